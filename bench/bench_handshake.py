@@ -0,0 +1,158 @@
+"""
+Compare the single message X25519 handshake with the SECP256K1 exchange it replaced
+
+    python -m bench.bench_handshake [--rtt MS] [--json]
+
+Both ends run in one process over in-memory frame streams, --rtt delays every
+frame by half the round trip to show what the saved round trips are worth.
+Nodes use the key pair of the working directory, so a throwaway one is generated first.
+"""
+
+from lib import util as cu
+from lib.session import SessionCache
+
+import argparse
+import asyncio
+import json
+import os
+import tempfile
+import time
+
+from cryptography.hazmat.backends import default_backend
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import ec
+
+
+class MemoryStream:
+    """
+    One end of an in-memory FrameProtocol stand-in
+    """
+
+    def __init__(self, delay: float):
+        self.delay = delay
+        self.inbox = asyncio.Queue()
+        self.peer = None
+
+    @classmethod
+    def pair(cls, delay: float = 0.0):
+        a, b = cls(delay), cls(delay)
+        a.peer, b.peer = b, a
+        return a, b
+
+    def get_extra_info(self, name, default=None):
+        return ('127.0.0.1', 0) if name == 'peername' else default
+
+    def write_frame(self, msg: bytes):
+        if self.delay:
+            asyncio.get_event_loop().call_later(self.delay, self.peer.inbox.put_nowait, bytes(msg))
+        else:
+            self.peer.inbox.put_nowait(bytes(msg))
+
+    async def drain(self):
+        pass
+
+    async def read_frame(self) -> bytes:
+        return await self.inbox.get()
+
+    def close(self):
+        pass
+
+
+async def legacy_handshake(n, is_client: bool):
+    """
+    The previous Node handshake: public keys, then signature and ECDH key as separate frames, in turn
+    """
+
+    if is_client:
+        await n._send_msg(n.identity.public_bytes)
+        pubkey_bytes = await n._recv_msg()
+    else:
+        pubkey_bytes = await n._recv_msg()
+        await n._send_msg(n.identity.public_bytes)
+    peer_pubkey = serialization.load_ssh_public_key(pubkey_bytes, default_backend())
+
+    dh_priv = ec.generate_private_key(ec.SECP256K1(), default_backend())
+    dh_pub_bytes = dh_priv.public_key().public_bytes(serialization.Encoding.X962,
+                                                     serialization.PublicFormat.UncompressedPoint)
+
+    async def send_dh():
+        await n._send_msg(n.identity.private_key.sign(dh_pub_bytes))
+        await n._send_msg(dh_pub_bytes)
+
+    async def receive_dh():
+        signature = await n._recv_msg()
+        peer_dh_bytes = await n._recv_msg()
+        peer_pubkey.verify(signature, peer_dh_bytes)
+        return ec.EllipticCurvePublicKey.from_encoded_point(ec.SECP256K1(), peer_dh_bytes)
+
+    if is_client:
+        await send_dh()
+        peer_dh = await receive_dh()
+    else:
+        peer_dh = await receive_dh()
+        await send_dh()
+    return dh_priv.exchange(ec.ECDH(), peer_dh)
+
+
+async def handshake_pair(path: str, delay: float, sessions):
+    from lib.node import Node
+
+    client_stream, server_stream = MemoryStream.pair(delay)
+    if path == 'secp256k1':
+        await asyncio.gather(legacy_handshake(Node(client_stream), True), legacy_handshake(Node(server_stream), False))
+        return
+    await asyncio.gather(Node.connect(client_stream, is_client=True, sessions=sessions[0]),
+                         Node.connect(server_stream, is_client=False, sessions=sessions[1]))
+
+
+async def measure(path: str, number: int, delay: float) -> dict:
+    # both ends of the resumed path keep their tickets across handshakes
+    sessions = (SessionCache(), SessionCache()) if path == 'resumed' else (None, None)
+    if path == 'resumed':
+        await handshake_pair(path, 0.0, sessions)
+
+    start = time.perf_counter()
+    for _ in range(number):
+        await handshake_pair(path, delay, sessions)
+    elapsed = time.perf_counter() - start
+
+    return {
+        'path': path,
+        'handshakes_per_s': number / elapsed,
+        'ms_per_handshake': elapsed / number * 1e3,
+    }
+
+
+def use_throwaway_keys():
+    os.chdir(tempfile.mkdtemp())
+    os.mkdir('.key')
+    cu.create_keys()
+    cu.write_trusted_key(cu.get_public_key())
+
+
+def run(number: int, rtt_ms: float) -> list:
+    use_throwaway_keys()
+
+    delay = rtt_ms / 2e3
+    return [asyncio.run(measure(path, number, delay)) for path in ('secp256k1', 'x25519', 'resumed')]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('-n', '--number', type=int, default=500, help="handshakes per measurement")
+    parser.add_argument('--rtt', type=float, default=0.0, help="simulated round trip time in milliseconds")
+    parser.add_argument('--json', action='store_true', help="print machine readable results")
+    args = parser.parse_args()
+
+    results = run(args.number, args.rtt)
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+
+    print(f"{'path':12}{'per s':>10}{'ms each':>10}")
+    for r in results:
+        print(f"{r['path']:12}{r['handshakes_per_s']:>10.1f}{r['ms_per_handshake']:>10.2f}")
+
+
+if __name__ == '__main__':
+    main()
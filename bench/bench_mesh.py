@@ -0,0 +1,316 @@
+"""
+Run a mesh of Meshchat instances over loopback and measure it
+
+    python -m bench.bench_mesh [-n NODES] [--address IP] [--port PORT] [--json] [--output FILE]
+
+Every instance gets a throwaway key pair trusting all the others and listens
+on its own loopback address, 127.0.0.1, 127.0.0.2 and so on by default, all on
+the same port since peers are known by their address alone. Linux routes the
+whole 127.0.0.0/8 to loopback, elsewhere the addresses may need adding first.
+
+Measured are full and resumed handshakes between two instances, message
+latency and throughput over one connection, the time each instance takes to
+join the mesh through the first one, and how long the mesh takes to agree on
+its members and to deliver a broadcast everywhere. The results, with the
+commit they were taken at, are printed or written as JSON to compare runs.
+"""
+
+from lib import util as cu
+from lib import logs
+from lib.engine import MESHCHAT_PORT
+from lib.meshchat import Meshchat
+from lib.session import SessionCache
+
+from typing import (Dict, List, Sequence)
+import argparse
+import asyncio
+import ipaddress
+import json
+import logging
+import os
+import platform
+import subprocess
+import tempfile
+import threading
+import time
+
+
+# how long the mesh may take to converge before the measurement gives up
+CONVERGENCE_TIMEOUT = 30.0
+POLL_INTERVAL = 0.005
+
+
+def percentiles(values: Sequence[float], points: Sequence[int] = (50, 90, 99)) -> Dict[str, float]:
+    """
+    Nearest rank percentiles of values, in milliseconds
+    """
+
+    ordered = sorted(values)
+    if not ordered:
+        return {}
+    result = {f'p{p}_ms': ordered[min(len(ordered) - 1, max(0, -(-p * len(ordered) // 100) - 1))] * 1e3
+              for p in points}
+    result['max_ms'] = ordered[-1] * 1e3
+    return result
+
+
+def run_on(m: Meshchat, coro):
+    """
+    Run coro on the instance's event loop and wait for its result
+    """
+
+    return asyncio.run_coroutine_threadsafe(coro, m.loop).result()
+
+
+def create_key_dirs(root: str, number: int) -> List[str]:
+    directories = [os.path.join(root, f'node{i}', '.key') for i in range(number)]
+    public_keys = []
+    for directory in directories:
+        os.makedirs(directory)
+        cu.create_keys(directory)
+        public_keys.append(cu.get_public_key(directory))
+    for directory in directories:
+        for kbytes in public_keys:
+            cu.write_trusted_key(kbytes, directory)
+    return directories
+
+
+def start_mesh(root: str, number: int, address: str, port: int, **engine_kwargs) -> List[Meshchat]:
+    first = ipaddress.ip_address(address)
+    instances = []
+    for i, key_dir in enumerate(create_key_dirs(root, number)):
+        m = Meshchat(host=str(first + i), port=port, key_dir=key_dir, **engine_kwargs)
+        m.start_network()
+        instances.append(m)
+    return instances
+
+
+async def _handshakes(m: Meshchat, ipa: str, number: int, resume: bool) -> List[float]:
+    engine = m.engine
+    durations = []
+    for _ in range(number):
+        if not resume:
+            engine.sessions = SessionCache()
+        start = time.perf_counter()
+        node = await engine.connect_peer(ipa)
+        durations.append(time.perf_counter() - start)
+
+        # the next handshake starts once both ends let go of this connection
+        node.close()
+        listener = engine.listen_tasks.get(ipa)
+        if listener is not None:
+            await listener
+    return durations
+
+
+async def _count_connections(m: Meshchat) -> int:
+    return len(m.engine.connections)
+
+
+def measure_handshakes(client: Meshchat, server: Meshchat, number: int) -> dict:
+    results = {}
+    for path, resume in (('full', False), ('resumed', True)):
+        start = time.perf_counter()
+        durations = run_on(client, _handshakes(client, server.engine.host, number, resume))
+        elapsed = time.perf_counter() - start
+        results[path] = {'handshakes_per_s': number / elapsed, **percentiles(durations)}
+        # the server may still hold the last connection
+        while run_on(server, _count_connections(server)):
+            time.sleep(POLL_INTERVAL)
+    return results
+
+
+def measure_messages(sender: Meshchat, receiver: Meshchat, number: int, size: int) -> dict:
+    """
+    One way latency of messages sent one at a time, then throughput of as many sent back to back
+    """
+
+    text = 'x' * size
+    received = []
+    arrived = threading.Event()
+    expected = 0
+
+    def dispatch(_):
+        received.append(time.perf_counter())
+        if len(received) >= expected:
+            arrived.set()
+
+    sender_ipa, receiver_ipa = sender.engine.host, receiver.engine.host
+    sender.connect_peer(receiver_ipa)
+    while sender_ipa not in receiver.connections:
+        time.sleep(POLL_INTERVAL)
+    receiver.set_message_dispatcher(sender_ipa, dispatch)
+
+    latencies = []
+    for i in range(number):
+        expected = i + 1
+        arrived.clear()
+        start = time.perf_counter()
+        sender.send_message(receiver_ipa, text)
+        arrived.wait(CONVERGENCE_TIMEOUT)
+        latencies.append(received[-1] - start)
+
+    async def burst():
+        for _ in range(number):
+            await sender.engine.send_message(receiver_ipa, text)
+
+    received.clear()
+    expected = number
+    arrived.clear()
+    start = time.perf_counter()
+    run_on(sender, burst())
+    if not arrived.wait(CONVERGENCE_TIMEOUT):
+        raise TimeoutError(f"only {len(received)} of {number} messages arrived")
+    elapsed = received[-1] - start
+
+    return {
+        'size': size,
+        'latency': percentiles(latencies),
+        'messages_per_s': number / elapsed,
+        'megabytes_per_s': number * size / elapsed / 1e6,
+    }
+
+
+async def _known_keys(m: Meshchat) -> set:
+    return set(m.engine.known_peers) | {m.engine.public_bytes}
+
+
+def measure_bootstrap(instances: List[Meshchat]) -> dict:
+    """
+    Join every instance through the first, then wait for all to know every member
+    """
+
+    inviter = instances[0].engine.host
+    durations = []
+    for m in instances[1:]:
+        start = time.perf_counter()
+        m.join_network(inviter)
+        durations.append(time.perf_counter() - start)
+
+    members = {m.public_bytes for m in instances}
+    joined = time.perf_counter()
+    while not all(run_on(m, _known_keys(m)) >= members for m in instances):
+        if time.perf_counter() - joined > CONVERGENCE_TIMEOUT:
+            raise TimeoutError("members didn't converge")
+        time.sleep(POLL_INTERVAL)
+
+    return {
+        'join': percentiles(durations),
+        'total_ms': sum(durations) * 1e3,
+        'membership_convergence_ms': (time.perf_counter() - joined) * 1e3,
+    }
+
+
+def measure_broadcast(instances: List[Meshchat], number: int) -> dict:
+    """
+    Time from a broadcast to its arrival at the last instance, and the copies sent for it
+    """
+
+    arrivals: Dict[str, List[float]] = {}
+    lock = threading.Lock()
+
+    def on_broadcast(_, text):
+        with lock:
+            arrivals.setdefault(text, []).append(time.perf_counter())
+
+    for m in instances:
+        m.bind(on_broadcast=on_broadcast)
+
+    origin, others = instances[0], len(instances) - 1
+    convergence = []
+    for i in range(number):
+        text = f'broadcast {i}'
+        start = time.perf_counter()
+        origin.broadcast(text)
+        while len(arrivals.get(text, ())) < others:
+            if time.perf_counter() - start > CONVERGENCE_TIMEOUT:
+                raise TimeoutError(f"{text} reached {len(arrivals.get(text, ()))} of {others} instances")
+            time.sleep(POLL_INTERVAL / 5)
+        convergence.append(arrivals[text][-1] - start)
+
+    duplicates = sum(m.stats()['meshchat_gossip_duplicates_total'] for m in instances)
+    return {
+        'convergence': percentiles(convergence),
+        'duplicates_per_broadcast': duplicates / number,
+    }
+
+
+def git_commit() -> str:
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__)), check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+def run(nodes: int, address: str, port: int, handshakes: int, messages: int, size: int, broadcasts: int) -> dict:
+    if nodes < 2:
+        raise ValueError("a mesh needs at least two nodes")
+
+    with tempfile.TemporaryDirectory() as root:
+        # probes and heartbeats would only add noise to a run this short
+        instances = start_mesh(root, nodes, address, port, probe_interval=3600.0, heartbeat_interval=None,
+                               receive_deadline=None)
+        try:
+            results = {
+                'handshake': measure_handshakes(instances[1], instances[0], handshakes),
+                'messages': measure_messages(instances[1], instances[0], messages, size),
+                'bootstrap': measure_bootstrap(instances),
+                'broadcast': measure_broadcast(instances, broadcasts),
+            }
+        finally:
+            for m in instances:
+                m.stop()
+
+    return {
+        'commit': git_commit(),
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'python': platform.python_version(),
+        'nodes': nodes,
+        'results': results,
+    }
+
+
+def _print(report: dict):
+    r = report['results']
+    print(f"{report['nodes']} nodes at {report['commit']}")
+    for path, h in r['handshake'].items():
+        print(f"handshake {path:9}{h['handshakes_per_s']:>10.1f}/s  p50 {h['p50_ms']:.2f} ms  p99 {h['p99_ms']:.2f} ms")
+    m = r['messages']
+    print(f"messages of {m['size']} B  {m['messages_per_s']:>10.1f}/s  {m['megabytes_per_s']:.2f} MB/s  "
+          f"latency p50 {m['latency']['p50_ms']:.3f} ms  p99 {m['latency']['p99_ms']:.3f} ms")
+    b = r['bootstrap']
+    print(f"join              p50 {b['join']['p50_ms']:.1f} ms  max {b['join']['max_ms']:.1f} ms  "
+          f"members converged after {b['membership_convergence_ms']:.1f} ms")
+    g = r['broadcast']
+    print(f"broadcast         p50 {g['convergence']['p50_ms']:.2f} ms  max {g['convergence']['max_ms']:.2f} ms  "
+          f"{g['duplicates_per_broadcast']:.1f} duplicates each")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('-n', '--nodes', type=int, default=8, help="instances in the mesh")
+    parser.add_argument('--address', default='127.0.0.1', help="loopback address of the first instance")
+    parser.add_argument('--port', type=int, default=MESHCHAT_PORT, help="port every instance listens on")
+    parser.add_argument('--handshakes', type=int, default=200, help="handshakes per measurement")
+    parser.add_argument('--messages', type=int, default=2000, help="messages per measurement")
+    parser.add_argument('--size', type=int, default=100, help="message size in bytes")
+    parser.add_argument('--broadcasts', type=int, default=20, help="broadcasts to time")
+    parser.add_argument('--json', action='store_true', help="print machine readable results")
+    parser.add_argument('-o', '--output', help="also write the JSON results to this file")
+    args = parser.parse_args()
+
+    # connections closed right after their handshake make the engine warn about every one
+    logs.configure(logging.ERROR, filename=None)
+    report = run(args.nodes, args.address, args.port, args.handshakes, args.messages, args.size, args.broadcasts)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        _print(report)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,95 @@
+"""
+Compare the AEAD record layer with the per-message HKDF + Fernet path it replaced
+
+    python -m bench.bench_record [--json]
+"""
+
+from lib.record import RecordCipher
+
+import argparse
+import base64
+import json
+import os
+import timeit
+
+from cryptography.fernet import Fernet
+from cryptography.hazmat.backends import default_backend
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.kdf.hkdf import HKDF
+
+
+SIZES = [16, 256, 4096, 65536]
+
+
+class FernetChain:
+    """
+    The previous Node crypto: derive a fresh key, build a Fernet, encrypt
+    """
+
+    def __init__(self, key: bytes):
+        self.enc_key = key
+
+    def derive_enc_key(self, key):
+        self.enc_key = HKDF(
+            algorithm=hashes.SHA256(),
+            length=32,
+            salt=None,
+            info=None,
+            backend=default_backend()
+        ).derive(key)
+
+    def seal(self, msg: bytes) -> bytes:
+        self.derive_enc_key(self.enc_key)
+        return Fernet(base64.urlsafe_b64encode(self.enc_key)).encrypt(msg)
+
+    def open(self, token: bytes) -> bytes:
+        self.derive_enc_key(self.enc_key)
+        return Fernet(base64.urlsafe_b64encode(self.enc_key)).decrypt(token)
+
+
+def measure(seal, open_, msg: bytes, number: int) -> dict:
+    records = []
+    seal_time = timeit.timeit(lambda: records.append(seal(msg)), number=number)
+    it = iter(records)
+    open_time = timeit.timeit(lambda: open_(next(it)), number=number)
+
+    return {
+        'seal_us': seal_time / number * 1e6,
+        'open_us': open_time / number * 1e6,
+        'wire_bytes': len(records[0]),
+    }
+
+
+def run(number: int) -> list:
+    results = []
+    for size in SIZES:
+        msg = os.urandom(size)
+        key = os.urandom(32)
+
+        sealer, opener = FernetChain(key), FernetChain(key)
+        results.append({'path': 'fernet', 'size': size, **measure(sealer.seal, opener.open, msg, number)})
+
+        sealer, opener = RecordCipher(key), RecordCipher(key)
+        results.append({'path': 'aead', 'size': size, **measure(
+            lambda m: sealer.seal(m, 0), lambda r: opener.open(r, 0), msg, number)})
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('-n', '--number', type=int, default=2000, help="records per measurement")
+    parser.add_argument('--json', action='store_true', help="print machine readable results")
+    args = parser.parse_args()
+
+    results = run(args.number)
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+
+    print(f"{'path':8}{'size':>8}{'seal us':>10}{'open us':>10}{'wire':>8}")
+    for r in results:
+        print(f"{r['path']:8}{r['size']:>8}{r['seal_us']:>10.2f}{r['open_us']:>10.2f}{r['wire_bytes']:>8}")
+
+
+if __name__ == '__main__':
+    main()
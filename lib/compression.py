@@ -0,0 +1,210 @@
+"""
+Compression of messages before they're sealed by the record layer
+
+Codecs are registered under a one byte id. Both ends list the ids they support
+in their hellos, most preferred first, and use the first codec of the client's
+list the server supports as well, or none. With a codec every message carries
+a flag byte telling whether the rest is compressed. Messages below a size
+threshold, or that wouldn't shrink, go out as they are.
+
+Compressing each message on its own keeps connections free of codec state,
+the default codec makes up for it on short chat messages with a dictionary
+of common text both ends share.
+"""
+
+from .framing import MAX_FRAME_SIZE
+
+from typing import (Dict, List, Optional, Sequence)
+import time
+import zlib
+
+
+# no compression, never registered
+CODEC_NONE = 0
+CODEC_ZLIB = 1
+# messages shorter than this aren't worth the compression attempt
+COMPRESS_THRESHOLD = 32
+
+_RAW = b'\x00'
+_COMPRESSED = b'\x01'
+
+# zlib finds matches in the dictionary as if it preceded every message, likeliest strings go last
+CHAT_DICTIONARY = (
+    b'http://https://www..com.org.net.jpg.png.pdf.zip'
+    b' would could should about their there which after before because'
+    b' thanks thank you please sorry okay yeah yes no not'
+    b' what when where why how who is are was were will can do does did have has had'
+    b' tomorrow today tonight morning evening later soon now'
+    b' I\'m I\'ll I\'ve don\'t can\'t won\'t it\'s that\'s'
+    b' hello hi hey bye see you later'
+    b' the and for that this with you your have are not but'
+)
+
+
+class Codec:
+    """
+    A compression algorithm both ends of a connection know by its id
+    """
+
+    id: int
+    name: str
+
+    def compress(self, data: bytes) -> bytes:
+        raise NotImplementedError
+
+    def decompress(self, data: bytes, max_size: int) -> bytes:
+        """
+        :raises ValueError: if data is corrupt or decompresses to more than max_size bytes
+        """
+
+        raise NotImplementedError
+
+
+class ZlibCodec(Codec):
+    """
+    Raw deflate primed with a preset dictionary
+    """
+
+    id = CODEC_ZLIB
+    name = 'zlib'
+
+    def __init__(self, level: int = 6, dictionary: bytes = CHAT_DICTIONARY):
+        self.level = level
+        self.dictionary = dictionary
+
+    def compress(self, data: bytes) -> bytes:
+        compressor = zlib.compressobj(self.level, zlib.DEFLATED, -zlib.MAX_WBITS, zdict=self.dictionary)
+        return compressor.compress(data) + compressor.flush()
+
+    def decompress(self, data: bytes, max_size: int) -> bytes:
+        decompressor = zlib.decompressobj(-zlib.MAX_WBITS, zdict=self.dictionary)
+        try:
+            plain = decompressor.decompress(data, max_size)
+        except zlib.error as e:
+            raise ValueError(f"corrupt compressed message: {e}")
+        if decompressor.unconsumed_tail:
+            raise ValueError(f"compressed message expands beyond {max_size} bytes")
+        if not decompressor.eof:
+            raise ValueError("truncated compressed message")
+        if decompressor.unused_data:
+            raise ValueError("data after the end of a compressed message")
+        return plain
+
+
+# supported codecs by id, in order of preference
+CODECS: Dict[int, Codec] = {}
+
+
+def register_codec(codec: Codec):
+    """
+    Make codec available to new connections, preferred over the ones registered before
+    """
+
+    if codec.id == CODEC_NONE or not 0 < codec.id < 256:
+        raise ValueError(f"invalid codec id {codec.id}")
+    CODECS.pop(codec.id, None)
+    CODECS[codec.id] = codec
+
+
+register_codec(ZlibCodec())
+
+
+def supported_codecs() -> List[int]:
+    return list(reversed(CODECS))
+
+
+def negotiate(client_codecs: Sequence[int], server_codecs: Sequence[int]) -> int:
+    """
+    The client's most preferred codec the server supports too, CODEC_NONE if there is none
+    """
+
+    return next((c for c in client_codecs if c in server_codecs and c in CODECS), CODEC_NONE)
+
+
+class CompressionStats:
+    """
+    Totals of one direction of a connection
+    """
+
+    def __init__(self):
+        self.messages = 0
+        # messages that went out or came in compressed
+        self.compressed = 0
+        # message bytes before compression and on the wire
+        self.raw_bytes = 0
+        self.wire_bytes = 0
+        # CPU seconds spent compressing or decompressing
+        self.seconds = 0.0
+
+    @property
+    def ratio(self) -> float:
+        """
+        Uncompressed over transmitted size, above 1 when compression pays off
+        """
+
+        return self.raw_bytes / self.wire_bytes if self.wire_bytes else 1.0
+
+    def add(self, raw: int, wire: int, compressed: bool, seconds: float):
+        self.messages += 1
+        self.compressed += compressed
+        self.raw_bytes += raw
+        self.wire_bytes += wire
+        self.seconds += seconds
+
+    def __repr__(self) -> str:
+        return (f"CompressionStats(messages={self.messages}, compressed={self.compressed}, "
+                f"ratio={self.ratio:.2f}, seconds={self.seconds:.6f})")
+
+
+class Compressor:
+    """
+    Frames the messages of one connection for the negotiated codec and keeps statistics
+    """
+
+    def __init__(self, codec_id: int = CODEC_NONE, threshold: int = COMPRESS_THRESHOLD,
+                 max_size: int = MAX_FRAME_SIZE):
+        self.codec: Optional[Codec] = CODECS.get(codec_id)
+        self.threshold = threshold
+        self.max_size = max_size
+        self.sent = CompressionStats()
+        self.received = CompressionStats()
+
+    @property
+    def codec_id(self) -> int:
+        return CODEC_NONE if self.codec is None else self.codec.id
+
+    def encode(self, msg: bytes) -> bytes:
+        if self.codec is None:
+            return msg
+        if len(msg) < self.threshold:
+            self.sent.add(len(msg), len(msg) + 1, False, 0.0)
+            return _RAW + msg
+
+        start = time.thread_time()
+        packed = self.codec.compress(msg)
+        seconds = time.thread_time() - start
+        if len(packed) >= len(msg):
+            self.sent.add(len(msg), len(msg) + 1, False, seconds)
+            return _RAW + msg
+        self.sent.add(len(msg), len(packed) + 1, True, seconds)
+        return _COMPRESSED + packed
+
+    def decode(self, record: bytes) -> bytes:
+        """
+        :raises ValueError: if the message is malformed
+        """
+
+        if self.codec is None:
+            return record
+
+        flag, body = record[:1], record[1:]
+        if flag == _RAW:
+            self.received.add(len(body), len(record), False, 0.0)
+            return body
+        if flag != _COMPRESSED:
+            raise ValueError(f"unknown compression flag {flag.hex()}")
+
+        start = time.thread_time()
+        msg = self.codec.decompress(body, self.max_size)
+        self.received.add(len(msg), len(record), True, time.thread_time() - start)
+        return msg
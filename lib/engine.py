@@ -0,0 +1,1230 @@
+"""
+Event loop driven core of the mesh
+
+All connections share a single thread: every ``Node`` is read by its own
+``listen_messages`` task and the server accepts peers through ``asyncio``.
+"""
+
+from .node import (Node, make_hello, open_hello, key_exchange)
+from . import util as cu
+from . import protocol
+from .rpc import REQUEST_TIMEOUT
+from .gossip import SeenCache
+from .peertable import PeerTable
+from .session import SessionCache
+from .record import derive_key
+from .routing import (RoutingTable, EndToEnd, ROUTED_TTL, ROUTED_HELLO, ROUTED_HELLO_REPLY, ROUTED_DATA,
+                      ROUTED_UNKNOWN, ROUTED_SESSION_IDLE)
+from .pool import (ConnectionPool, MAX_CONNECTIONS, IDLE_TIMEOUT, KEEPALIVE_INTERVAL, HEARTBEAT_INTERVAL,
+                   RECEIVE_DEADLINE)
+from .transfer import (OutgoingTransfer, IncomingTransfer, CHUNK_SIZE, WINDOW)
+from .link import (LinkQuality, select_neighbours)
+from .metrics import (Registry, ConnectionStats)
+from .framing import (FrameProtocol, TransportProfile, DEFAULT_PROFILE)
+from .transport import (Transport, TcpTransport, ANY_HOST)
+
+from typing import (Callable, List, NamedTuple, Dict, Optional, Sequence, Set, Tuple)
+import asyncio
+import hashlib
+import math
+import os
+import random
+import threading
+import struct
+import time
+
+from cryptography.exceptions import (InvalidSignature, InvalidTag)
+from cryptography.hazmat.primitives.asymmetric import x25519
+
+import logging
+
+
+logger = logging.getLogger(__name__)
+
+
+MESHCHAT_PORT = 8008
+# every interface, peers are told apart by their address
+MESHCHAT_HOST = ANY_HOST
+MAX_NEIGHBOURS = 4
+CONNECT_TIMEOUT = 5.0
+# seconds between known peers syncs with a random connected peer
+ANTI_ENTROPY_INTERVAL = 30.0
+# seconds between pings measuring every connection's link
+PROBE_INTERVAL = 10.0
+# seconds between writes of the metrics file
+STATS_INTERVAL = 15.0
+# a keepalive ping not answered in time marks the connection dead
+PING_TIMEOUT = 5.0
+# connections the kernel queues before they are accepted
+ACCEPT_BACKLOG = 128
+# handshakes of accepted connections run at once, the rest wait their turn
+MAX_HANDSHAKES = 32
+# an accepted peer has this long to finish its handshake, queueing included
+HANDSHAKE_TIMEOUT = 5.0
+# longest text, encoded, send_message and broadcast take, anything bigger goes with send_file
+MAX_MESSAGE_SIZE = 64 * 1024
+# route changes within this many seconds go out in one advertisement
+ADVERTISE_DELAY = 0.5
+
+
+class Peer(NamedTuple):
+    ipa: str
+    # should be in bytes to easily construct a public key or decode to str
+    kbytes: bytes
+    # key: Optional[bytes] = None
+
+
+class AsyncMeshchat:
+    """
+    Mesh networking core; every coroutine must run on the same event loop
+    """
+
+    def __init__(self, transport_profile: TransportProfile = DEFAULT_PROFILE, gossip_fanout: int = MAX_NEIGHBOURS,
+                 anti_entropy_interval: float = ANTI_ENTROPY_INTERVAL, max_connections: int = MAX_CONNECTIONS,
+                 connect_timeout: float = CONNECT_TIMEOUT, idle_timeout: float = IDLE_TIMEOUT,
+                 keepalive_interval: float = KEEPALIVE_INTERVAL, accept_backlog: int = ACCEPT_BACKLOG,
+                 max_handshakes: int = MAX_HANDSHAKES, handshake_timeout: float = HANDSHAKE_TIMEOUT,
+                 codecs: Sequence[int] = None, probe_interval: float = PROBE_INTERVAL,
+                 heartbeat_interval: Optional[float] = HEARTBEAT_INTERVAL,
+                 receive_deadline: Optional[float] = RECEIVE_DEADLINE,
+                 stats_file: str = None, stats_format: str = 'prometheus', stats_interval: float = STATS_INTERVAL,
+                 host: str = MESHCHAT_HOST, port: int = MESHCHAT_PORT, key_dir: str = cu.KEY_DIR,
+                 identity: cu.Identity = None, transport: Transport = None, clock: Callable[[], float] = time.time):
+        self.transport_profile = transport_profile
+        # TCP unless simulated, see lib.transport
+        self.transport = transport if transport is not None else TcpTransport(transport_profile)
+        # compression codecs offered to peers, None for every registered one
+        self.codecs = codecs
+        # the address we listen and dial from, and the port every node of the mesh listens on
+        self.host = host
+        self.port = port
+        # nodes sharing a process each need their own key directory, or an identity made in memory
+        if identity is None:
+            identity = cu.default_identity() if key_dir == cu.KEY_DIR else cu.Identity.load(key_dir)
+        self.identity = identity
+        self.public_bytes = self.identity.public_bytes
+        self.public_raw = self.identity.public_raw
+        self.neighbours: List[Peer] = []
+        # versions are stamped in milliseconds of the wall clock, or of the loop's when simulated
+        self.known_peers = PeerTable(clock=lambda: int(clock() * 1000))
+        # reconnecting to a peer resumes the last session instead of a full handshake
+        # expiries follow the loop's clock, which may be simulated
+        self._loop_clock = asyncio.get_event_loop().time
+        self.sessions = SessionCache(clock=self._loop_clock)
+        self.anti_entropy_interval = anti_entropy_interval
+        self.anti_entropy_task = None
+
+        # neighbours are pinned, the pool only evicts or idles out other connections. connections
+        # whose peer stopped sending, heartbeats included, are closed whether pinned or not. None turns either off
+        self.pool = ConnectionPool(self.connect_peer, self.ping,
+                                   pinned=lambda ipa: any(n.ipa == ipa for n in self.neighbours),
+                                   max_size=max_connections, connect_timeout=connect_timeout,
+                                   idle_timeout=idle_timeout, keepalive_interval=keepalive_interval,
+                                   heartbeat=self.heartbeat if heartbeat_interval is not None else None,
+                                   heartbeat_interval=heartbeat_interval,
+                                   receive_deadline=receive_deadline)
+        self.pool_task = None
+        self.connections = self.pool.connections
+        self.probe_interval = probe_interval
+        self.probe_task = None
+        self.listen_tasks: Dict[str, asyncio.Task] = {}
+        # connections being listened to by address, and the traffic of closed ones per address
+        self._listened: Dict[Node, str] = {}
+        self._closed_stats: Dict[str, ConnectionStats] = {}
+
+        self.accept_backlog = accept_backlog
+        self.handshake_timeout = handshake_timeout
+        self._handshakes = asyncio.Semaphore(max_handshakes)
+
+        # neighbours each flooded message is forwarded to
+        self.gossip_fanout = gossip_fanout
+        self.gossip_seen = SeenCache(clock=self._loop_clock)
+        self._gossip_seq = 0
+
+        # peers without a direct connection are reached through relays
+        self.routes = RoutingTable(self.public_raw)
+        self._advertise_task = None
+        # the connection at each address and the routes record it was last sent
+        self._advertised: Dict[str, Tuple[Node, bytes]] = {}
+        # end-to-end sessions over relays by raw key, and the ones being set up
+        self.routed_sessions: Dict[bytes, EndToEnd] = {}
+        self._routed_handshakes: Dict[bytes, Tuple[x25519.X25519PrivateKey, bytes, asyncio.Future]] = {}
+
+        # file transfers by (peer key, transfer id)
+        self.transfers_out: Dict[Tuple[bytes, bytes], OutgoingTransfer] = {}
+        self.transfers_in: Dict[Tuple[bytes, bytes], IncomingTransfer] = {}
+        self.server = None
+
+        # with a stats file, metrics are written to it every stats_interval in stats_format
+        self.stats_file = stats_file
+        self.stats_format = stats_format
+        self.stats_interval = stats_interval
+        self.stats_task = None
+        self.metrics = Registry()
+
+        self.transport.bind(host, port)
+        self._setup_callbacks()
+        self._setup_metrics()
+
+    def _setup_callbacks(self):
+        self.on_joined = lambda _: None
+        self.on_peer_joined = lambda _: None
+        self.on_connected = lambda _: None
+        self.on_peer_connected = lambda _: None
+        self.on_peer_disconnected = lambda _: None
+        self.on_received_peers = lambda _: None
+        # called with the sending Peer and the text of every message relayed to us
+        self.on_routed_message = lambda *_: None
+        # called with the originating Peer and the text of every broadcast, once per broadcast
+        self.on_broadcast = lambda *_: None
+        # called with the offering Peer, the file's name and size, returns the path to store it at or None to decline
+        self.on_file_offer = lambda *_: None
+        # called with the sending Peer and the path of every completely received file
+        self.on_file_received = lambda *_: None
+
+    def _setup_metrics(self):
+        m = self.metrics
+        self._connect_failures = m.counter('meshchat_connect_failures_total',
+                                           "Outgoing connections that failed to connect or complete the handshake")
+        self._handshake_failures = m.counter('meshchat_accept_failures_total',
+                                             "Accepted connections whose handshake failed or timed out")
+        self._handshake_seconds = m.summary('meshchat_handshake_seconds', "Handshake duration by phase", 'phase')
+        self._handling_seconds = m.summary('meshchat_message_handling_seconds',
+                                           "Time taken to handle received messages by code", 'code')
+        self._alert_seconds = m.summary('meshchat_alert_newpeer_seconds', "Time taken to announce a peer")
+
+        def per_connection(attr: str):
+            # connections to an address replacing each other add up, the counters never go back
+            def collect():
+                totals = {ipa: getattr(stats, attr) for ipa, stats in self._closed_stats.items()}
+                for node, ipa in self._listened.items():
+                    totals[ipa] = totals.get(ipa, 0) + getattr(node.stats, attr)
+                return totals
+            return collect
+
+        for attr, help in (('messages_sent', "Messages sent"), ('messages_received', "Messages received"),
+                           ('bytes_sent', "Record bytes sent"), ('bytes_received', "Record bytes received"),
+                           ('seal_seconds', "Time spent encrypting records"),
+                           ('open_seconds', "Time spent decrypting records")):
+            m.collected_counter(f'meshchat_connection_{attr}_total', f"{help} on connections to an address",
+                                per_connection(attr), 'ipa')
+        m.gauge('meshchat_read_queue_bytes', "Received bytes waiting to be read by connection",
+                lambda: {ipa: node.stream.queued_bytes for ipa, node in self.connections.items()}, 'ipa')
+        m.gauge('meshchat_write_buffer_bytes', "Bytes waiting to be written by connection",
+                lambda: {ipa: node.stream.write_buffer_size for ipa, node in self.connections.items()}, 'ipa')
+        m.gauge('meshchat_pending_records', "Records queued for connections being established",
+                lambda: sum(map(len, self.pool.pending.values())))
+        m.collected_counter('meshchat_gossip_duplicates_total', "Flooded messages dropped as already seen",
+                            lambda: self.gossip_seen.duplicates)
+
+        m.gauge('meshchat_connections', "Established connections", lambda: len(self.connections))
+        m.gauge('meshchat_neighbours', "Neighbours", lambda: len(self.neighbours))
+        m.gauge('meshchat_known_peers', "Known peers", lambda: len(self.known_peers))
+        m.gauge('meshchat_routes', "Nodes reachable through relays", lambda: len(self.routes))
+        m.gauge('meshchat_transfers', "File transfers in progress",
+                lambda: len(self.transfers_in) + len(self.transfers_out))
+        m.gauge('meshchat_threads', "Threads of the process", threading.active_count)
+        m.gauge('meshchat_tasks', "Tasks of the event loop", lambda: len(asyncio.all_tasks()))
+
+    def stats(self) -> dict:
+        """
+        Snapshot of the node's metrics by name, per connection or phase ones by address or phase
+        """
+
+        return self.metrics.snapshot()
+
+    async def write_stats(self):
+        """
+        Periodically replace the stats file with the current metrics
+        """
+
+        while True:
+            await asyncio.sleep(self.stats_interval)
+            try:
+                self.metrics.write(self.stats_file, self.stats_format)
+            except OSError as e:
+                logger.error("couldn't write metrics to %s: %r", self.stats_file, e)
+
+    def _observe_handshake(self, node: Node):
+        for phase, seconds in node.stats.handshake.items():
+            self._handshake_seconds.labels(phase).observe(seconds)
+
+    def bind(self, **kwargs):
+        for key, value in kwargs.items():
+            assert callable(value), f"{value} is not callable"
+            setattr(self, key, value)
+
+    async def start_network(self):
+        """
+        Start hosting new connections
+        """
+
+        if self.server is None:
+            self.server = await self.transport.start_server(self.listen_peer, self.accept_backlog)
+        if self.anti_entropy_task is None:
+            self.anti_entropy_task = asyncio.ensure_future(self.anti_entropy())
+        if self.pool_task is None:
+            self.pool_task = asyncio.ensure_future(self.pool.maintain())
+        if self.probe_task is None:
+            self.probe_task = asyncio.ensure_future(self.probe_links())
+        if self.stats_task is None and self.stats_file is not None:
+            self.stats_task = asyncio.ensure_future(self.write_stats())
+
+    async def serve_peers(self):
+        """
+        Host new connections until the server is closed
+        """
+
+        await self.start_network()
+        await self.server.wait_closed()
+
+    async def listen_peer(self, stream: FrameProtocol):
+        """
+        Take over a connection accepted by the server
+
+        Every accepted connection runs in its own task, a slow or stalled
+        handshake is dropped after handshake_timeout without holding up the others.
+        """
+
+        ipa = stream.get_extra_info('peername')[0]
+
+        try:
+            node = await asyncio.wait_for(self._accept_handshake(stream), self.handshake_timeout)
+        except (RuntimeError, OSError, asyncio.TimeoutError) as e:
+            logger.error("%s: handshake failed: %r", ipa, e)
+            self._handshake_failures.inc()
+            stream.close()
+            return
+        self._observe_handshake(node)
+
+        peer_pubkey = node.peer_kbytes
+        is_new = peer_pubkey not in self.known_peers
+        # * if a peer joins with a new ipa it will be reset
+        self.known_peers[peer_pubkey] = ipa
+        # when connecting node already checks if new key is trusted and invited
+        if is_new:
+            logger.debug("%s is a new invitee, alerting", peer_pubkey)
+            await self.alert_newpeer(ipa, peer_pubkey, ipa)
+
+        self._add_neighbour(Peer(ipa, peer_pubkey))
+
+        if self._add_connection(ipa, node) is not node:
+            return
+
+        logger.info("%s: connection established", ipa)
+        self.on_peer_connected(node)
+
+    async def _accept_handshake(self, stream: FrameProtocol) -> Node:
+        # a burst of joiners is served a few at a time, the loop stays free for established connections
+        async with self._handshakes:
+            return await Node.connect(stream, is_client=False, trusted_keys=self.known_peers,
+                                      sessions=self.sessions, codecs=self.codecs, identity=self.identity)
+
+    async def alert_newpeer(self, sender_ipa: str, peer_pubkey: bytes, peer_ipa: str,
+                            gossip_id: Tuple[bytes, int] = None):
+        """
+        Announce a known peer to the neighbours, gossip_id is given when forwarding someone else's announcement
+        """
+
+        start = time.perf_counter()
+        if gossip_id is None:
+            gossip_id = self._next_gossip_id()
+        # the entry's version travels along, every node ends up with the same one
+        peer_record = protocol.encode_peer_records([self.known_peers.record(peer_pubkey)])
+        record = MESSAGE_CODES['newpeer'] + protocol.encode_gossip(*gossip_id, peer_record)
+
+        targets = self._gossip_targets(peer_ipa, sender_ipa)
+        await self._fan_out(targets, record)
+        self._alert_seconds.observe(time.perf_counter() - start)
+
+        logger.debug("alerted %s neighbours of %s", len(targets), peer_ipa)
+
+    def _next_gossip_id(self) -> Tuple[bytes, int]:
+        gossip_id = (self.public_raw, self._gossip_seq)
+        self._gossip_seq = (self._gossip_seq + 1) & 0xFFFFFFFF
+        # our own messages echoed back are duplicates too
+        self.gossip_seen.check(gossip_id)
+        return gossip_id
+
+    def _gossip_targets(self, *excluded_ipas: str) -> List[Peer]:
+        targets = [n for n in self.neighbours if n.ipa not in excluded_ipas]
+        if len(targets) > self.gossip_fanout:
+            targets = random.sample(targets, self.gossip_fanout)
+        return targets
+
+    async def _fan_out(self, targets: List[Peer], record: bytes):
+        results = await asyncio.gather(*(self._send_record(n.ipa, record) for n in targets), return_exceptions=True)
+        for n, result in zip(targets, results):
+            if isinstance(result, Exception):
+                logger.warning("%s: couldn't forward: %r", n.ipa, result)
+
+    async def _send_record(self, ipa: str, record: bytes):
+        node = await self._get_peer(ipa)
+        await node.send_message(record)
+
+    async def broadcast(self, msg: str):
+        """
+        Send a text message to every node of the mesh
+
+        The message is pushed to every connected peer, which forwards it to
+        theirs, so each node sends it at most once per connection whatever the
+        size of the network. Gossip ids drop the copies arriving over other
+        paths and the origin's signature keeps relays from altering it.
+
+        :raises ValueError: if the encoded text is longer than MAX_MESSAGE_SIZE
+        """
+
+        text = _check_size(msg.encode())
+        gossip_id = self._next_gossip_id()
+        signature = self.identity.private_key.sign(_broadcast_signed(*gossip_id, text))
+        record = MESSAGE_CODES['broadcast'] + protocol.encode_gossip(*gossip_id, signature + text)
+        await self._forward_broadcast(record)
+
+    async def _forward_broadcast(self, record: bytes, sender_ipa: str = None):
+        nodes = [node for ipa, node in self.connections.items() if ipa != sender_ipa]
+        results = await asyncio.gather(*(node.send_message(record) for node in nodes), return_exceptions=True)
+        for node, result in zip(nodes, results):
+            if isinstance(result, Exception):
+                logger.warning("%s: couldn't forward a broadcast: %r", node.peer_ipa, result)
+
+    async def _handle_broadcast(self, node: Node, body: bytes):
+        gossip_id, payload = protocol.decode_gossip(body)
+        # only marked seen once verified, a forged copy arriving first mustn't suppress the real one
+        if self.gossip_seen.peek(gossip_id):
+            return
+        origin, seq = gossip_id
+        if len(payload) < SIGNATURE_SIZE:
+            raise ValueError("broadcast without a signature")
+        signature, text = payload[:SIGNATURE_SIZE], payload[SIGNATURE_SIZE:]
+
+        if not self._is_trusted_raw(origin):
+            logger.debug("dropped a broadcast from an untrusted node")
+            return
+        try:
+            self.identity.trusted.public_key(origin).verify(signature, _broadcast_signed(origin, seq, text))
+        except (InvalidSignature, ValueError):
+            logger.warning("dropped a broadcast with a bad signature from %s", node.peer_ipa)
+            return
+        if self.gossip_seen.check(gossip_id):
+            return
+
+        kbytes = cu.raw_to_ssh(origin)
+        self.on_broadcast(Peer(self.known_peers.get(kbytes, ''), kbytes), text.decode())
+        await self._forward_broadcast(MESSAGE_CODES['broadcast'] + body, node.peer_ipa)
+
+    async def join_network(self, ipa: str):
+        """
+        Connect to a network, receiving all network peers from the inviter
+
+        on_joined fires as soon as the inviter's tables are in, the remaining
+        neighbours are then dialed in parallel and each reports through on_connected.
+
+        :raises OSError: if the inviter can't be reached
+        :raises asyncio.TimeoutError: if the inviter answered neither of the bootstrap requests
+        """
+
+        # * catch connect exception here
+
+        await self.start_network()
+
+        await self._get_peer(ipa)
+        await self.bootstrap(ipa)
+
+        self.on_joined(ipa)
+
+        await self.connect_neighbours()
+
+    async def connect_neighbours(self):
+        """
+        Dial up to MAX_NEIGHBOURS unconnected neighbours and known peers at once
+
+        Peers that can't be reached within the connect timeout are dropped from neighbours.
+        """
+
+        candidates = [n.ipa for n in self.neighbours]
+        candidates += [ipa for kbytes, ipa in self.known_peers.items() if kbytes != self.public_bytes]
+
+        targets = []
+        for ipa in candidates:
+            if ipa not in self.connections and ipa not in targets:
+                targets.append(ipa)
+        targets = targets[:max(0, MAX_NEIGHBOURS - len(self.connections))]
+
+        results = await asyncio.gather(*(self._get_peer(ipa) for ipa in targets), return_exceptions=True)
+        for ipa, result in zip(targets, results):
+            if isinstance(result, BaseException):
+                logger.warning("%s: couldn't connect while bootstrapping: %r", ipa, result)
+                self.neighbours = [n for n in self.neighbours if n.ipa != ipa]
+
+    async def connect_peer(self, ipa: str) -> Node:
+        logger.debug("connecting to %s", ipa)
+
+        try:
+            stream = await self.transport.open_connection(ipa, self.port)
+        except OSError:
+            self._connect_failures.inc()
+            raise
+
+        try:
+            node = await Node.connect(stream, is_client=True, trusted_keys=self.known_peers,
+                                      sessions=self.sessions, codecs=self.codecs, identity=self.identity)
+        except Exception:
+            self._connect_failures.inc()
+            stream.close()
+            raise
+        self._observe_handshake(node)
+        peer_pubkey = node.peer_kbytes
+
+        self.known_peers[peer_pubkey] = ipa
+
+        # ? rename Peer to Neighbour if it's only used here ?
+        self._add_neighbour(Peer(ipa, peer_pubkey))
+
+        kept = self._add_connection(ipa, node)
+        if kept is not node:
+            return kept
+
+        logger.info("%s: connection established", ipa)
+        self.on_connected(node)
+        return node
+
+    def _add_connection(self, ipa: str, node: Node) -> Node:
+        """
+        Register node, unless it duplicates a connection to ipa that is kept instead
+
+        :returns: the connection kept
+        """
+
+        existing = self.connections.get(ipa)
+        if existing is not None and existing is not node:
+            if self._keeps_existing(existing, node):
+                logger.debug("%s: dropping a duplicate connection", ipa)
+                node.close()
+                return existing
+            # its listener sees the close and leaves the new connection registered
+            existing.close()
+
+        for evicted in self.pool.add(ipa, node):
+            # its listener cleans up once the stream is closed
+            evicted.close()
+        self._listened[node] = ipa
+        self.listen_tasks[ipa] = asyncio.ensure_future(self.listen_messages(ipa, node))
+        self._schedule_advertisement()
+        return node
+
+    def _keeps_existing(self, existing: Node, new: Node) -> bool:
+        # a reconnect replaces the old connection
+        if existing.direction == new.direction:
+            return False
+        # both ends dialed at once, both keep the connection dialed by the lower key, as with routed handshakes
+        lower_dialed = 0 if self.public_raw < cu.ssh_to_raw(new.peer_kbytes) else 1
+        return existing.direction == lower_dialed
+
+    async def bootstrap(self, ipa: str):
+        """
+        Fetch the neighbours and known peers of ipa at once, either is enough to go on with
+        """
+
+        # both requests share the connection, neither waits for the other's reply
+        results = await asyncio.gather(self.request_neighbours(ipa), self.request_known_peers(ipa),
+                                       return_exceptions=True)
+        errors = [result for result in results if isinstance(result, Exception)]
+        for e in errors:
+            logger.warning("%s: bootstrap request failed: %r", ipa, e)
+        if len(errors) == len(results):
+            raise errors[0]
+
+    async def request(self, node: Node, code: str, payload: bytes = b'', timeout: float = REQUEST_TIMEOUT) -> bytes:
+        """
+        Send a control request and wait for the matching reply
+
+        :returns: the reply payload, empty if the peer had nothing to send
+        :raises asyncio.TimeoutError: if the peer didn't reply in time
+        :raises OSError: if the connection dropped before the reply
+        """
+
+        request_id, reply = node.requests.new_request()
+        try:
+            await node.send_message(MESSAGE_CODES[code] + protocol.encode_request(request_id, payload),
+                                    keepalive=code == 'ping')
+        # cancelled while draining too, nothing will wait for the reply
+        except BaseException:
+            node.requests.discard(request_id)
+            raise
+        return await node.requests.wait(request_id, reply, timeout)
+
+    async def reply(self, node: Node, request_id: int, payload: bytes = b''):
+        # answering keeps nothing alive, the request already counted
+        await node.send_message(MESSAGE_CODES['reply'] + protocol.encode_request(request_id, payload),
+                                keepalive=True)
+
+    async def ping(self, node: Node, timeout: float = PING_TIMEOUT) -> float:
+        """
+        Check that the peer still answers, measuring the link on the way
+
+        :returns: the round trip time in seconds
+        :raises asyncio.TimeoutError: if it didn't reply in time
+        """
+
+        loop = asyncio.get_event_loop()
+        start = loop.time()
+        try:
+            await self.request(node, 'ping', timeout=timeout)
+        except asyncio.TimeoutError:
+            node.link.add_loss()
+            raise
+        rtt = loop.time() - start
+        node.link.add_rtt(rtt)
+        return rtt
+
+    async def heartbeat(self, node: Node):
+        """
+        Tell the peer we're alive, it expects traffic before its receive deadline
+        """
+
+        await node.send_message(MESSAGE_CODES['heartbeat'], keepalive=True)
+
+    async def probe_links(self):
+        """
+        Periodically ping every connection and pick the neighbours by the results
+        """
+
+        while True:
+            await asyncio.sleep(self.probe_interval)
+            nodes = list(self.connections.values())
+            results = await asyncio.gather(*(self.ping(node) for node in nodes), return_exceptions=True)
+            for node, result in zip(nodes, results):
+                if isinstance(result, OSError):
+                    logger.debug("%s: ping failed: %r", node.peer_ipa, result)
+            self._select_neighbours()
+
+    def _select_neighbours(self):
+        scores = {ipa: node.link.score for ipa, node in self.connections.items() if node.link.probes}
+        current = {n.ipa: n for n in self.neighbours}
+        selected = select_neighbours(list(current), scores, MAX_NEIGHBOURS)
+        if selected == list(current):
+            return
+
+        self.neighbours = [current.get(ipa) or Peer(ipa, self.connections[ipa].peer_kbytes) for ipa in selected]
+        logger.debug("neighbours by link quality are: %s", self.neighbours)
+
+    def get_link_quality(self) -> Dict[str, LinkQuality]:
+        """
+        Measured round trip time and loss of every connection by address
+        """
+
+        return {ipa: node.link.quality() for ipa, node in self.connections.items()}
+
+    async def request_neighbours(self, ipa: str):
+        logger.debug("requesting neighbours from %s", ipa)
+
+        node = await self._get_peer(ipa)
+        payload = await self.request(node, 'neighbours')
+        if payload:
+            self._get_neighbours(payload)
+
+    def _get_neighbours(self, payload: bytes):
+        for n in protocol.decode_peers(payload):
+            self._add_neighbour(Peer(*n))
+
+        logger.debug("neighbours are: %s", self.neighbours)
+
+    def _add_neighbour(self, n: Peer):
+        assert len(self.neighbours) <= MAX_NEIGHBOURS
+        # sockets will close after timeout so i mustn't include reconnections
+        if n not in self.neighbours:
+            # rotating neighbours, the one with the worst link goes
+            if len(self.neighbours) == MAX_NEIGHBOURS:
+                worst = max(self.neighbours, key=self._link_score)
+                self.neighbours.remove(worst)
+                logger.debug("rotating, removed neighbour %s", worst.ipa)
+            self.neighbours.append(n)
+
+            logger.debug("%s new neighbour", n.ipa)
+
+    def _link_score(self, n: Peer) -> float:
+        node = self.connections.get(n.ipa)
+        # an unconnected neighbour is as bad as an unreachable one
+        return node.link.score if node is not None else math.inf
+
+    async def request_known_peers(self, ipa: str):
+        """
+        Pull the known peers entries that differ from ours
+
+        The request carries our table's bucket digests, the peer answers with
+        the entries of the buckets that don't match.
+        """
+
+        logger.debug("requesting known peers from %s", ipa)
+
+        node = await self._get_peer(ipa)
+        digests = self.known_peers.digests(exclude=(node.peer_kbytes,))
+        payload = await self.request(node, 'knownpeers', protocol.encode_digests(digests))
+        if payload and self._get_known_peers(payload):
+            self.on_received_peers(node.peer_ipa)
+
+    def _get_known_peers(self, payload: bytes) -> List[bytes]:
+        records = [r for r in protocol.decode_peer_records(payload) if r.kbytes != self.public_bytes]
+        changed = self.known_peers.merge(records)
+        logger.debug("received %s peers, %s changed", len(records), len(changed))
+        return changed
+
+    async def anti_entropy(self):
+        """
+        Periodically sync known peers with a random connection
+        """
+
+        while True:
+            await asyncio.sleep(self.anti_entropy_interval)
+            if not self.connections:
+                continue
+
+            ipa = random.choice(list(self.connections))
+            try:
+                await self.request_known_peers(ipa)
+            except (OSError, asyncio.TimeoutError, ValueError) as e:
+                logger.warning("%s: known peers sync failed: %r", ipa, e)
+
+    def set_message_dispatcher(self, ipa: str, _dispatcher):
+        self.connections[ipa].dispatcher = _dispatcher
+
+    async def listen_messages(self, ipa: str, node: Node):
+        """
+        Read and dispatch messages from ipa until its connection drops
+        """
+
+        # a peer gone silent past the receive deadline has its connection closed by the pool, ending this loop
+        try:
+            while True:
+                try:
+                    msg = await node.receive_message()
+                # socket is dead
+                except OSError:
+                    break
+
+                code, body = msg[:CODE_SIZE], msg[CODE_SIZE:]
+                if code not in KEEPALIVE_CODES:
+                    node.last_active = node.clock()
+                start = time.perf_counter()
+                # a failing handler costs the message, not the connection
+                try:
+                    await self._handle_message(node, code, body)
+                except ValueError as e:
+                    logger.error("%s sent a malformed message: %r", ipa, e)
+                except OSError as e:
+                    logger.warning("%s: couldn't handle a message: %r", ipa, e)
+                except Exception:
+                    logger.exception("%s: failed handling a message", ipa)
+                self._handling_seconds.labels(_CODE_NAMES.get(code, 'unknown')).observe(time.perf_counter() - start)
+        finally:
+            node.close()
+            # its traffic moves to the address' totals in one step, so the counters don't dip
+            self._closed_stats.setdefault(ipa, ConnectionStats()).add(node.stats)
+            self._listened.pop(node, None)
+            node.requests.cancel_all(ConnectionResetError(f"{ipa} disconnected"))
+            self._close_transfers(node.peer_kbytes)
+            logger.debug("stopped listening for messages from %s", ipa)
+            # the pool may have dropped the connection already, unless a new one replaced it
+            if self.connections.get(ipa, node) is node:
+                self.pool.remove(ipa, node)
+                if self.listen_tasks.get(ipa) is asyncio.current_task():
+                    del self.listen_tasks[ipa]
+                if self.routes.remove_hop(ipa):
+                    self._schedule_advertisement()
+            self.on_peer_disconnected(node)
+
+    async def _handle_message(self, node: Node, code: bytes, body: bytes):
+        if code == MESSAGE_CODES['message']:
+            logger.debug("dispatching regular message...")
+            node.dispatcher(body.decode())
+
+        elif code == MESSAGE_CODES['reply']:
+            request_id, payload = protocol.decode_request(body)
+            # a reply nobody waits for anymore, it took longer than the timeout
+            if not node.requests.resolve(request_id, payload):
+                logger.debug("dropped reply to request %s", request_id)
+
+        elif code == MESSAGE_CODES['neighbours']:
+            request_id, _ = protocol.decode_request(body)
+            await self._send_neighbours(node, request_id)
+
+        elif code == MESSAGE_CODES['knownpeers']:
+            request_id, digests = protocol.decode_request(body)
+            await self._send_known_peers(node, request_id, digests)
+
+        elif code == MESSAGE_CODES['newpeer']:
+            await self._add_newpeer(node, body)
+
+        elif code == MESSAGE_CODES['ping']:
+            request_id, _ = protocol.decode_request(body)
+            await self.reply(node, request_id)
+
+        elif code == MESSAGE_CODES['heartbeat']:
+            pass
+
+        elif code == MESSAGE_CODES['routes']:
+            if self.routes.update(node.peer_ipa, protocol.decode_routes(body)):
+                self._schedule_advertisement()
+
+        elif code == MESSAGE_CODES['routed']:
+            await self._handle_routed(body)
+
+        elif code == MESSAGE_CODES['broadcast']:
+            await self._handle_broadcast(node, body)
+
+        elif code == MESSAGE_CODES['file']:
+            request_id, offer = protocol.decode_request(body)
+            await self._answer_file_offer(node, request_id, offer)
+
+        elif code == MESSAGE_CODES['chunk']:
+            await self._receive_chunk(node, body)
+
+        elif code == MESSAGE_CODES['chunkack']:
+            transfer_id, offset, reason = protocol.decode_chunk(body)
+            transfer = self.transfers_out.get((node.peer_kbytes, transfer_id))
+            if transfer is not None and reason:
+                transfer.fail(ConnectionAbortedError(f"{node.peer_ipa} gave up on {transfer.name}: "
+                                                     f"{reason.decode(errors='replace')}"))
+            elif transfer is not None:
+                transfer.ack(offset)
+
+        elif code != MESSAGE_CODES['none']:
+            raise ValueError(f"unknown message code {code.hex()}")
+
+    async def _send_neighbours(self, node: Node, request_id: int):
+        neighbours = self.neighbours.copy()
+
+        peer = Peer(node.peer_ipa, node.peer_kbytes)
+        if peer in neighbours:
+            neighbours.remove(peer)
+        if not neighbours:
+            await self.reply(node, request_id)
+            return
+
+        await self.reply(node, request_id, protocol.encode_peers(neighbours))
+
+        logger.debug("%s neighbours sent", len(neighbours))
+
+    async def _add_newpeer(self, node: Node, body: bytes):
+        gossip_id, payload = protocol.decode_gossip(body)
+        if self.gossip_seen.check(gossip_id):
+            logger.debug("dropped a duplicate announcement from %s", node.peer_ipa)
+            return
+
+        records = protocol.decode_peer_records(payload)
+        if len(records) != 1:
+            raise ValueError(f"expected a single peer, got {len(records)}")
+        pubkey, ipa, _ = records[0]
+        if pubkey == self.public_bytes:
+            return
+
+        is_new = pubkey not in self.known_peers
+        # ipa may change, resetting it. concurrent announcements of the same peer from different origins stop here
+        if not self.known_peers.merge(records):
+            return
+
+        if is_new:
+            logger.debug("added new peer %s...", ipa)
+            self.on_peer_joined(Peer(ipa, pubkey))
+
+        # if i'm not familiar i'm gonna tell my neighbours about this new peer
+        await self.alert_newpeer(node.peer_ipa, pubkey, ipa, gossip_id)
+
+    async def _send_known_peers(self, node: Node, request_id: int, digests_payload: bytes):
+        digests = protocol.decode_digests(digests_payload) if digests_payload else []
+        # the requester doesn't keep an entry of itself and we don't keep one of us
+        records = self.known_peers.diff(digests, exclude=(node.peer_kbytes,))
+
+        if not records:
+            await self.reply(node, request_id)
+            logger.debug("sent none")
+            return
+
+        await self.reply(node, request_id, protocol.encode_peer_records(records))
+        logger.debug("sent %s peers", len(records))
+
+    async def _get_peer(self, ipa: str) -> Node:
+        return await self.pool.get(ipa)
+
+    async def send_message(self, ipa: str, msg: str):
+        """
+        Send a text message to ipa
+
+        Without a connection the message is relayed if a route to the peer is
+        known. Otherwise it's queued and sent once a connection is established
+        in the background, so a cold peer doesn't hold up the caller.
+
+        :raises OSError: if the connection dropped, or too many messages already wait for it to be established
+        :raises ValueError: if the encoded text is longer than MAX_MESSAGE_SIZE
+        """
+
+        record = MESSAGE_CODES['message'] + _check_size(msg.encode())
+        node = self.connections.get(ipa)
+        if node is not None:
+            await node.send_message(record)
+            return
+
+        kbytes = self.known_peers.key_at(ipa)
+        if kbytes is not None and cu.ssh_to_raw(kbytes) in self.routes:
+            await self.send_routed(cu.ssh_to_raw(kbytes), msg.encode())
+            return
+        self.pool.enqueue(ipa, record)
+
+    async def send_file(self, ipa: str, path: str):
+        """
+        Send the file at path to ipa, continuing from what an earlier attempt left with the peer
+
+        Returns once the peer acknowledged the whole file. Only a chunk at a
+        time is read from disk and at most a window of chunks awaits
+        acknowledgement, so a file of any size takes constant memory.
+
+        :raises ConnectionRefusedError: if the peer declined the file
+        :raises ConnectionError: if the peer answered the offer with a malformed offset
+        :raises ConnectionAbortedError: if the peer couldn't store the file
+        :raises asyncio.TimeoutError: if the peer stopped acknowledging chunks
+        """
+
+        node = await self._get_peer(ipa)
+        transfer = OutgoingTransfer(path)
+        key = (node.peer_kbytes, transfer.id)
+        self.transfers_out[key] = transfer
+        loop = asyncio.get_event_loop()
+        try:
+            reply = await self.request(node, 'file', protocol.encode_offer(transfer.id, transfer.size, transfer.name))
+            if not reply:
+                raise ConnectionRefusedError(f"{ipa} declined {transfer.name}")
+            if len(reply) != _OFFSET.size:
+                raise ConnectionError(f"{ipa} answered the offer of {transfer.name} with a malformed offset")
+            offset, = _OFFSET.unpack(reply)
+            if offset > transfer.size:
+                raise ConnectionError(f"{ipa} has more of {transfer.name} than there is")
+            transfer.ack(offset)
+            logger.debug("sending %s to %s from byte %s of %s", transfer.name, ipa, offset, transfer.size)
+
+            while offset < transfer.size:
+                # the window is full until the oldest chunk in flight is acknowledged
+                await transfer.wait_acked(offset - (WINDOW - 1) * CHUNK_SIZE)
+                data = await loop.run_in_executor(None, transfer.read_chunk, offset)
+                await node.send_message(MESSAGE_CODES['chunk'] + protocol.encode_chunk(transfer.id, offset, data))
+                offset += len(data)
+            await transfer.wait_acked(transfer.size)
+        finally:
+            del self.transfers_out[key]
+            transfer.close()
+
+    async def _answer_file_offer(self, node: Node, request_id: int, offer: bytes):
+        transfer_id, size, name = protocol.decode_offer(offer)
+        peer = Peer(node.peer_ipa, node.peer_kbytes)
+        # only the file name, never a path chosen by the sender
+        path = self.on_file_offer(peer, os.path.basename(name), size)
+        if path is None:
+            await self.reply(node, request_id)
+            return
+
+        key = (node.peer_kbytes, transfer_id)
+        if key in self.transfers_in:
+            self.transfers_in.pop(key).close()
+        try:
+            transfer = IncomingTransfer(transfer_id, size, path)
+        except OSError as e:
+            logger.error("couldn't store %s from %s: %r", name, node.peer_ipa, e)
+            await self.reply(node, request_id)
+            return
+
+        if transfer.complete:
+            transfer.finish()
+            self.on_file_received(peer, path)
+        else:
+            self.transfers_in[key] = transfer
+        await self.reply(node, request_id, _OFFSET.pack(transfer.offset))
+
+    async def _receive_chunk(self, node: Node, body: bytes):
+        transfer_id, offset, data = protocol.decode_chunk(body)
+        key = (node.peer_kbytes, transfer_id)
+        transfer = self.transfers_in.get(key)
+        if transfer is None:
+            logger.debug("dropped a chunk of an unknown transfer from %s", node.peer_ipa)
+            return
+
+        try:
+            # the connection's messages wait for the disk, which in turn holds back the sender
+            done = await asyncio.get_event_loop().run_in_executor(None, transfer.write, offset, data)
+        except (OSError, ValueError) as e:
+            # only this transfer fails, the sender hears why and the connection carries on
+            logger.error("%s: couldn't store %s: %r", node.peer_ipa, transfer.path, e)
+            del self.transfers_in[key]
+            transfer.close()
+            reason = type(e).__name__.encode()
+            await node.send_message(MESSAGE_CODES['chunkack'] +
+                                    protocol.encode_chunk(transfer_id, transfer.offset, reason))
+            return
+        await node.send_message(MESSAGE_CODES['chunkack'] + protocol.encode_chunk(transfer_id, transfer.offset))
+        if done:
+            del self.transfers_in[key]
+            self.on_file_received(Peer(node.peer_ipa, node.peer_kbytes), transfer.path)
+
+    def _close_transfers(self, peer_kbytes: bytes):
+        for key in [key for key in self.transfers_in if key[0] == peer_kbytes]:
+            self.transfers_in.pop(key).close()
+
+    def _schedule_advertisement(self):
+        # a join changes routes with every connection and vector, they all go out in one advertisement
+        if self._advertise_task is None or self._advertise_task.done():
+            self._advertise_task = asyncio.ensure_future(self._advertise_routes())
+
+    async def _advertise_routes(self):
+        await asyncio.sleep(ADVERTISE_DELAY)
+        # later changes schedule a new advertisement
+        self._advertise_task = None
+
+        targets, advertised = [], {}
+        for ipa, node in self.connections.items():
+            record = MESSAGE_CODES['routes'] + protocol.encode_routes(self.routes.advertisement(ipa))
+            # peers whose vector from us didn't change aren't sent it again
+            if self._advertised.get(ipa) != (node, record):
+                targets.append((ipa, node, record))
+            advertised[ipa] = (node, record)
+        self._advertised = advertised
+
+        results = await asyncio.gather(*(node.send_message(record) for _, node, record in targets),
+                                       return_exceptions=True)
+        for (ipa, _, _), result in zip(targets, results):
+            if isinstance(result, Exception):
+                # sent again with the next advertisement
+                self._advertised.pop(ipa, None)
+                logger.warning("%s: couldn't advertise routes: %r", ipa, result)
+
+    async def send_routed(self, dest: bytes, payload: bytes):
+        """
+        Relay payload end-to-end encrypted to the node with raw key dest
+
+        :raises OSError: if there is no route to dest
+        :raises asyncio.TimeoutError: if dest didn't answer the end-to-end handshake
+        """
+
+        session = self.routed_sessions.get(dest)
+        if session is None:
+            session = await self._routed_handshake(dest)
+        await self._relay(dest, self.public_raw, ROUTED_TTL, ROUTED_DATA, session.seal(payload))
+
+    async def _routed_handshake(self, dest: bytes) -> EndToEnd:
+        pending = self._routed_handshakes.get(dest)
+        if pending is None:
+            dh_priv = x25519.X25519PrivateKey.generate()
+            hello = make_hello(0, dh_priv, identity=self.identity)
+            pending = self._routed_handshakes[dest] = (dh_priv, hello, asyncio.get_event_loop().create_future())
+            try:
+                await self._relay(dest, self.public_raw, ROUTED_TTL, ROUTED_HELLO, hello)
+            except OSError:
+                del self._routed_handshakes[dest]
+                raise
+
+        future = pending[2]
+        try:
+            # concurrent senders share the handshake, one timing out doesn't fail the others
+            return await asyncio.wait_for(asyncio.shield(future), REQUEST_TIMEOUT)
+        except asyncio.TimeoutError:
+            if self._routed_handshakes.get(dest) is pending:
+                del self._routed_handshakes[dest]
+            raise
+
+    async def _relay(self, dest: bytes, src: bytes, ttl: int, kind: int, body: bytes):
+        route = self.routes.route(dest)
+        node = self.connections.get(route.next_hop) if route is not None else None
+        if node is None:
+            raise ConnectionError(f"no route to {cu.raw_to_ssh(dest)}")
+        await node.send_message(MESSAGE_CODES['routed'] + protocol.encode_routed(dest, src, ttl, kind, body))
+
+    def _is_trusted_raw(self, raw: bytes) -> bool:
+        return raw in self.identity.trusted or cu.raw_to_ssh(raw) in self.known_peers
+
+    async def _handle_routed(self, body: bytes):
+        dest, src, ttl, kind, payload = protocol.decode_routed(body)
+        if dest != self.public_raw:
+            if ttl <= 1:
+                logger.debug("dropped a relayed message out of hops")
+                return
+            try:
+                await self._relay(dest, src, ttl - 1, kind, payload)
+            except OSError as e:
+                logger.debug("couldn't relay a message: %r", e)
+            return
+
+        try:
+            if kind == ROUTED_HELLO:
+                await self._answer_routed_hello(src, payload)
+            elif kind == ROUTED_HELLO_REPLY:
+                self._complete_routed_hello(src, payload)
+            elif kind == ROUTED_DATA:
+                await self._receive_routed(src, payload)
+            elif kind == ROUTED_UNKNOWN:
+                self._drop_routed_session(src, payload)
+            else:
+                raise ValueError(f"unknown relayed message kind {kind}")
+        except RuntimeError as e:
+            logger.warning("end-to-end handshake failed: %r", e)
+        except OSError as e:
+            logger.warning("couldn't answer a relayed message: %r", e)
+
+    def _routed_key(self, shared: bytes, hello: bytes, reply: bytes) -> bytes:
+        return derive_key(shared, b'meshchat routed' + hashlib.sha256(hello + reply).digest())
+
+    async def _answer_routed_hello(self, src: bytes, hello: bytes):
+        _, identity, share, _ = open_hello(hello, 0, self._is_trusted_raw, self.identity.trusted)
+        if identity != src:
+            raise RuntimeError("relayed hello signed by another key than its source")
+
+        pending = self._routed_handshakes.get(src)
+        # both ends started at once, the one with the higher key waits for its own hello to be answered
+        if pending is not None and self.public_raw > src:
+            return
+
+        dh_priv = x25519.X25519PrivateKey.generate()
+        reply = make_hello(1, dh_priv, identity=self.identity)
+        session = EndToEnd(self._routed_key(key_exchange(dh_priv, share), hello, reply), is_initiator=False,
+                           clock=self._loop_clock)
+        self._store_routed_session(src, session)
+        if pending is not None:
+            del self._routed_handshakes[src]
+            pending[2].set_result(session)
+
+        await self._relay(src, self.public_raw, ROUTED_TTL, ROUTED_HELLO_REPLY, reply)
+
+    def _store_routed_session(self, dest: bytes, session: EndToEnd):
+        # sessions with peers we stopped talking to go whenever a new one is set up
+        expired = session.last_used - ROUTED_SESSION_IDLE
+        for stale in [key for key, other in self.routed_sessions.items() if other.last_used < expired]:
+            del self.routed_sessions[stale]
+        self.routed_sessions[dest] = session
+
+    def _drop_routed_session(self, src: bytes, reference: bytes):
+        session = self.routed_sessions.get(src)
+        # an unauthenticated claim, only believed about a message we really sent
+        if session is None or not session.sealed(reference):
+            logger.debug("ignored a stale session notice not matching anything sent")
+            return
+        logger.debug("relayed session went stale, a new one is set up with the next message")
+        del self.routed_sessions[src]
+
+    def _complete_routed_hello(self, src: bytes, reply: bytes):
+        pending = self._routed_handshakes.get(src)
+        if pending is None:
+            logger.debug("dropped a late end-to-end hello reply")
+            return
+        dh_priv, hello, future = pending
+
+        _, identity, share, _ = open_hello(reply, 1, self._is_trusted_raw, self.identity.trusted)
+        if identity != src:
+            raise RuntimeError("relayed hello reply signed by another key than its source")
+
+        del self._routed_handshakes[src]
+        session = EndToEnd(self._routed_key(key_exchange(dh_priv, share), hello, reply), is_initiator=True,
+                           clock=self._loop_clock)
+        self._store_routed_session(src, session)
+        future.set_result(session)
+
+    async def _receive_routed(self, src: bytes, payload: bytes):
+        session = self.routed_sessions.get(src)
+        try:
+            if session is None:
+                raise InvalidTag()
+            text = session.open(payload).decode()
+        except InvalidTag:
+            logger.debug("couldn't open a relayed message, telling the sender to start over")
+            await self._relay(src, self.public_raw, ROUTED_TTL, ROUTED_UNKNOWN, EndToEnd.reference(payload))
+            return
+
+        kbytes = cu.raw_to_ssh(src)
+        self.on_routed_message(Peer(self.known_peers.get(kbytes, ''), kbytes), text)
+
+    async def close_connections(self):
+        tasks = list(self.listen_tasks.values())
+        for node in self.connections.values():
+            node.close()
+        # listeners see the closed stream and fire on_peer_disconnected
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+        self.pool.close()
+        self.connections.clear()
+        self.listen_tasks.clear()
+
+    async def stop_serving(self):
+        if self.server is None:
+            self.transport.close()
+            return
+        self.server.close()
+        await self.server.wait_closed()
+
+    async def stop(self):
+        tasks = [task for task in (self.anti_entropy_task, self.pool_task, self.probe_task, self.stats_task)
+                 if task is not None]
+        for task in tasks:
+            task.cancel()
+        await self.close_connections()
+        # connections closing withdraw routes, the advertisement that schedules goes too
+        if self._advertise_task is not None:
+            tasks.append(self._advertise_task)
+            self._advertise_task.cancel()
+        # nothing may be left pending once the loop closes
+        await asyncio.gather(*tasks, return_exceptions=True)
+        await self.stop_serving()
+
+    def get_known_peers(self) -> Set[Peer]:
+        return {Peer(ipa=item[1], kbytes=item[0]) for item in self.known_peers.items()}
+
+    def get_connections(self) -> Set[Node]:
+        return set(self.connections.values())
+
+
+# every message starts with one of these, requests and replies follow it with a request id
+CODE_SIZE = 2
+MESSAGE_CODES = {
+    # ignored by the receiver
+    'none': (0).to_bytes(CODE_SIZE, byteorder='big'),
+    # request for the peer's neighbours
+    'neighbours': (1).to_bytes(CODE_SIZE, byteorder='big'),
+    # inform the peer of a new peer in the network
+    'newpeer': (2).to_bytes(CODE_SIZE, byteorder='big'),
+    # send me your known_peers entries that differ from my digests
+    'knownpeers': (4).to_bytes(CODE_SIZE, byteorder='big'),
+    # answer to a request, an empty payload means there is nothing to send
+    'reply': (8).to_bytes(CODE_SIZE, byteorder='big'),
+    # text for the dispatcher
+    'message': (16).to_bytes(CODE_SIZE, byteorder='big'),
+    # keepalive request, answered with an empty reply
+    'ping': (32).to_bytes(CODE_SIZE, byteorder='big'),
+    # distance vector of the nodes the sender can reach
+    'routes': (64).to_bytes(CODE_SIZE, byteorder='big'),
+    # message relayed towards another node
+    'routed': (128).to_bytes(CODE_SIZE, byteorder='big'),
+    # signed text for every node, flooded over all connections
+    'broadcast': (256).to_bytes(CODE_SIZE, byteorder='big'),
+    # request to accept a file, answered with the offset to start from or an empty reply declining it
+    'file': (512).to_bytes(CODE_SIZE, byteorder='big'),
+    # part of a file being transferred
+    'chunk': (1024).to_bytes(CODE_SIZE, byteorder='big'),
+    # acknowledges the file data received so far
+    'chunkack': (2048).to_bytes(CODE_SIZE, byteorder='big'),
+    # sent on connections quiet for the heartbeat interval, unanswered
+    'heartbeat': (4096).to_bytes(CODE_SIZE, byteorder='big'),
+}
+
+
+_CODE_NAMES = {code: name for name, code in MESSAGE_CODES.items()}
+
+# received messages that don't keep a connection from idling out
+KEEPALIVE_CODES = (MESSAGE_CODES['ping'], MESSAGE_CODES['reply'], MESSAGE_CODES['heartbeat'])
+
+SIGNATURE_SIZE = 64
+_OFFSET = struct.Struct('>Q')
+
+
+def _check_size(text: bytes) -> bytes:
+    if len(text) > MAX_MESSAGE_SIZE:
+        raise ValueError(f"{len(text)} byte message exceeds the limit of {MAX_MESSAGE_SIZE}, send it as a file")
+    return text
+
+
+def _broadcast_signed(origin: bytes, seq: int, text: bytes) -> bytes:
+    # the gossip id is signed too, a relay can't replay the text under a fresh id
+    return b'meshchat broadcast' + protocol.encode_gossip(origin, seq, text)
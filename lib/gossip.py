@@ -0,0 +1,66 @@
+"""
+Duplicate suppression for messages flooded through the mesh
+"""
+
+from typing import (Callable, Hashable)
+from collections import OrderedDict
+import time
+
+
+SEEN_CAPACITY = 4096
+SEEN_TTL = 300.0
+
+
+class SeenCache:
+    """
+    Bounded set of recently seen message ids, entries expire after ttl seconds
+    """
+
+    def __init__(self, capacity: int = SEEN_CAPACITY, ttl: float = SEEN_TTL,
+                 clock: Callable[[], float] = time.monotonic):
+        self.capacity = capacity
+        self.ttl = ttl
+        self.clock = clock
+        # insertion ordered, so the oldest entries are always at the front
+        self._expiries: 'OrderedDict[Hashable, float]' = OrderedDict()
+        self.duplicates = 0
+
+    def __len__(self) -> int:
+        return len(self._expiries)
+
+    def __contains__(self, msg_id: Hashable) -> bool:
+        expiry = self._expiries.get(msg_id)
+        return expiry is not None and expiry > self.clock()
+
+    def _expire(self, now: float):
+        while self._expiries:
+            msg_id, expiry = next(iter(self._expiries.items()))
+            if expiry > now and len(self._expiries) < self.capacity:
+                break
+            del self._expiries[msg_id]
+
+    def peek(self, msg_id: Hashable) -> bool:
+        """
+        Like check without recording msg_id, for messages to be verified before they count as seen
+        """
+
+        if msg_id in self:
+            self.duplicates += 1
+            return True
+        return False
+
+    def check(self, msg_id: Hashable) -> bool:
+        """
+        Record msg_id as seen
+
+        :returns: True if it was already seen and the message should be dropped
+        """
+
+        if self.peek(msg_id):
+            return True
+
+        now = self.clock()
+        self._expire(now)
+        self._expiries.pop(msg_id, None)
+        self._expiries[msg_id] = now + self.ttl
+        return False
@@ -0,0 +1,274 @@
+"""
+Persistent per-peer message history
+
+Every peer gets a directory of append-only segments. A segment is a log of
+records::
+
+    timestamp(8) | outgoing(1) | length(4) | utf-8 text
+
+and an index of 8 byte record offsets, so message ``i`` of a segment is found
+without scanning it. Both are read through ``mmap`` and a front-end pages
+scrollback without loading a whole conversation.
+
+Appends only queue the message; a writer thread stores queued messages in
+batches every ``flush_interval`` seconds, or sooner once ``BATCH_SIZE`` are
+waiting, and fsyncs each batch unless told not to. Queued messages are
+readable right away.
+"""
+
+from typing import (Dict, List, NamedTuple, Optional, Tuple, Union)
+from bisect import bisect_right
+from hashlib import blake2b
+import mmap
+import os
+import struct
+import threading
+import time
+
+import logging
+
+
+logger = logging.getLogger(__name__)
+
+
+SEGMENT_SIZE = 1024 * 1024
+FLUSH_INTERVAL = 1.0
+BATCH_SIZE = 256
+PAGE_SIZE = 50
+
+_RECORD = struct.Struct('>dBI')
+_OFFSET = struct.Struct('>Q')
+
+
+class Message(NamedTuple):
+    timestamp: float
+    outgoing: bool
+    text: str
+
+
+def _encode(message: Message) -> bytes:
+    text = message.text.encode()
+    return _RECORD.pack(message.timestamp, message.outgoing, len(text)) + text
+
+
+class _Segment:
+    """
+    A log file and its offset index, mapped lazily and remapped as they grow
+    """
+
+    def __init__(self, base: str):
+        self.log_path = base + '.log'
+        self.idx_path = base + '.idx'
+        self.count = 0
+        if os.path.exists(self.idx_path):
+            self.count = os.path.getsize(self.idx_path) // _OFFSET.size
+            # an offset cut short by a crash would misalign every later one
+            os.truncate(self.idx_path, self.count * _OFFSET.size)
+        self.size = os.path.getsize(self.log_path) if os.path.exists(self.log_path) else 0
+        self._maps: Optional[Tuple[mmap.mmap, mmap.mmap]] = None
+        self._mapped = 0
+
+    def _map(self) -> Tuple[mmap.mmap, mmap.mmap]:
+        if self._maps is None or self._mapped < self.count:
+            self.unmap()
+            with open(self.log_path, 'rb') as log, open(self.idx_path, 'rb') as idx:
+                self._maps = (mmap.mmap(log.fileno(), 0, access=mmap.ACCESS_READ),
+                              mmap.mmap(idx.fileno(), 0, access=mmap.ACCESS_READ))
+            self._mapped = self.count
+        return self._maps
+
+    def read(self, start: int, stop: int) -> List[Message]:
+        log, idx = self._map()
+        messages = []
+        for i in range(start, stop):
+            offset, = _OFFSET.unpack_from(idx, i * _OFFSET.size)
+            timestamp, outgoing, length = _RECORD.unpack_from(log, offset)
+            text_start = offset + _RECORD.size
+            messages.append(Message(timestamp, bool(outgoing), log[text_start:text_start + length].decode()))
+        return messages
+
+    def unmap(self):
+        if self._maps is not None:
+            for m in self._maps:
+                m.close()
+            self._maps = None
+
+
+class PeerLog:
+    """
+    Segments of one conversation plus the messages still waiting to be written
+    """
+
+    def __init__(self, directory: str, segment_size: int = SEGMENT_SIZE):
+        self.directory = directory
+        self.segment_size = segment_size
+        os.makedirs(directory, exist_ok=True)
+
+        numbers = sorted(int(name[:-4]) for name in os.listdir(directory) if name.endswith('.log'))
+        self.segments = [_Segment(self._base(n)) for n in numbers]
+        self.pending: List[Message] = []
+        self.lock = threading.Lock()
+
+    def _base(self, number: int) -> str:
+        return os.path.join(self.directory, f"{number:08d}")
+
+    def __len__(self) -> int:
+        with self.lock:
+            return sum(s.count for s in self.segments) + len(self.pending)
+
+    def read(self, start: int, stop: int) -> List[Message]:
+        with self.lock:
+            # first message index of every segment
+            firsts, total = [], 0
+            for segment in self.segments:
+                firsts.append(total)
+                total += segment.count
+
+            messages = []
+            i = max(start, 0)
+            while i < min(stop, total):
+                n = bisect_right(firsts, i) - 1
+                segment = self.segments[n]
+                end = min(stop, firsts[n] + segment.count)
+                messages += segment.read(i - firsts[n], end - firsts[n])
+                i = end
+            pending = self.pending[max(start - total, 0):max(stop - total, 0)]
+            return messages + pending
+
+    def write(self, fsync: bool):
+        """
+        Append the pending messages to the last segment, starting new ones as it fills up
+        """
+
+        with self.lock:
+            batch = self.pending.copy()
+        if not batch:
+            return
+
+        # (segment, its new size, records, offsets) for each segment the batch lands in
+        chunks = []
+        for message in batch:
+            if not chunks:
+                if not self.segments or self.segments[-1].size >= self.segment_size:
+                    self.segments.append(_Segment(self._base(len(self.segments))))
+                chunks.append([self.segments[-1], self.segments[-1].size, [], []])
+            elif chunks[-1][1] >= self.segment_size:
+                self.segments.append(_Segment(self._base(len(self.segments))))
+                chunks.append([self.segments[-1], 0, [], []])
+
+            chunk = chunks[-1]
+            record = _encode(message)
+            chunk[2].append(record)
+            chunk[3].append(_OFFSET.pack(chunk[1]))
+            chunk[1] += len(record)
+
+        for segment, size, records, offsets in chunks:
+            with open(segment.log_path, 'ab') as log, open(segment.idx_path, 'ab') as idx:
+                log.write(b''.join(records))
+                # the index only points at records already written
+                log.flush()
+                idx.write(b''.join(offsets))
+                idx.flush()
+                if fsync:
+                    os.fsync(log.fileno())
+                    os.fsync(idx.fileno())
+
+            with self.lock:
+                segment.size = size
+                segment.count += len(records)
+                del self.pending[:len(records)]
+
+    def close(self):
+        for segment in self.segments:
+            segment.unmap()
+
+
+class MessageHistory:
+    """
+    Message logs of every peer under one directory, written by a background thread
+    """
+
+    def __init__(self, directory: str = '.history', segment_size: int = SEGMENT_SIZE,
+                 flush_interval: float = FLUSH_INTERVAL, fsync: bool = True):
+        self.directory = directory
+        self.segment_size = segment_size
+        self.flush_interval = flush_interval
+        self.fsync = fsync
+
+        self.logs: Dict[str, PeerLog] = {}
+        self._lock = threading.Lock()
+        self._flushing = threading.Lock()
+        self._wake = threading.Event()
+        self._closed = False
+        self._writer = threading.Thread(target=self._run, name='history writer', daemon=True)
+        self._writer.start()
+
+    def _log(self, peer: Union[str, bytes]) -> PeerLog:
+        if isinstance(peer, str):
+            peer = peer.encode()
+        # any peer id, an address or a public key, becomes a safe directory name
+        name = blake2b(peer, digest_size=16).hexdigest()
+        with self._lock:
+            log = self.logs.get(name)
+            if log is None:
+                log = self.logs[name] = PeerLog(os.path.join(self.directory, name), self.segment_size)
+            return log
+
+    def append(self, peer: Union[str, bytes], text: str, outgoing: bool = False, timestamp: float = None):
+        """
+        Queue a message for writing, it's readable immediately
+        """
+
+        log = self._log(peer)
+        with log.lock:
+            log.pending.append(Message(time.time() if timestamp is None else timestamp, outgoing, text))
+            if len(log.pending) >= BATCH_SIZE:
+                self._wake.set()
+
+    def count(self, peer: Union[str, bytes]) -> int:
+        return len(self._log(peer))
+
+    def read(self, peer: Union[str, bytes], start: int, stop: int) -> List[Message]:
+        return self._log(peer).read(start, stop)
+
+    def page(self, peer: Union[str, bytes], before: int = None, size: int = PAGE_SIZE) -> Tuple[int, List[Message]]:
+        """
+        Read up to size messages preceding index before, the latest ones if it's None
+
+        :returns: the index of the first message read and the messages, oldest first
+        """
+
+        log = self._log(peer)
+        if before is None:
+            before = len(log)
+        start = max(before - size, 0)
+        return start, log.read(start, before)
+
+    def flush(self):
+        with self._lock:
+            logs = list(self.logs.values())
+        with self._flushing:
+            for log in logs:
+                try:
+                    log.write(self.fsync)
+                except OSError as e:
+                    logger.error("couldn't write message history to %s: %r", log.directory, e)
+
+    def _run(self):
+        while not self._closed:
+            self._wake.wait(self.flush_interval)
+            self._wake.clear()
+            self.flush()
+
+    def close(self):
+        """
+        Write out everything queued and stop the writer
+        """
+
+        self._closed = True
+        self._wake.set()
+        self._writer.join()
+        self.flush()
+        with self._lock:
+            for log in self.logs.values():
+                log.close()
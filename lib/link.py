@@ -0,0 +1,113 @@
+"""
+Link quality of connections and neighbour selection by it
+
+Every connection is pinged periodically. Round trip times are smoothed as in
+TCP's retransmission timer (RFC 6298) and the share of recent pings that went
+unanswered is the loss. A link's score is its smoothed RTT inflated by its
+loss, lower is better.
+
+Neighbours are the best scoring peers plus a few random ones that keep the
+mesh from clustering around fast links. A neighbour is only replaced by a peer
+scoring better by more than the hysteresis, so neighbours don't churn with
+every jittery measurement.
+"""
+
+from typing import (Deque, Dict, List, NamedTuple, Optional, Sequence)
+from collections import deque
+import math
+import random
+
+
+# gains of the smoothed RTT and its variation
+RTT_ALPHA = 1 / 8
+RTT_BETA = 1 / 4
+# pings the loss is measured over
+LOSS_WINDOW = 20
+# a link losing every ping scores this many times its RTT on top
+LOSS_PENALTY = 4.0
+# neighbour slots given to random peers rather than the fastest ones
+RANDOM_NEIGHBOURS = 1
+# how much better, relatively, a peer must score to displace a neighbour
+HYSTERESIS = 0.2
+
+
+class LinkQuality(NamedTuple):
+    # smoothed round trip time and its variation in seconds, None before the first answered ping
+    rtt: Optional[float]
+    rttvar: float
+    # fraction of the last pings that went unanswered
+    loss: float
+    probes: int
+
+
+class LinkStats:
+    """
+    Round trip times and losses of the pings over one connection
+    """
+
+    def __init__(self, window: int = LOSS_WINDOW):
+        self.srtt: Optional[float] = None
+        self.rttvar = 0.0
+        self.probes = 0
+        # True for every answered ping, False for a lost one
+        self._answered: Deque[bool] = deque(maxlen=window)
+
+    def add_rtt(self, rtt: float):
+        if self.srtt is None:
+            self.srtt, self.rttvar = rtt, rtt / 2
+        else:
+            self.rttvar += RTT_BETA * (abs(self.srtt - rtt) - self.rttvar)
+            self.srtt += RTT_ALPHA * (rtt - self.srtt)
+        self.probes += 1
+        self._answered.append(True)
+
+    def add_loss(self):
+        self.probes += 1
+        self._answered.append(False)
+
+    @property
+    def loss(self) -> float:
+        if not self._answered:
+            return 0.0
+        return self._answered.count(False) / len(self._answered)
+
+    @property
+    def score(self) -> float:
+        if self.srtt is None:
+            return math.inf
+        return self.srtt * (1 + LOSS_PENALTY * self.loss)
+
+    def quality(self) -> LinkQuality:
+        return LinkQuality(self.srtt, self.rttvar, self.loss, self.probes)
+
+
+def select_neighbours(current: Sequence[str], scores: Dict[str, float], size: int,
+                      random_slots: int = RANDOM_NEIGHBOURS, hysteresis: float = HYSTERESIS,
+                      rng: random.Random = random) -> List[str]:
+    """
+    Pick up to size neighbours among the current ones and the scored peers
+
+    :param current: addresses of the current neighbours
+    :param scores: link scores of the measured peers, current neighbours without one count as unreachable
+    :returns: the new neighbours' addresses, the fastest first
+    """
+
+    def effective(ipa: str) -> float:
+        score = scores.get(ipa, math.inf)
+        # the incumbent keeps its place unless clearly beaten
+        return score * (1 - hysteresis) if ipa in current else score
+
+    candidates = sorted(set(current) | set(scores), key=lambda ipa: (effective(ipa), ipa))
+    reachable = [ipa for ipa in candidates if math.isfinite(scores.get(ipa, math.inf))]
+    chosen = reachable[:max(size - random_slots, 0)]
+
+    rest = [ipa for ipa in reachable if ipa not in chosen]
+    # random neighbours stay as long as they're reachable, new ones are drawn for the free slots
+    randoms = [ipa for ipa in rest if ipa in current][:random_slots]
+    others = [ipa for ipa in rest if ipa not in randoms]
+    randoms += rng.sample(others, min(random_slots - len(randoms), len(others)))
+    chosen += randoms
+
+    # unmeasured neighbours may still be connecting, they keep the slots nobody else wants
+    chosen += [ipa for ipa in current if ipa not in chosen][:size - len(chosen)]
+    return chosen[:size]
@@ -0,0 +1,142 @@
+"""
+Logging setup for applications embedding meshchat
+
+Importing the library configures nothing. An application calls
+:func:`configure` once, which routes the library's records through a
+``QueueHandler``: the event loop only enqueues them and a listener thread
+formats and writes them out, so file and terminal I/O never stall the network.
+
+A trace keeps the latest records of every level in a ring buffer instead,
+optionally only a sample of them, to be dumped when something went wrong. A
+buffered record is formatted only when dumped.
+"""
+
+from typing import (Deque, List, Optional)
+from collections import deque
+from logging.handlers import (QueueHandler, QueueListener)
+import atexit
+import logging
+import queue
+import random
+
+
+# the package's loggers all descend from this one
+ROOT_LOGGER = __name__.rpartition('.')[0]
+FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+TRACE_CAPACITY = 10000
+
+
+class TraceBuffer(logging.Handler):
+    """
+    The last capacity records, a sample of them when sample is below 1
+    """
+
+    def __init__(self, capacity: int = TRACE_CAPACITY, sample: float = 1.0):
+        super().__init__(logging.DEBUG)
+        self.sample = sample
+        self.records: Deque[logging.LogRecord] = deque(maxlen=capacity)
+
+    def emit(self, record: logging.LogRecord):
+        if self.sample >= 1 or random.random() < self.sample:
+            self.records.append(record)
+
+    # a deque append is atomic, the handler's lock isn't needed
+    def handle(self, record: logging.LogRecord) -> bool:
+        if self.filter(record):
+            self.emit(record)
+        return True
+
+    def dump(self, path: str = None) -> List[str]:
+        """
+        Format the buffered records, oldest first, and write them to path if given
+        """
+
+        formatter = self.formatter or logging.Formatter(FORMAT)
+        lines = [formatter.format(record) for record in list(self.records)]
+        if path is not None:
+            with open(path, 'w') as f:
+                f.writelines(line + '\n' for line in lines)
+        return lines
+
+
+_listener: Optional[QueueListener] = None
+_handlers: List[logging.Handler] = []
+_trace: Optional[TraceBuffer] = None
+
+
+def configure(level: int = logging.INFO, filename: Optional[str] = 'log', stream: bool = True,
+              trace: bool = False, trace_capacity: int = TRACE_CAPACITY, trace_sample: float = 1.0):
+    """
+    Send the library's records of level and above to filename and stderr through a background thread
+
+    :param filename: log file, truncated first, None for no file
+    :param stream: also write to stderr, off for terminal interfaces
+    :param trace: keep every level's records in a ring buffer for :func:`dump_trace`
+    """
+
+    shutdown()
+    global _listener, _trace
+
+    formatter = logging.Formatter(FORMAT)
+    outputs = []
+    if filename is not None:
+        outputs.append(logging.FileHandler(filename, mode='w'))
+    if stream:
+        outputs.append(logging.StreamHandler())
+    for handler in outputs:
+        handler.setFormatter(formatter)
+
+    logger = logging.getLogger(ROOT_LOGGER)
+    if outputs:
+        records = queue.SimpleQueue()
+        # records below level are dropped before they're queued
+        queue_handler = QueueHandler(records)
+        queue_handler.setLevel(level)
+        _handlers.append(queue_handler)
+        _listener = QueueListener(records, *outputs, respect_handler_level=False)
+        _listener.start()
+
+    if trace:
+        _trace = TraceBuffer(trace_capacity, trace_sample)
+        _trace.setFormatter(formatter)
+        _handlers.append(_trace)
+
+    for handler in _handlers:
+        logger.addHandler(handler)
+    # debug records are only created at all when a trace wants them
+    logger.setLevel(logging.DEBUG if trace else level)
+    logger.propagate = False
+
+
+def dump_trace(path: str = None) -> List[str]:
+    """
+    Format the traced records, writing them to path if given
+
+    :raises RuntimeError: if tracing isn't configured
+    """
+
+    if _trace is None:
+        raise RuntimeError("tracing is not enabled")
+    return _trace.dump(path)
+
+
+def shutdown():
+    """
+    Write out the queued records and detach the handlers
+    """
+
+    global _listener, _trace
+    logger = logging.getLogger(ROOT_LOGGER)
+    for handler in _handlers:
+        logger.removeHandler(handler)
+    _handlers.clear()
+    _trace = None
+
+    if _listener is not None:
+        _listener.stop()
+        for handler in _listener.handlers:
+            handler.close()
+        _listener = None
+
+
+atexit.register(shutdown)
@@ -0,0 +1,210 @@
+"""
+Counters, summaries and gauges of a node, readable as a snapshot or exported
+
+Hot paths only bump plain attributes: a ``Counter`` adds to an int and a
+``Summary`` keeps a count, sum and maximum. Gauges, and metrics computed from
+state kept elsewhere such as per-connection totals, are callbacks evaluated
+when a snapshot is taken, so they cost nothing in between.
+
+A metric family can have one label, its children are told apart by the
+label's value. Snapshots export as the Prometheus text format, for the
+node_exporter textfile collector for instance, or as JSON.
+"""
+
+from typing import (Callable, Dict, Iterator, List, NamedTuple, Optional, Tuple, Union)
+import json
+import os
+
+
+class Counter:
+    __slots__ = ('value',)
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount: float = 1):
+        self.value += amount
+
+
+class Summary:
+    """
+    Count, sum and maximum of observed values, durations in seconds mostly
+    """
+
+    __slots__ = ('count', 'sum', 'max')
+
+    def __init__(self):
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value: float):
+        self.count += 1
+        self.sum += value
+        if value > self.max:
+            self.max = value
+
+
+class Sample(NamedTuple):
+    name: str
+    # label name and value, None for unlabeled metrics
+    label: Optional[Tuple[str, str]]
+    value: float
+
+
+# the current value, or values by label value for labeled families
+Collect = Callable[[], Union[float, Dict[str, float]]]
+
+
+class _Family:
+    def __init__(self, name: str, kind: str, help: str, label: Optional[str], collect: Optional[Collect]):
+        self.name = name
+        self.kind = kind
+        self.help = help
+        self.label = label
+        self.collect = collect
+        self.children: Dict[Optional[str], Union[Counter, Summary]] = {}
+
+    def labels(self, value: str) -> Union[Counter, Summary]:
+        child = self.children.get(value)
+        if child is None:
+            child = self.children[value] = Summary() if self.kind == 'summary' else Counter()
+        return child
+
+    def samples(self) -> Iterator[Sample]:
+        if self.collect is not None:
+            values = self.collect()
+            if self.label is None:
+                values = {None: values}
+            for value, v in values.items():
+                yield Sample(self.name, None if value is None else (self.label, value), v)
+            return
+
+        for value, child in self.children.items():
+            label = None if value is None else (self.label, value)
+            if isinstance(child, Summary):
+                yield Sample(self.name + '_count', label, child.count)
+                yield Sample(self.name + '_sum', label, child.sum)
+                yield Sample(self.name + '_max', label, child.max)
+            else:
+                yield Sample(self.name, label, child.value)
+
+
+class Registry:
+    """
+    Metric families of one node by name
+    """
+
+    def __init__(self):
+        self._families: Dict[str, _Family] = {}
+
+    def _family(self, name: str, kind: str, help: str, label: Optional[str] = None,
+                collect: Optional[Collect] = None) -> _Family:
+        family = self._families.get(name)
+        if family is None:
+            family = self._families[name] = _Family(name, kind, help, label, collect)
+        elif family.kind != kind:
+            raise ValueError(f"{name} is already registered as a {family.kind}")
+        return family
+
+    def counter(self, name: str, help: str, label: str = None) -> Union[Counter, _Family]:
+        """
+        :returns: the counter, or its family to pick children from with labels() if label is given
+        """
+
+        family = self._family(name, 'counter', help, label)
+        return family if label is not None else family.labels(None)
+
+    def summary(self, name: str, help: str, label: str = None) -> Union[Summary, _Family]:
+        family = self._family(name, 'summary', help, label)
+        return family if label is not None else family.labels(None)
+
+    def gauge(self, name: str, help: str, collect: Collect, label: str = None):
+        self._family(name, 'gauge', help, label, collect)
+
+    def collected_counter(self, name: str, help: str, collect: Collect, label: str = None):
+        """
+        A counter whose totals are kept elsewhere and read by collect
+        """
+
+        self._family(name, 'counter', help, label, collect)
+
+    def samples(self) -> List[Sample]:
+        return [sample for family in self._families.values() for sample in family.samples()]
+
+    def snapshot(self) -> Dict[str, Union[float, Dict[str, float]]]:
+        """
+        Current values by metric name, labeled ones by label value
+        """
+
+        snapshot = {}
+        for name, label, value in self.samples():
+            if label is None:
+                snapshot[name] = value
+            else:
+                snapshot.setdefault(name, {})[label[1]] = value
+        return snapshot
+
+    def to_prometheus(self) -> str:
+        lines = []
+        for family in self._families.values():
+            lines.append(f"# HELP {family.name} {family.help}")
+            lines.append(f"# TYPE {family.name} {'untyped' if family.kind == 'summary' else family.kind}")
+            for name, label, value in family.samples():
+                labels = '' if label is None else '{%s="%s"}' % (label[0], _escape(label[1]))
+                lines.append(f"{name}{labels} {value!r}")
+        return '\n'.join(lines) + '\n'
+
+    def to_json(self) -> str:
+        return json.dumps(self.snapshot(), indent=2, sort_keys=True)
+
+    def write(self, path: str, fmt: str = 'prometheus'):
+        """
+        Replace the file at path with a snapshot, readers never see half of one
+
+        :param fmt: 'prometheus' or 'json'
+        """
+
+        if fmt not in ('prometheus', 'json'):
+            raise ValueError(f"unknown metrics format {fmt}")
+        text = self.to_prometheus() if fmt == 'prometheus' else self.to_json()
+        tmp = f"{path}.tmp"
+        with open(tmp, 'w') as f:
+            f.write(text)
+        os.replace(tmp, path)
+
+
+def _escape(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+class ConnectionStats:
+    """
+    Traffic and record layer cost of one connection
+    """
+
+    __slots__ = ('messages_sent', 'bytes_sent', 'messages_received', 'bytes_received',
+                 'seal_seconds', 'open_seconds', 'handshake')
+
+    def __init__(self):
+        self.messages_sent = 0
+        self.messages_received = 0
+        # sealed records as they go over the wire, without framing
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.seal_seconds = 0.0
+        self.open_seconds = 0.0
+        # seconds spent in each phase of the handshake
+        self.handshake: Dict[str, float] = {}
+
+    def add(self, other: 'ConnectionStats'):
+        """
+        Count other's traffic and record layer time in too, handshakes aside
+        """
+
+        self.messages_sent += other.messages_sent
+        self.messages_received += other.messages_received
+        self.bytes_sent += other.bytes_sent
+        self.bytes_received += other.bytes_received
+        self.seal_seconds += other.seal_seconds
+        self.open_seconds += other.open_seconds
@@ -1,153 +1,376 @@
 from . import util as cu
-
-from typing import Set
-from threading import Lock
-
-import socket
-
-import base64
-from cryptography.fernet import Fernet
-from cryptography.hazmat.backends import default_backend
-from cryptography.hazmat.primitives import hashes
+from .framing import FrameProtocol
+from .record import RecordCipher, derive_key, TAG_SIZE
+from .rpc import RequestTracker
+from .session import (Session, SessionCache, TICKET_SIZE)
+from .protocol import PROTOCOL_VERSION
+from .compression import (Compressor, CODEC_NONE, negotiate, supported_codecs)
+from .link import LinkStats
+from .metrics import ConnectionStats
+
+from typing import (Callable, Container, Optional, Sequence, Tuple)
+import hashlib
+import asyncio
+import hmac
+import struct
+import time
+
+from cryptography.exceptions import (InvalidSignature, InvalidTag)
 from cryptography.hazmat.primitives import serialization
-from cryptography.hazmat.primitives.asymmetric import ec
-from cryptography.hazmat.primitives.asymmetric import ed25519
-from cryptography.hazmat.primitives.kdf.hkdf import HKDF
+from cryptography.hazmat.primitives.asymmetric import x25519
 
 import logging
 
 
 logger = logging.getLogger(__name__)
-HEADER_SIZE = 4
 
 
-# initializing only once when importing
-private_key: ed25519.Ed25519PrivateKey = cu.read_private_key()
-public_bytes: bytes = cu.get_public_key()
+# first byte of every handshake message
+_RESUME = b'\x00'
+_ACCEPT = b'\x01'
+_REJECT = b'\x02'
+_HELLO = b'\x03'
+MAC_SIZE = 32
+# protocol version, raw identity key, X25519 key share, signature of the share and codec ids,
+# the ids of the supported compression codecs follow
+_HELLO_BODY = struct.Struct('>B32s32s64s')
 
 
-class Node:
-    def __init__(self, sock: socket.socket, is_client=False, trusted_keys: Set[bytes] = None):
-        self.trusted_keys: Set[bytes] = cu.read_trusted_keys()
-        if trusted_keys:
-            self.trusted_keys |= trusted_keys
+def _resumption_mac(secret: bytes, role: bytes, transcript: bytes) -> bytes:
+    return hmac.new(derive_key(secret, b'meshchat resume ' + role), transcript, hashlib.sha256).digest()
 
-        self.node_sock = sock
-        self.peer_ipa = sock.getpeername()[0]
 
-        if is_client:
-            self._send_msg(public_bytes)
-            pubkey_bytes = self._recv_msg()
-            if pubkey_bytes not in self.trusted_keys:
-                raise RuntimeError("Initial received message is not a known public key")
-        else:
-            # receive pubic key and check if known
-            pubkey_bytes = self._recv_msg()
-            if pubkey_bytes not in self.trusted_keys:
-                raise RuntimeError("Initial received message is not a known public key")
+def _dh_public_bytes(dh_priv: x25519.X25519PrivateKey) -> bytes:
+    return dh_priv.public_key().public_bytes(serialization.Encoding.Raw, serialization.PublicFormat.Raw)
+
+
+def key_exchange(dh_priv: x25519.X25519PrivateKey, peer_share: x25519.X25519PublicKey) -> bytes:
+    try:
+        return dh_priv.exchange(peer_share)
+    # a low order point, which would give a predictable key
+    except ValueError:
+        raise RuntimeError("peer sent an invalid key share")
+
+
+def _signed_share(direction: int, version: int, share: bytes, codecs: bytes) -> bytes:
+    # the direction keeps a hello from being reflected back to its sender, the codecs from being stripped
+    return b'meshchat hello' + bytes((direction, version)) + share + codecs
+
+
+def make_hello(direction: int, dh_priv: x25519.X25519PrivateKey, codecs: Sequence[int] = (),
+               identity: cu.Identity = None) -> bytes:
+    """
+    Our identity, the key share of dh_priv and codecs, signed for the end using direction
+
+    :param identity: the signing node's, the default key directory's if None
+    """
+
+    identity = identity or cu.default_identity()
+    share = _dh_public_bytes(dh_priv)
+    codecs = bytes(codecs)
+    signature = identity.private_key.sign(_signed_share(direction, PROTOCOL_VERSION, share, codecs))
+    return _HELLO + _HELLO_BODY.pack(PROTOCOL_VERSION, identity.public_raw, share, signature) + codecs
 
-            self._send_msg(public_bytes)
 
-        self.peer_kbytes = pubkey_bytes
-        self.peer_pubkey = serialization.load_ssh_public_key(pubkey_bytes, default_backend())
+def open_hello(hello: bytes, direction: int, is_trusted: Callable[[bytes], bool],
+               keystore: cu.KeyStore = cu.trusted_keys) -> Tuple[int, bytes, x25519.X25519PublicKey, bytes]:
+    """
+    Check a hello made by the end using direction
+
+    :returns: the sender's protocol version, raw identity key, key share and codec ids
+    :raises RuntimeError: if the hello is malformed, its key not trusted or its signature invalid
+    """
+
+    if len(hello) < len(_HELLO) + _HELLO_BODY.size or not hello.startswith(_HELLO):
+        raise RuntimeError("Initial received message is not a handshake hello")
+    version, identity, share, signature = _HELLO_BODY.unpack_from(hello, len(_HELLO))
+    codecs = hello[len(_HELLO) + _HELLO_BODY.size:]
+    if not is_trusted(identity):
+        raise RuntimeError("Initial received message is not a known public key")
+
+    try:
+        keystore.public_key(identity).verify(signature, _signed_share(direction, version, share, codecs))
+    except InvalidSignature:
+        raise RuntimeError("hello signature failed verification")
+    return version, identity, x25519.X25519PublicKey.from_public_bytes(share), codecs
+
+
+class Node:
+    """
+    An encrypted connection to a single peer, driven by the event loop
+
+    Construct with :meth:`Node.connect`, which runs the handshake.
+    """
+
+    def __init__(self, stream: FrameProtocol, trusted_keys: Container[bytes] = (), codecs: Sequence[int] = None,
+                 identity: cu.Identity = None):
+        # our key pair, the default key directory's unless several nodes share the process
+        self.identity = identity or cu.default_identity()
+        # OpenSSH keys trusted on top of the identity's, looked up in place rather than copied
+        self.trusted_keys = trusted_keys
+        self.keystore = self.identity.trusted
+        # compression codecs we accept, most preferred first
+        self.codecs = supported_codecs() if codecs is None else list(codecs)
+        self.compressor = Compressor()
+
+        self.stream = stream
+        self.peer_ipa = stream.get_extra_info('peername')[0]
+
         # callback to handle messages
         self.dispatcher = lambda _: None
-        # can't send asynchronously, key derivation will break. peer would try to process first message and answer with an old key
-        self.sending_lock = Lock()
+        # control requests waiting for their replies
+        self.requests = RequestTracker()
+        # the event loop's, simulated runs have one of their own
+        self.clock = asyncio.get_event_loop().time
+        # clock times of the last traffic each way, and of the last that wasn't a keepalive
+        self.last_sent = self.last_received = self.last_active = self.clock()
+        # round trip times and losses of the pings over this connection
+        self.link = LinkStats()
+        self.stats = ConnectionStats()
+
+    @classmethod
+    async def connect(cls, stream: FrameProtocol, is_client=False, trusted_keys: Container[bytes] = (),
+                      sessions: SessionCache = None, codecs: Sequence[int] = None,
+                      identity: cu.Identity = None) -> 'Node':
+        """
+        Wrap an open frame stream and run the handshake over it
 
-        shared = self.exchange_dh(is_client)
-        self.derive_enc_key(shared)
+        With sessions, a client resumes its last session with the peer's address
+        if it has one and the session is remembered for the next connection.
+        codecs lists the compression codecs to offer, all registered ones by default.
 
-    def send_message(self, msg: bytes):
-        """
-        Securely transmit a byte message
+        :raises RuntimeError: if the peer's public key is not trusted
         """
 
-        self.derive_enc_key(self.enc_key)
+        node = cls(stream, trusted_keys, codecs=codecs, identity=identity)
+        await node.handshake(is_client, sessions)
+        return node
 
-        fernet = Fernet(base64.urlsafe_b64encode(self.enc_key))
-        msg_token = fernet.encrypt(msg)
+    async def handshake(self, is_client=False, sessions: SessionCache = None):
+        # nonce direction tags, each side seals with its own and opens with the peer's
+        self.direction = 0 if is_client else 1
+        self.peer_direction = 1 - self.direction
 
-        self._send_msg(msg_token)
+        phases = self.stats.handshake
+        start = time.perf_counter()
+        shared = None
+        hello = None
+        if is_client:
+            session = sessions.take_for(self.peer_ipa) if sessions is not None else None
+            if session is not None and self._is_trusted(cu.ssh_to_raw(session.peer_kbytes)):
+                shared = await self._offer_resumption(session)
+        else:
+            first = await self._recv_msg()
+            if first.startswith(_RESUME):
+                shared = await self._answer_resumption(first, sessions)
+            else:
+                hello = first
+        phases['resumption'] = time.perf_counter() - start
+
+        self.resumed = shared is not None
+        if shared is None:
+            shared = await self._full_handshake(is_client, hello)
+
+        keys_start = time.perf_counter()
+        self._setup_chains(shared, is_client)
+        if sessions is not None:
+            sessions.store(self.peer_ipa, self.peer_kbytes, shared, self.protocol_version, self.compressor.codec_id)
+        phases['keys'] = time.perf_counter() - keys_start
+        phases['total'] = time.perf_counter() - start
+
+    async def _full_handshake(self, is_client: bool, hello: bytes = None) -> bytes:
+        """
+        Swap signed hellos carrying the identity and a fresh X25519 key share, one message each way
 
-    def receive_message(self) -> bytes:
+        Neither hello depends on the other's, so each side sends its own right
+        away. hello is the client's if the server already read it.
         """
-        Receive and decrypt a byte message
+
+        start = time.perf_counter()
+        dh_priv = x25519.X25519PrivateKey.generate()
+        ours = self._hello(dh_priv)
+        if is_client:
+            await self._send_msg(ours)
+            theirs = await self._recv_msg()
+        else:
+            await self._send_msg(ours)
+            theirs = hello if hello is not None else await self._recv_msg()
+        verify_start = time.perf_counter()
+        # signing the hello, sending it and waiting for the peer's
+        self.stats.handshake['hello'] = verify_start - start
+
+        shared = key_exchange(dh_priv, self._check_hello(theirs))
+        transcript = ours + theirs if is_client else theirs + ours
+        key = derive_key(shared, b'meshchat session' + hashlib.sha256(transcript).digest())
+        self.stats.handshake['verify'] = time.perf_counter() - verify_start
+        return key
+
+    def _hello(self, dh_priv: x25519.X25519PrivateKey) -> bytes:
+        return make_hello(self.direction, dh_priv, self.codecs, self.identity)
+
+    def _check_hello(self, hello: bytes) -> x25519.X25519PublicKey:
+        version, identity, share, codecs = open_hello(hello, self.peer_direction, self._is_trusted, self.keystore)
+        # the client's preference wins, both ends pick the same codec
+        codec = negotiate(self.codecs, codecs) if self.direction == 0 else negotiate(codecs, self.codecs)
+        self._set_peer(cu.raw_to_ssh(identity), version, codec)
+        return share
+
+    def _is_trusted(self, raw: bytes) -> bool:
+        return raw in self.keystore or cu.raw_to_ssh(raw) in self.trusted_keys
+
+    def _set_peer(self, kbytes: bytes, version: int, codec: int = CODEC_NONE):
+        self.peer_kbytes = kbytes
+        self.peer_pubkey = self.keystore.public_key(cu.ssh_to_raw(kbytes))
+        # the newest version both ends speak
+        self.protocol_version = min(version, PROTOCOL_VERSION)
+        self.compressor = Compressor(codec)
+
+    async def _offer_resumption(self, session: Session) -> Optional[bytes]:
         """
+        Offer session's ticket along with a fresh key share
 
-        msg_token = self._recv_msg()
+        :returns: the new shared key, None if the peer declined and the full handshake must follow
+        """
 
-        # deriving only after received something to avoid messing with send_message
-        self.derive_enc_key(self.enc_key)
+        dh_priv = x25519.X25519PrivateKey.generate()
+        offer = _RESUME + session.ticket + _dh_public_bytes(dh_priv)
+        offer += _resumption_mac(session.secret, b'client', offer)
+        await self._send_msg(offer)
 
-        fernet = Fernet(base64.urlsafe_b64encode(self.enc_key))
-        return fernet.decrypt(msg_token)
+        reply = await self._recv_msg()
+        if not reply.startswith(_ACCEPT):
+            logger.debug("resumption declined, falling back to the full handshake")
+            return None
 
-    def close(self):
-        self.node_sock.shutdown(socket.SHUT_RD)
-        self.node_sock.close()
-        logger.debug("closed node")
+        body, mac = reply[:-MAC_SIZE], reply[-MAC_SIZE:]
+        if not hmac.compare_digest(mac, _resumption_mac(session.secret, b'server', offer + body)):
+            raise RuntimeError("resumption reply failed authentication")
 
-    def _send_msg(self, msg: bytes) -> None:
-        logger.debug("sending...")
-        self.node_sock.send(len(msg).to_bytes(HEADER_SIZE, byteorder='big'))
-        self.node_sock.send(msg)
-        logger.debug("message sent")
+        self._set_peer(session.peer_kbytes, session.version, session.codec)
+        logger.debug("resumed the previous session")
+        return self._resumed_key(session, dh_priv, body[len(_ACCEPT):])
 
-    def _recv_msg(self) -> bytes:
-        logger.debug("waiting for a message")
-        msg_len = int.from_bytes(self.node_sock.recv(HEADER_SIZE), byteorder='big')
-        msg = b''
-        logger.debug("receiving a message...")
-        # ! this refused to receive initial neighbours. wtf??
-        # while len(msg) < msg_len:
-        #     msg += self.node_sock.recv(16)
-        msg = self.node_sock.recv(msg_len)
-        if not msg:
-            raise OSError(f"{self.peer_ipa} closed the connection socket")
-        logger.debug("completed receiving a message")
-        return msg
+    async def _answer_resumption(self, offer: bytes, sessions: SessionCache) -> Optional[bytes]:
+        """
+        Accept a resumption offer if its ticket is still held and its MAC checks out, decline it otherwise
 
-    def exchange_dh(self, is_client=False):
-        dh_priv = ec.generate_private_key(ec.SECP256K1, default_backend())
-        dh_pub = dh_priv.public_key()
+        :returns: the new shared key, None if declined
+        """
 
-        if is_client:
-            self._send_dh(dh_pub)
-            dh_peer_pub = self._receive_dh()
-        else:
-            dh_peer_pub = self._receive_dh()
-            self._send_dh(dh_pub)
+        ticket = offer[len(_RESUME):len(_RESUME) + TICKET_SIZE]
+        session = sessions.get(ticket) if sessions is not None else None
+        body, mac = offer[:-MAC_SIZE], offer[-MAC_SIZE:]
+        # a replayed or guessed ticket is only used up by an offer from the session's owner
+        if (session is None or not self._is_trusted(cu.ssh_to_raw(session.peer_kbytes))
+                or not hmac.compare_digest(mac, _resumption_mac(session.secret, b'client', body))):
+            logger.debug("declined a resumption offer")
+            await self._send_msg(_REJECT)
+            return None
+        sessions.take(ticket)
+
+        dh_priv = x25519.X25519PrivateKey.generate()
+        reply = _ACCEPT + _dh_public_bytes(dh_priv)
+        await self._send_msg(reply + _resumption_mac(session.secret, b'server', offer + reply))
+
+        self._set_peer(session.peer_kbytes, session.version, session.codec)
+        logger.debug("resumed the previous session")
+        return self._resumed_key(session, dh_priv, body[len(_RESUME) + TICKET_SIZE:])
+
+    def _resumed_key(self, session: Session, dh_priv: x25519.X25519PrivateKey, peer_dh_bytes: bytes) -> bytes:
+        try:
+            peer_dh_pub = x25519.X25519PublicKey.from_public_bytes(peer_dh_bytes)
+        except ValueError:
+            raise RuntimeError("malformed resumption key share")
+        # the fresh exchange keeps the session forward secret should the resumption secret leak later
+        return derive_key(session.secret + key_exchange(dh_priv, peer_dh_pub), b'meshchat resumed session')
+
+    def _setup_chains(self, shared: bytes, is_client: bool):
+        # one chain per direction, sending never has to wait for the peer's messages
+        client_key = derive_key(shared, b'meshchat record client')
+        server_key = derive_key(shared, b'meshchat record server')
+
+        self.send_chain = RecordCipher(client_key if is_client else server_key)
+        self.recv_chain = RecordCipher(server_key if is_client else client_key)
+
+    async def send_message(self, msg: bytes, keepalive: bool = False):
+        """
+        Securely transmit a byte message
+        """
 
-        return dh_priv.exchange(ec.ECDH(), dh_peer_pub)
+        await self.send_messages(msg, keepalive=keepalive)
 
-    def derive_enc_key(self, key):
-        self.enc_key = HKDF(
-            algorithm=hashes.SHA256(),
-            length=32,
-            salt=None,
-            info=None,
-            backend=default_backend()
-        ).derive(key)
+    async def send_messages(self, *msgs: bytes, keepalive: bool = False):
+        """
+        Securely transmit messages back to back, nothing sent concurrently lands between them
 
-    def _receive_dh(self) -> ec.EllipticCurvePublicKey:
-        logger.debug("DH: waiting for the public key signature...")
-        peer_pubsign = self._recv_msg() 
+        Keepalives don't count as activity, a connection carrying only them still idles out.
 
-        logger.debug("DH: waiting for the public key...")
-        peer_dh_pubbytes = self._recv_msg()
+        :raises ValueError: if a message doesn't fit in a frame, none of them is sent then
+        """
 
-        self.peer_pubkey.verify(peer_pubsign, peer_dh_pubbytes)
-        logger.debug("DH: successfully verified the key")
+        plaintexts = [self.compressor.encode(msg) for msg in msgs]
+        # sealing uses up a counter, a record the stream then refused would fail every later one at the peer
+        for plaintext in plaintexts:
+            if len(plaintext) + TAG_SIZE > self.stream.max_frame_size:
+                raise ValueError(f"{len(plaintext)} byte message doesn't fit in a frame")
+
+        # sealing and queueing don't yield, so records hit the wire in counter order
+        stats = self.stats
+        for plaintext in plaintexts:
+            start = time.perf_counter()
+            record = self.send_chain.seal(plaintext, self.direction)
+            stats.seal_seconds += time.perf_counter() - start
+            stats.messages_sent += 1
+            stats.bytes_sent += len(record)
+            self.stream.write_frame(record)
+        self.last_sent = self.clock()
+        if not keepalive:
+            self.last_active = self.last_sent
+        await self.stream.drain()
+
+    async def receive_message(self) -> bytes:
+        """
+        Receive and decrypt a byte message
+        """
 
-        return default_backend().load_elliptic_curve_public_bytes(ec.SECP256K1, peer_dh_pubbytes)
+        record = await self._recv_msg()
+        self.last_received = self.clock()
+        stats = self.stats
+        stats.messages_received += 1
+        stats.bytes_received += len(record)
+
+        start = time.perf_counter()
+        try:
+            plaintext = self.recv_chain.open(record, self.peer_direction)
+            stats.open_seconds += time.perf_counter() - start
+        except InvalidTag:
+            self.close()
+            raise OSError(f"{self.peer_ipa} sent a record that failed authentication")
+
+        try:
+            return self.compressor.decode(plaintext)
+        except ValueError as e:
+            self.close()
+            raise OSError(f"{self.peer_ipa} sent a message that failed to decompress: {e}")
 
-    def _send_dh(self, dhpk):
-        dh_pub_bytes = dhpk.public_bytes(serialization.Encoding.X962, serialization.PublicFormat.UncompressedPoint)
+    def close(self):
+        self.stream.close()
+        logger.debug("closed node")
+
+    def abort(self):
+        # a dead peer never acknowledges buffered data, closing gracefully could wait on it for minutes
+        self.stream.abort()
+        logger.debug("aborted node")
 
-        pubsign = private_key.sign(dh_pub_bytes)
-        logger.debug("DH: sending the public key signature...")
-        self._send_msg(pubsign)
+    async def _send_msg(self, msg: bytes) -> None:
+        logger.debug("sending...")
+        self.stream.write_frame(msg)
+        await self.stream.drain()
+        logger.debug("message sent")
 
-        logger.debug("DH: sending the public key...")
-        self._send_msg(dh_pub_bytes)
+    async def _recv_msg(self) -> bytes:
+        # every message passes here, logging them would cost more than receiving them
+        try:
+            return await self.stream.read_frame()
+        except ConnectionResetError:
+            raise OSError(f"{self.peer_ipa} closed the connection socket")
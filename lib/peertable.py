@@ -0,0 +1,146 @@
+"""
+Versioned known peers table with digests for anti-entropy
+
+Every entry carries a version, a millisecond timestamp bumped on each local
+change, and merges keep the higher one. Entries fall into buckets by the
+first byte of their raw key; a bucket's digest is the XOR of its entries'
+hashes, so it is kept up to date in O(1) and any entry can be left out of a
+comparison by XOR-ing its hash back out. Two nodes swap bucket digests and
+transfer only the entries of buckets that differ.
+"""
+
+from .util import ssh_to_raw
+
+from typing import (Callable, Dict, Iterable, Iterator, List, MutableMapping, NamedTuple, Optional, Set)
+from hashlib import blake2b
+import time
+
+
+BUCKETS = 256
+
+
+class PeerRecord(NamedTuple):
+    kbytes: bytes
+    ipa: str
+    version: int
+
+
+class _Entry(NamedTuple):
+    ipa: str
+    version: int
+    bucket: int
+    digest: int
+
+
+def _now_ms() -> int:
+    return int(time.time() * 1000)
+
+
+def _entry(kbytes: bytes, ipa: str, version: int) -> _Entry:
+    raw = ssh_to_raw(kbytes)
+    h = blake2b(raw + ipa.encode() + version.to_bytes(8, byteorder='big'), digest_size=8)
+    return _Entry(ipa, version, raw[0], int.from_bytes(h.digest(), byteorder='big'))
+
+
+class PeerTable(MutableMapping[bytes, str]):
+    """
+    Maps OpenSSH public keys to addresses like the plain dict it replaces
+    """
+
+    def __init__(self, clock: Callable[[], int] = _now_ms):
+        self.clock = clock
+        self._entries: Dict[bytes, _Entry] = {}
+        self._digests = [0] * BUCKETS
+        self._buckets: List[Set[bytes]] = [set() for _ in range(BUCKETS)]
+        # the key last seen at each address
+        self._addresses: Dict[str, bytes] = {}
+
+    def __getitem__(self, kbytes: bytes) -> str:
+        return self._entries[kbytes].ipa
+
+    def __setitem__(self, kbytes: bytes, ipa: str):
+        old = self._entries.get(kbytes)
+        if old is not None and old.ipa == ipa:
+            return
+        version = self.clock() if old is None else max(self.clock(), old.version + 1)
+        self._put(kbytes, _entry(kbytes, ipa, version))
+
+    def __delitem__(self, kbytes: bytes):
+        old = self._entries.pop(kbytes)
+        self._digests[old.bucket] ^= old.digest
+        self._buckets[old.bucket].discard(kbytes)
+        if self._addresses.get(old.ipa) == kbytes:
+            del self._addresses[old.ipa]
+
+    def __iter__(self) -> Iterator[bytes]:
+        return iter(self._entries)
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def __repr__(self) -> str:
+        return f"PeerTable({dict(self.items())!r})"
+
+    def _put(self, kbytes: bytes, entry: _Entry):
+        old = self._entries.get(kbytes)
+        if old is not None:
+            self._digests[old.bucket] ^= old.digest
+            if old.ipa != entry.ipa and self._addresses.get(old.ipa) == kbytes:
+                del self._addresses[old.ipa]
+        self._entries[kbytes] = entry
+        self._digests[entry.bucket] ^= entry.digest
+        self._buckets[entry.bucket].add(kbytes)
+        self._addresses[entry.ipa] = kbytes
+
+    def key_at(self, ipa: str) -> Optional[bytes]:
+        return self._addresses.get(ipa)
+
+    def version(self, kbytes: bytes) -> int:
+        return self._entries[kbytes].version
+
+    def record(self, kbytes: bytes) -> PeerRecord:
+        entry = self._entries[kbytes]
+        return PeerRecord(kbytes, entry.ipa, entry.version)
+
+    def merge(self, records: Iterable[PeerRecord]) -> List[bytes]:
+        """
+        Take every record newer than the local entry
+
+        :returns: keys whose entry was added or changed
+        """
+
+        changed = []
+        for kbytes, ipa, version in records:
+            old = self._entries.get(kbytes)
+            # equal versions are settled by the address so both ends pick the same one
+            if old is None or (version, ipa) > (old.version, old.ipa):
+                self._put(kbytes, _entry(kbytes, ipa, version))
+                changed.append(kbytes)
+        return changed
+
+    def digests(self, exclude: Iterable[bytes] = ()) -> List[int]:
+        digests = self._digests.copy()
+        for kbytes in exclude:
+            entry = self._entries.get(kbytes)
+            if entry is not None:
+                digests[entry.bucket] ^= entry.digest
+        return digests
+
+    def diff(self, digests: List[int], exclude: Iterable[bytes] = ()) -> List[PeerRecord]:
+        """
+        Records of every bucket whose digest differs from the given ones
+
+        An empty digest list stands for an empty table, so everything is returned.
+        """
+
+        exclude = set(exclude)
+        if not digests:
+            digests = [0] * BUCKETS
+        elif len(digests) != BUCKETS:
+            raise ValueError(f"expected {BUCKETS} digests, got {len(digests)}")
+
+        records = []
+        for bucket, (ours, theirs) in enumerate(zip(self.digests(exclude), digests)):
+            if ours != theirs:
+                records += [self.record(kbytes) for kbytes in self._buckets[bucket] if kbytes not in exclude]
+        return records
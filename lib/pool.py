@@ -0,0 +1,236 @@
+"""
+Bounded pool of peer connections
+"""
+
+from typing import (Awaitable, Callable, Dict, List, Optional, Set, TYPE_CHECKING)
+from collections import OrderedDict
+from functools import partial
+import asyncio
+
+import logging
+
+
+if TYPE_CHECKING:
+    # the pool only needs the interface
+    from .node import Node
+
+
+logger = logging.getLogger(__name__)
+
+
+MAX_CONNECTIONS = 64
+CONNECT_TIMEOUT = 5.0
+# connections without traffic for this long are closed, unless pinned
+IDLE_TIMEOUT = 300.0
+# connections that received nothing for this long are probed
+KEEPALIVE_INTERVAL = 60.0
+# seconds without sending anything after which a heartbeat goes out
+HEARTBEAT_INTERVAL = 15.0
+# connections that received nothing, not even a heartbeat, for this long are dead
+RECEIVE_DEADLINE = 45.0
+# records waiting per peer while its connection is being established
+MAX_PENDING = 256
+
+
+class ConnectionPool:
+    """
+    Established connections by address, least recently used first
+
+    connect establishes and registers a connection, probe raises if a
+    connection is dead, pinned tells which addresses must not be evicted.
+    With heartbeat, quiet connections are sent a heartbeat every
+    heartbeat_interval, with receive_deadline the ones the peer stopped
+    sending on are closed. Both are off by default, a heartbeat_interval of None
+    turns heartbeats off too. With a receive deadline
+    the peer's own heartbeats show it's alive, quiet connections aren't probed.
+    Connections the pool closes leave it at once, whoever reads them cleans up the rest.
+    """
+
+    def __init__(self, connect: Callable[[str], Awaitable['Node']], probe: Callable[['Node'], Awaitable],
+                 pinned: Callable[[str], bool] = lambda _: False,
+                 max_size: int = MAX_CONNECTIONS, connect_timeout: float = CONNECT_TIMEOUT,
+                 idle_timeout: float = IDLE_TIMEOUT, keepalive_interval: float = KEEPALIVE_INTERVAL,
+                 heartbeat: Callable[['Node'], Awaitable] = None,
+                 heartbeat_interval: Optional[float] = HEARTBEAT_INTERVAL,
+                 receive_deadline: Optional[float] = None):
+        self.connect = connect
+        self.probe = probe
+        self.pinned = pinned
+        self.max_size = max_size
+        self.connect_timeout = connect_timeout
+        self.idle_timeout = idle_timeout
+        self.keepalive_interval = keepalive_interval
+        self.heartbeat = heartbeat if heartbeat_interval is not None else None
+        self.heartbeat_interval = heartbeat_interval
+        self.receive_deadline = receive_deadline
+
+        self.connections: 'OrderedDict[str, Node]' = OrderedDict()
+        # connections being established, so concurrent callers share one handshake
+        self.connecting: Dict[str, asyncio.Future] = {}
+        self.pending: Dict[str, List[bytes]] = {}
+        self._probing: Set[str] = set()
+        self._tasks: Set[asyncio.Task] = set()
+
+    def __contains__(self, ipa: str) -> bool:
+        return ipa in self.connections
+
+    def __len__(self) -> int:
+        return len(self.connections)
+
+    def add(self, ipa: str, node: 'Node') -> List['Node']:
+        """
+        Register an established connection
+
+        :returns: least recently used connections evicted to stay within max_size, for the caller to close
+        """
+
+        self.connections[ipa] = node
+        self.connections.move_to_end(ipa)
+
+        evicted = []
+        while len(self.connections) > self.max_size:
+            victim = self._eviction_candidate(exclude=ipa)
+            if victim is None:
+                break
+            evicted.append(self.connections.pop(victim))
+            logger.debug("%s: evicted from the pool", victim)
+        return evicted
+
+    def _eviction_candidate(self, exclude: str):
+        candidates = [ipa for ipa in self.connections if ipa != exclude]
+        unpinned = [ipa for ipa in candidates if not self.pinned(ipa)]
+        candidates = unpinned or candidates
+        if not candidates:
+            return None
+        return min(candidates, key=lambda ipa: self.connections[ipa].last_active)
+
+    def remove(self, ipa: str, node: 'Node'):
+        if self.connections.get(ipa) is node:
+            del self.connections[ipa]
+
+    async def get(self, ipa: str) -> 'Node':
+        """
+        Return the connection to ipa, establishing it if needed
+
+        :raises asyncio.TimeoutError: if the connection took longer than connect_timeout
+        """
+
+        node = self.connections.get(ipa)
+        if node is not None:
+            return node
+
+        pending = self.connecting.get(ipa)
+        if pending is None:
+            pending = asyncio.ensure_future(asyncio.wait_for(self.connect(ipa), self.connect_timeout))
+            self.connecting[ipa] = pending
+            pending.add_done_callback(partial(self._connect_done, ipa))
+        # a caller giving up must not cancel the handshake others are waiting on
+        await asyncio.shield(pending)
+
+        node = self.connections.get(ipa)
+        if node is None:
+            raise ConnectionResetError(f"{ipa} disconnected right after connecting")
+        return node
+
+    def _connect_done(self, ipa: str, future: asyncio.Future):
+        del self.connecting[ipa]
+        # retrieved here as every waiter may have timed out already
+        if not future.cancelled():
+            future.exception()
+
+    def enqueue(self, ipa: str, record: bytes):
+        """
+        Send record once ipa is connected without waiting for the connection
+
+        Records are dropped if the peer can't be reached within connect_timeout.
+
+        :raises BlockingIOError: if MAX_PENDING records already wait for ipa
+        """
+
+        queue = self.pending.get(ipa)
+        if queue is not None:
+            if len(queue) >= MAX_PENDING:
+                raise BlockingIOError(f"{ipa}: too many records waiting for the connection")
+            queue.append(record)
+            return
+
+        self.pending[ipa] = [record]
+        self._spawn(self._deliver(ipa))
+
+    async def _deliver(self, ipa: str):
+        try:
+            node = await self.get(ipa)
+        except (OSError, RuntimeError, asyncio.TimeoutError) as e:
+            dropped = self.pending.pop(ipa, [])
+            logger.warning("%s: dropped %s records, couldn't connect: %r", ipa, len(dropped), e)
+            return
+
+        records = self.pending.pop(ipa, [])
+        try:
+            await node.send_messages(*records)
+        except (OSError, ValueError) as e:
+            logger.warning("%s: dropped %s records: %r", ipa, len(records), e)
+
+    def _spawn(self, coro):
+        task = asyncio.ensure_future(coro)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def maintain(self):
+        """
+        Close idle and dead connections, probe and heartbeat quiet ones, forever
+        """
+
+        periods = [self.idle_timeout]
+        if self.receive_deadline is None:
+            periods.append(self.keepalive_interval)
+        else:
+            periods.append(self.receive_deadline)
+        if self.heartbeat is not None:
+            periods.append(self.heartbeat_interval)
+        while True:
+            await asyncio.sleep(min(periods) / 2)
+            # the clock connections record their traffic by
+            self.check(asyncio.get_event_loop().time())
+
+    def check(self, now: float):
+        for ipa, node in list(self.connections.items()):
+            if self.receive_deadline is not None and now - node.last_received > self.receive_deadline:
+                logger.info("%s: dropping connection silent for %.0fs", ipa, now - node.last_received)
+                node.abort()
+                self.remove(ipa, node)
+                continue
+            if now - node.last_active > self.idle_timeout and not self.pinned(ipa):
+                logger.debug("%s: closing idle connection", ipa)
+                node.close()
+                self.remove(ipa, node)
+                continue
+
+            # the deadline would close a silent connection before the probe could
+            if (self.receive_deadline is None and now - node.last_received > self.keepalive_interval
+                    and ipa not in self._probing):
+                self._probing.add(ipa)
+                self._spawn(self._probe(ipa, node))
+            if self.heartbeat is not None and now - node.last_sent > self.heartbeat_interval:
+                self._spawn(self._heartbeat(ipa, node))
+
+    async def _probe(self, ipa: str, node: 'Node'):
+        try:
+            await self.probe(node)
+        except (OSError, asyncio.TimeoutError) as e:
+            logger.info("%s: closing unresponsive connection: %r", ipa, e)
+            node.close()
+            self.remove(ipa, node)
+        finally:
+            self._probing.discard(ipa)
+
+    async def _heartbeat(self, ipa: str, node: 'Node'):
+        try:
+            await self.heartbeat(node)
+        except OSError as e:
+            logger.debug("%s: couldn't send a heartbeat: %r", ipa, e)
+
+    def close(self):
+        for task in self._tasks:
+            task.cancel()
+        self.pending.clear()
@@ -0,0 +1,275 @@
+"""
+Binary encoding of control message payloads
+
+Every payload starts with a version byte. Peers travel as fixed size records
+of the raw ed25519 key followed by a 16 byte address, IPv4 addresses are
+stored IPv4-mapped::
+
+    version(1) | count(4) | (key(32) | address(16)) * count
+
+Known peers entries add an 8 byte version to each record, digests of the known
+peers table are sent as ``count`` 8 byte integers after the same header.
+
+A node decodes every version it has a decoder for, so the format can be
+extended without cutting off nodes that still speak an older one.
+
+Requests and their replies carry a 4 byte request id in front of the payload,
+flooded messages a 36 byte gossip id. Route advertisements are
+``(key(32) | hops(1)) * count`` after the header, relayed messages start with
+the raw keys of their destination and source, a hop limit and their kind.
+File offers and chunks start with a 16 byte transfer id and an 8 byte size or
+offset.
+"""
+
+from .util import ssh_to_raw, raw_to_ssh
+from .peertable import PeerRecord
+
+from typing import (Iterable, List, Tuple)
+import socket
+import struct
+
+
+PROTOCOL_VERSION = 1
+
+_COUNT = struct.Struct('>I')
+_PEER = struct.Struct('>32s16s')
+_V4_MAPPED = b'\x00' * 10 + b'\xff\xff'
+
+
+def pack_address(ipa: str) -> bytes:
+    if ':' in ipa:
+        return socket.inet_pton(socket.AF_INET6, ipa)
+    return _V4_MAPPED + socket.inet_pton(socket.AF_INET, ipa)
+
+
+def unpack_address(packed: bytes) -> str:
+    if packed[:12] == _V4_MAPPED:
+        return socket.inet_ntop(socket.AF_INET, packed[12:])
+    return socket.inet_ntop(socket.AF_INET6, packed)
+
+
+def _check_version(payload: bytes, decoders: dict) -> int:
+    if len(payload) < 1 + _COUNT.size:
+        raise ValueError("truncated payload")
+    version = payload[0]
+    if version not in decoders:
+        raise ValueError(f"unsupported protocol version {version}")
+    return version
+
+
+def encode_peers(peers: Iterable[Tuple[str, bytes]]) -> bytes:
+    """
+    Encode (ipa, OpenSSH public key) pairs
+
+    :returns: the payload, prefixed with PROTOCOL_VERSION
+    """
+
+    records = [_PEER.pack(ssh_to_raw(kbytes), pack_address(ipa)) for ipa, kbytes in peers]
+    return b''.join((bytes((PROTOCOL_VERSION,)), _COUNT.pack(len(records)), *records))
+
+
+def _decode_peers_v1(payload: bytes) -> List[Tuple[str, bytes]]:
+    count, = _COUNT.unpack_from(payload, 1)
+    body = memoryview(payload)[1 + _COUNT.size:]
+    if len(body) != count * _PEER.size:
+        raise ValueError(f"expected {count} peers, payload has {len(body)} bytes")
+
+    return [(unpack_address(packed), raw_to_ssh(raw)) for raw, packed in _PEER.iter_unpack(body)]
+
+
+_PEERS_DECODERS = {
+    1: _decode_peers_v1,
+}
+
+
+def decode_peers(payload: bytes) -> List[Tuple[str, bytes]]:
+    """
+    Decode a payload made by encode_peers
+
+    :raises ValueError: if the payload is malformed or of an unknown version
+    """
+
+    return _PEERS_DECODERS[_check_version(payload, _PEERS_DECODERS)](payload)
+
+
+_RECORD = struct.Struct('>32s16sQ')
+
+
+def encode_peer_records(records: Iterable[PeerRecord]) -> bytes:
+    """
+    Encode versioned known peers entries, a peer followed by its 8 byte version
+    """
+
+    packed = [_RECORD.pack(ssh_to_raw(kbytes), pack_address(ipa), version) for kbytes, ipa, version in records]
+    return b''.join((bytes((PROTOCOL_VERSION,)), _COUNT.pack(len(packed)), *packed))
+
+
+def _decode_peer_records_v1(payload: bytes) -> List[PeerRecord]:
+    count, = _COUNT.unpack_from(payload, 1)
+    body = memoryview(payload)[1 + _COUNT.size:]
+    if len(body) != count * _RECORD.size:
+        raise ValueError(f"expected {count} records, payload has {len(body)} bytes")
+
+    return [PeerRecord(raw_to_ssh(raw), unpack_address(packed), version)
+            for raw, packed, version in _RECORD.iter_unpack(body)]
+
+
+_RECORDS_DECODERS = {
+    1: _decode_peer_records_v1,
+}
+
+
+def decode_peer_records(payload: bytes) -> List[PeerRecord]:
+    """
+    :raises ValueError: if the payload is malformed or of an unknown version
+    """
+
+    return _RECORDS_DECODERS[_check_version(payload, _RECORDS_DECODERS)](payload)
+
+
+_DIGEST = struct.Struct('>Q')
+
+
+def encode_digests(digests: List[int]) -> bytes:
+    return b''.join((bytes((PROTOCOL_VERSION,)), _COUNT.pack(len(digests)), *map(_DIGEST.pack, digests)))
+
+
+def _decode_digests_v1(payload: bytes) -> List[int]:
+    count, = _COUNT.unpack_from(payload, 1)
+    body = memoryview(payload)[1 + _COUNT.size:]
+    if len(body) != count * _DIGEST.size:
+        raise ValueError(f"expected {count} digests, payload has {len(body)} bytes")
+
+    return [digest for digest, in _DIGEST.iter_unpack(body)]
+
+
+_DIGESTS_DECODERS = {
+    1: _decode_digests_v1,
+}
+
+
+def decode_digests(payload: bytes) -> List[int]:
+    return _DIGESTS_DECODERS[_check_version(payload, _DIGESTS_DECODERS)](payload)
+
+
+_REQUEST_ID = struct.Struct('>I')
+
+
+def encode_request(request_id: int, payload: bytes = b'') -> bytes:
+    """
+    Prefix a request or reply payload with the id correlating the two
+    """
+
+    return _REQUEST_ID.pack(request_id) + payload
+
+
+def decode_request(body: bytes) -> Tuple[int, bytes]:
+    if len(body) < _REQUEST_ID.size:
+        raise ValueError("missing request id")
+    request_id, = _REQUEST_ID.unpack_from(body)
+    return request_id, body[_REQUEST_ID.size:]
+
+
+_GOSSIP = struct.Struct('>32sI')
+
+
+def encode_gossip(origin: bytes, seq: int, payload: bytes) -> bytes:
+    """
+    Prefix a flooded payload with its id: the raw key of the node it started from and that node's sequence number
+    """
+
+    return _GOSSIP.pack(origin, seq) + payload
+
+
+def decode_gossip(body: bytes) -> Tuple[Tuple[bytes, int], bytes]:
+    """
+    :returns: the (origin, seq) message id and the payload
+    """
+
+    if len(body) < _GOSSIP.size:
+        raise ValueError("missing gossip id")
+    origin, seq = _GOSSIP.unpack_from(body)
+    return (origin, seq), body[_GOSSIP.size:]
+
+
+_ROUTE = struct.Struct('>32sB')
+
+
+def encode_routes(routes: Iterable[Tuple[bytes, int]]) -> bytes:
+    """
+    Encode a distance vector, (raw key, hop count) pairs
+    """
+
+    packed = [_ROUTE.pack(raw, hops) for raw, hops in routes]
+    return b''.join((bytes((PROTOCOL_VERSION,)), _COUNT.pack(len(packed)), *packed))
+
+
+def _decode_routes_v1(payload: bytes) -> List[Tuple[bytes, int]]:
+    count, = _COUNT.unpack_from(payload, 1)
+    body = memoryview(payload)[1 + _COUNT.size:]
+    if len(body) != count * _ROUTE.size:
+        raise ValueError(f"expected {count} routes, payload has {len(body)} bytes")
+
+    return list(_ROUTE.iter_unpack(body))
+
+
+_ROUTES_DECODERS = {
+    1: _decode_routes_v1,
+}
+
+
+def decode_routes(payload: bytes) -> List[Tuple[bytes, int]]:
+    return _ROUTES_DECODERS[_check_version(payload, _ROUTES_DECODERS)](payload)
+
+
+_ROUTED = struct.Struct('>32s32sBB')
+
+
+def encode_routed(dest: bytes, src: bytes, ttl: int, kind: int, body: bytes) -> bytes:
+    """
+    Wrap a message relayed through other nodes: raw keys of its destination and source, hops left and its kind
+    """
+
+    return _ROUTED.pack(dest, src, ttl, kind) + body
+
+
+def decode_routed(body: bytes) -> Tuple[bytes, bytes, int, int, bytes]:
+    if len(body) < _ROUTED.size:
+        raise ValueError("truncated routed message")
+    return (*_ROUTED.unpack_from(body), body[_ROUTED.size:])
+
+
+_OFFER = struct.Struct('>16sQ')
+
+
+def encode_offer(transfer_id: bytes, size: int, name: str) -> bytes:
+    """
+    Offer a file: its transfer id, size in bytes and utf-8 name
+    """
+
+    return _OFFER.pack(transfer_id, size) + name.encode()
+
+
+def decode_offer(body: bytes) -> Tuple[bytes, int, str]:
+    if len(body) < _OFFER.size:
+        raise ValueError("truncated file offer")
+    return (*_OFFER.unpack_from(body), body[_OFFER.size:].decode())
+
+
+_CHUNK = struct.Struct('>16sQ')
+
+
+def encode_chunk(transfer_id: bytes, offset: int, data: bytes = b'') -> bytes:
+    """
+    Wrap file data starting at offset, without data it acknowledges everything before offset
+
+    An acknowledgement carrying data tells the sender the receiver gave up, the data is why.
+    """
+
+    return _CHUNK.pack(transfer_id, offset) + data
+
+
+def decode_chunk(body: bytes) -> Tuple[bytes, int, bytes]:
+    if len(body) < _CHUNK.size:
+        raise ValueError("truncated file chunk")
+    return (*_CHUNK.unpack_from(body), body[_CHUNK.size:])
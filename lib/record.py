@@ -0,0 +1,76 @@
+"""
+AEAD record layer protecting messages after the handshake
+
+A ``RecordCipher`` keeps one AEAD object per key. Nonces are a 4 byte
+direction tag followed by an 8 byte record counter, so the two ends of a
+connection never produce the same nonce. After ``rekey_records`` records or
+``rekey_bytes`` bytes the key is ratcheted forward through HKDF and the old
+one dropped: a compromised key exposes at most the current epoch.
+"""
+
+from cryptography.hazmat.backends import default_backend
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.ciphers.aead import ChaCha20Poly1305
+from cryptography.hazmat.primitives.kdf.hkdf import HKDF
+
+import struct
+
+
+KEY_SIZE = 32
+TAG_SIZE = 16
+REKEY_RECORDS = 1024
+REKEY_BYTES = 16 * 1024 * 1024
+
+_NONCE = struct.Struct('>IQ')
+
+
+def derive_key(key_material: bytes, info: bytes) -> bytes:
+    return HKDF(
+        algorithm=hashes.SHA256(),
+        length=KEY_SIZE,
+        salt=None,
+        info=info,
+        backend=default_backend()
+    ).derive(key_material)
+
+
+class RecordCipher:
+    """
+    Seals and opens records of a single key chain, in order
+    """
+
+    def __init__(self, key: bytes, aead=ChaCha20Poly1305,
+                 rekey_records: int = REKEY_RECORDS, rekey_bytes: int = REKEY_BYTES):
+        self.aead = aead
+        self.rekey_records = rekey_records
+        self.rekey_bytes = rekey_bytes
+        self.epoch = 0
+        self._set_key(key)
+
+    def _set_key(self, key: bytes):
+        self._key = key
+        self._cipher = self.aead(key)
+        self._counter = 0
+        self._bytes = 0
+
+    def _advance(self, nbytes: int):
+        self._counter += 1
+        self._bytes += nbytes
+        if self._counter >= self.rekey_records or self._bytes >= self.rekey_bytes:
+            self._set_key(derive_key(self._key, b'meshchat rekey'))
+            self.epoch += 1
+
+    def seal(self, plaintext: bytes, direction: int) -> bytes:
+        record = self._cipher.encrypt(_NONCE.pack(direction, self._counter), plaintext, None)
+        self._advance(len(record))
+        return record
+
+    def open(self, record: bytes, direction: int) -> bytes:
+        """
+        :raises cryptography.exceptions.InvalidTag: if the record was forged, reordered or corrupted
+        """
+
+        plaintext = self._cipher.decrypt(_NONCE.pack(direction, self._counter), record, None)
+        self._advance(len(record))
+        return plaintext
+
@@ -0,0 +1,207 @@
+"""
+Distance-vector routing between nodes that aren't directly connected
+
+Every node advertises to each connected peer the hop count of every node it
+can reach, itself at 0. A full advertisement replaces everything learned from
+that peer before, so a missing entry withdraws the route. Routes through the
+peer an advertisement goes to are sent as unreachable (poisoned reverse) and
+hop counts stop at ``MAX_HOPS``, which keeps loops from counting to infinity.
+
+Relayed messages are end-to-end encrypted with an ``EndToEnd`` cipher whose
+key both ends agree on through hellos relayed like any other message. A node
+that can't open one answers with the message's reference, its counter and
+tag. Only the sender and the relays on the path know it, so no other node can
+make the sender drop a working session.
+"""
+
+from .record import (derive_key, TAG_SIZE)
+
+from typing import (Callable, Deque, Dict, Iterable, List, NamedTuple, Optional, Set, Tuple)
+from collections import deque
+import struct
+import time
+
+from cryptography.exceptions import InvalidTag
+from cryptography.hazmat.primitives.ciphers.aead import ChaCha20Poly1305
+
+
+# hop count of an unreachable node
+MAX_HOPS = 16
+# hops a relayed message may take before it's dropped
+ROUTED_TTL = MAX_HOPS
+# how far behind the newest counter a relayed message may arrive
+REPLAY_WINDOW = 1024
+# references of the latest messages sealed, a peer that couldn't open one of them may ask to start over
+SENT_REFERENCES = 64
+# seconds an end-to-end session may go unused before it's dropped
+ROUTED_SESSION_IDLE = 600.0
+
+# kinds of relayed messages
+ROUTED_HELLO = 0
+ROUTED_HELLO_REPLY = 1
+ROUTED_DATA = 2
+# the destination had no session for a data message, the sender should start over
+ROUTED_UNKNOWN = 3
+
+_NONCE = struct.Struct('>IQ')
+_COUNTER = struct.Struct('>Q')
+
+
+class Route(NamedTuple):
+    next_hop: str
+    hops: int
+
+
+class RoutingTable:
+    """
+    Routes to nodes by raw public key, through the addresses of connected peers
+    """
+
+    def __init__(self, own_raw: bytes):
+        self.own_raw = own_raw
+        # dest -> next hop -> hops, as last advertised by each next hop
+        self._learned: Dict[bytes, Dict[str, int]] = {}
+        # shortest route to every reachable dest, recomputed on change
+        self._best: Dict[bytes, Route] = {}
+
+    def __len__(self) -> int:
+        return len(self._best)
+
+    def __contains__(self, dest: bytes) -> bool:
+        return dest in self._best
+
+    def route(self, dest: bytes) -> Optional[Route]:
+        return self._best.get(dest)
+
+    def _recompute(self, dests: Iterable[bytes]) -> bool:
+        changed = False
+        for dest in dests:
+            via = self._learned.get(dest)
+            best = None
+            if via:
+                # ties go to the lowest address, so both ends of a comparison agree
+                next_hop, hops = min(via.items(), key=lambda item: (item[1], item[0]))
+                best = Route(next_hop, hops)
+            if best != self._best.get(dest):
+                changed = True
+                if best is None:
+                    del self._best[dest]
+                else:
+                    self._best[dest] = best
+        return changed
+
+    def update(self, next_hop: str, advertised: Iterable[Tuple[bytes, int]]) -> bool:
+        """
+        Replace the routes through next_hop with the ones it advertised
+
+        :returns: True if any shortest route changed
+        """
+
+        routes = {}
+        for dest, hops in advertised:
+            if dest != self.own_raw and hops + 1 < MAX_HOPS:
+                routes[dest] = hops + 1
+
+        # only the dests whose hop count through next_hop moved need a new shortest route
+        touched = set()
+        for dest, via in self._learned.items():
+            if next_hop in via and dest not in routes:
+                del via[next_hop]
+                touched.add(dest)
+        for dest, hops in routes.items():
+            via = self._learned.setdefault(dest, {})
+            if via.get(next_hop) != hops:
+                via[next_hop] = hops
+                touched.add(dest)
+
+        changed = self._recompute(touched)
+        for dest in touched:
+            if not self._learned[dest]:
+                del self._learned[dest]
+        return changed
+
+    def remove_hop(self, next_hop: str) -> bool:
+        """
+        Drop every route through a peer that disconnected
+
+        :returns: True if any shortest route changed
+        """
+
+        return self.update(next_hop, ())
+
+    def advertisement(self, to: str) -> List[Tuple[bytes, int]]:
+        """
+        The distance vector for the peer at address to, ourselves included
+        """
+
+        routes = [(self.own_raw, 0)]
+        for dest, route in self._best.items():
+            routes.append((dest, MAX_HOPS if route.next_hop == to else route.hops))
+        return routes
+
+
+class EndToEnd:
+    """
+    AEAD between two nodes over relays that may drop or reorder messages
+
+    Unlike the record layer every message carries its own counter. Replays
+    are caught by remembering the counters opened within REPLAY_WINDOW of the
+    newest one, anything older is rejected.
+    """
+
+    def __init__(self, shared: bytes, is_initiator: bool, clock: Callable[[], float] = time.monotonic):
+        initiator_key = derive_key(shared, b'meshchat routed initiator')
+        responder_key = derive_key(shared, b'meshchat routed responder')
+
+        self.direction = 0 if is_initiator else 1
+        self._send = ChaCha20Poly1305(initiator_key if is_initiator else responder_key)
+        self._recv = ChaCha20Poly1305(responder_key if is_initiator else initiator_key)
+        self._counter = 0
+        self._highest = -1
+        self._opened: Set[int] = set()
+        self._sent: Deque[bytes] = deque(maxlen=SENT_REFERENCES)
+        self.clock = clock
+        self.last_used = clock()
+
+    @staticmethod
+    def reference(message: bytes) -> bytes:
+        """
+        Counter and tag of a sealed message, what a peer that couldn't open it sends back
+        """
+
+        return message[:_COUNTER.size] + message[-TAG_SIZE:]
+
+    def seal(self, plaintext: bytes) -> bytes:
+        counter = self._counter
+        self._counter += 1
+        message = _COUNTER.pack(counter) + self._send.encrypt(_NONCE.pack(self.direction, counter), plaintext, None)
+        self._sent.append(self.reference(message))
+        self.last_used = self.clock()
+        return message
+
+    def sealed(self, reference: bytes) -> bool:
+        """
+        Whether reference is one of the latest messages sealed here
+        """
+
+        return reference in self._sent
+
+    def open(self, message: bytes) -> bytes:
+        """
+        :raises cryptography.exceptions.InvalidTag: if the message was forged or replayed
+        """
+
+        if len(message) < _COUNTER.size:
+            raise InvalidTag()
+        counter, = _COUNTER.unpack_from(message)
+        if counter + REPLAY_WINDOW <= self._highest or counter in self._opened:
+            raise InvalidTag()
+
+        plaintext = self._recv.decrypt(_NONCE.pack(1 - self.direction, counter), message[_COUNTER.size:], None)
+        self.last_used = self.clock()
+        self._opened.add(counter)
+        if counter > self._highest:
+            self._highest = counter
+            if len(self._opened) > 2 * REPLAY_WINDOW:
+                self._opened = {c for c in self._opened if c + REPLAY_WINDOW > counter}
+        return plaintext
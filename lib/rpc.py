@@ -0,0 +1,70 @@
+"""
+Correlation of control requests with their replies
+"""
+
+from typing import (Dict, Tuple)
+import asyncio
+
+
+REQUEST_TIMEOUT = 10.0
+
+
+class RequestTracker:
+    """
+    Outstanding requests of one connection, each waiting on its own future
+    """
+
+    def __init__(self):
+        self._next_id = 0
+        self._pending: Dict[int, asyncio.Future] = {}
+
+    def __len__(self) -> int:
+        return len(self._pending)
+
+    def new_request(self) -> Tuple[int, asyncio.Future]:
+        request_id = self._next_id
+        self._next_id = (self._next_id + 1) & 0xFFFFFFFF
+
+        future = asyncio.get_event_loop().create_future()
+        self._pending[request_id] = future
+        return request_id, future
+
+    async def wait(self, request_id: int, future: asyncio.Future, timeout: float = REQUEST_TIMEOUT) -> bytes:
+        """
+        Wait for the reply to request_id
+
+        :raises asyncio.TimeoutError: if no reply arrived within timeout seconds
+        """
+
+        try:
+            return await asyncio.wait_for(future, timeout)
+        finally:
+            self._pending.pop(request_id, None)
+
+    def discard(self, request_id: int):
+        """
+        Forget a request that won't be waited for, e.g. because it couldn't be sent
+        """
+
+        future = self._pending.pop(request_id, None)
+        if future is not None:
+            future.cancel()
+
+    def resolve(self, request_id: int, payload: bytes) -> bool:
+        """
+        Hand a reply to its waiter
+
+        :returns: False if nothing waits for request_id, e.g. it timed out
+        """
+
+        future = self._pending.pop(request_id, None)
+        if future is None or future.done():
+            return False
+        future.set_result(payload)
+        return True
+
+    def cancel_all(self, exc: Exception):
+        for future in self._pending.values():
+            if not future.done():
+                future.set_exception(exc)
+        self._pending.clear()
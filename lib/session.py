@@ -0,0 +1,103 @@
+"""
+Resumption secrets of past sessions, so reconnecting peers skip the full handshake
+
+Both ends of a finished handshake derive the same ticket id and resumption
+secret from the session's shared key and remember them here, the ticket under
+its id and under the peer's address. A node dialing an address it has a ticket
+for offers it; if the other end still holds the ticket both mix the secret with
+a fresh ephemeral exchange, authenticated by the secret instead of signatures.
+Tickets are single use, every resumed session leaves a new one behind.
+"""
+
+from .record import derive_key
+from .compression import CODEC_NONE
+
+from typing import (Callable, Dict, NamedTuple, Optional)
+from collections import OrderedDict
+import time
+
+
+TICKET_SIZE = 16
+SESSION_LIFETIME = 3600.0
+SESSION_CAPACITY = 1024
+
+
+class Session(NamedTuple):
+    ticket: bytes
+    peer_kbytes: bytes
+    secret: bytes
+    expiry: float
+    # protocol version and compression codec the session was set up with
+    version: int
+    codec: int = CODEC_NONE
+
+
+class SessionCache:
+    """
+    Unexpired resumable sessions by ticket, the oldest dropped beyond capacity
+    """
+
+    def __init__(self, lifetime: float = SESSION_LIFETIME, capacity: int = SESSION_CAPACITY,
+                 clock: Callable[[], float] = time.monotonic):
+        self.lifetime = lifetime
+        self.capacity = capacity
+        self.clock = clock
+        self._sessions: 'OrderedDict[bytes, Session]' = OrderedDict()
+        self._tickets: Dict[str, bytes] = {}
+        self._addresses: Dict[bytes, str] = {}
+
+    def __len__(self) -> int:
+        return len(self._sessions)
+
+    def store(self, ipa: str, peer_kbytes: bytes, shared: bytes, version: int, codec: int = CODEC_NONE) -> Session:
+        """
+        Remember the session with ipa whose handshake produced shared
+        """
+
+        ticket = derive_key(shared, b'meshchat ticket')[:TICKET_SIZE]
+        session = Session(ticket, peer_kbytes, derive_key(shared, b'meshchat resumption'),
+                          self.clock() + self.lifetime, version, codec)
+
+        old = self._tickets.get(ipa)
+        if old is not None:
+            self._drop(old)
+        self._sessions[ticket] = session
+        self._tickets[ipa] = ticket
+        self._addresses[ticket] = ipa
+
+        while len(self._sessions) > self.capacity:
+            self._drop(next(iter(self._sessions)))
+        return session
+
+    def _drop(self, ticket: bytes):
+        self._sessions.pop(ticket, None)
+        ipa = self._addresses.pop(ticket, None)
+        if ipa is not None and self._tickets.get(ipa) == ticket:
+            del self._tickets[ipa]
+
+    def get(self, ticket: bytes) -> Optional[Session]:
+        """
+        Return the session of ticket without using it up, None if it's unknown or expired
+        """
+
+        session = self._sessions.get(ticket)
+        if session is None or session.expiry <= self.clock():
+            return None
+        return session
+
+    def take(self, ticket: bytes) -> Optional[Session]:
+        """
+        Remove and return the session of ticket, None if it's unknown or expired
+        """
+
+        session = self.get(ticket)
+        self._drop(ticket)
+        return session
+
+    def take_for(self, ipa: str) -> Optional[Session]:
+        """
+        Remove and return the latest session with ipa, to be offered when dialing it
+        """
+
+        ticket = self._tickets.get(ipa)
+        return None if ticket is None else self.take(ticket)
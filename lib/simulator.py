@@ -0,0 +1,243 @@
+"""
+A mesh of engines in one process, over a simulated network in virtual time
+
+Every engine is a real :class:`AsyncMeshchat` with its own key pair,
+connected to the others through a :class:`MemoryNetwork` and driven by one
+:class:`VirtualClockLoop`. Handshakes, gossip and the periodic tasks all run
+as they would on a real network, only waiting is free: a run costs the CPU
+time of the work the engines do, whatever the latencies and timeouts.
+
+A run joins the nodes one after another, each through a random node that
+joined before it, waits for every node to know every other and then times
+broadcasts from the first node. Times in the report are virtual seconds.
+Given the same seed, key pairs, delays and the engines' random choices repeat,
+and the engines stamp their known peers with the loop's clock instead of the
+wall clock, so a run repeats exactly.
+"""
+
+from . import util as cu
+from .engine import (AsyncMeshchat, MESHCHAT_PORT)
+from .transport import (MemoryNetwork, LinkProfile, VirtualClockLoop)
+
+from typing import (Dict, List, NamedTuple, Optional, Sequence)
+import asyncio
+import os
+import random
+import tempfile
+import time
+
+from cryptography.hazmat.primitives.asymmetric import ed25519
+
+import logging
+
+
+logger = logging.getLogger(__name__)
+
+
+# virtual seconds between two nodes joining
+JOIN_INTERVAL = 0.05
+# how long, in virtual seconds, the mesh may take to converge before the run gives up
+CONVERGENCE_TIMEOUT = 600.0
+POLL_INTERVAL = 0.01
+
+
+class Distribution(NamedTuple):
+    count: int
+    mean: float
+    p50: float
+    p99: float
+    max: float
+
+    @classmethod
+    def of(cls, values: Sequence[float]) -> 'Distribution':
+        ordered = sorted(values)
+        if not ordered:
+            return cls(0, 0.0, 0.0, 0.0, 0.0)
+
+        def rank(p: int) -> float:
+            return ordered[min(len(ordered) - 1, max(0, -(-p * len(ordered) // 100) - 1))]
+
+        return cls(len(ordered), sum(ordered) / len(ordered), rank(50), rank(99), ordered[-1])
+
+
+class SimulationReport(NamedTuple):
+    nodes: int
+    # nodes whose join_network failed
+    failed_joins: int
+    join_seconds: Distribution
+    # from the last join to every node knowing all others, None if that never happened
+    membership_convergence: Optional[float]
+    # from each broadcast to its arrival at the last node it reached
+    broadcast_seconds: Distribution
+    # fraction of the other nodes each broadcast reached
+    broadcast_reach: float
+    # frames over the whole run, and the ones caused by each broadcast
+    messages: int
+    bytes: int
+    messages_per_broadcast: float
+    # frames sent and received by each node, and the connections each opened or accepted
+    load: Distribution
+    connections: Distribution
+    virtual_seconds: float
+    real_seconds: float
+
+    def to_dict(self) -> dict:
+        return {name: value._asdict() if isinstance(value, Distribution) else value
+                for name, value in self._asdict().items()}
+
+
+def _address(i: int) -> str:
+    i += 1
+    return f"10.{(i >> 16) & 0xFF}.{(i >> 8) & 0xFF}.{i & 0xFF}"
+
+
+class Simulation:
+    """
+    nodes engines on a simulated network, configured by the remaining keyword arguments
+    """
+
+    def __init__(self, nodes: int, link: LinkProfile = LinkProfile(), seed: int = 0, **engine_kwargs):
+        if nodes < 2:
+            raise ValueError("a mesh needs at least two nodes")
+        self.nodes = nodes
+        self.seed = seed
+        self.rng = random.Random(seed)
+        self.network = MemoryNetwork(link, random.Random(self.rng.random()))
+        self.engine_kwargs = engine_kwargs
+        self.engines: List[AsyncMeshchat] = []
+
+    def run(self, join_interval: float = JOIN_INTERVAL, broadcasts: int = 10) -> SimulationReport:
+        """
+        Join, converge and broadcast on a fresh virtual clock loop
+        """
+
+        loop = VirtualClockLoop()
+        asyncio.set_event_loop(loop)
+        # the engines draw from the global generator
+        random.seed(self.seed)
+        start = time.perf_counter()
+        try:
+            with tempfile.TemporaryDirectory() as directory:
+                report = loop.run_until_complete(self._run(directory, join_interval, broadcasts))
+        finally:
+            # connections still closing when the engines stopped, cancelling some may start others
+            tasks = asyncio.all_tasks(loop)
+            while tasks:
+                for task in tasks:
+                    task.cancel()
+                loop.run_until_complete(asyncio.gather(*tasks, return_exceptions=True))
+                tasks = asyncio.all_tasks(loop)
+            loop.close()
+            asyncio.set_event_loop(None)
+        return report._replace(real_seconds=time.perf_counter() - start)
+
+    def _create_engines(self, directory: str):
+        keys = [ed25519.Ed25519PrivateKey.from_private_bytes(self.rng.randbytes(32)) for _ in range(self.nodes)]
+        identities = []
+        # one trusted file for all, every node trusts every other
+        loop = asyncio.get_event_loop()
+        trusted = cu.KeyStore(os.path.join(directory, "trusted"), refresh=CONVERGENCE_TIMEOUT, clock=loop.time)
+        for key in keys:
+            identities.append(cu.Identity(key, trusted))
+            cu.write_trusted_key(identities[-1].public_bytes, directory)
+
+        engine_kwargs = {'clock': loop.time, **self.engine_kwargs}
+        self.engines = [AsyncMeshchat(host=_address(i), port=MESHCHAT_PORT, identity=identity,
+                                      transport=self.network.transport(), **engine_kwargs)
+                        for i, identity in enumerate(identities)]
+
+    async def _run(self, directory: str, join_interval: float, broadcasts: int) -> SimulationReport:
+        loop = asyncio.get_event_loop()
+        self._create_engines(directory)
+        engines = self.engines
+        await engines[0].start_network()
+
+        try:
+            join_seconds = await self._join_all(join_interval)
+            failed = self.nodes - 1 - len(join_seconds)
+
+            joined = loop.time()
+            convergence = await self._wait_for_members()
+            membership = convergence - joined if convergence is not None else None
+
+            before = self._traffic()[0]
+            broadcast_seconds, reached = await self._broadcast(broadcasts)
+            per_broadcast = (self._traffic()[0] - before) / broadcasts if broadcasts else 0.0
+        finally:
+            await asyncio.gather(*(engine.stop() for engine in engines), return_exceptions=True)
+
+        messages, size = self._traffic()
+        load = self.network.load
+        return SimulationReport(
+            nodes=self.nodes,
+            failed_joins=failed,
+            join_seconds=Distribution.of(join_seconds),
+            membership_convergence=membership,
+            broadcast_seconds=Distribution.of(broadcast_seconds),
+            broadcast_reach=reached,
+            messages=messages,
+            bytes=size,
+            messages_per_broadcast=per_broadcast,
+            load=Distribution.of([load[e.host].writes_sent + load[e.host].writes_received for e in engines]),
+            connections=Distribution.of([load[e.host].connections for e in engines]),
+            virtual_seconds=loop.time(),
+            real_seconds=0.0,
+        )
+
+    async def _join_all(self, join_interval: float) -> List[float]:
+        loop = asyncio.get_event_loop()
+        durations = []
+
+        async def join(i: int):
+            await asyncio.sleep(i * join_interval)
+            inviter = self.engines[self.rng.randrange(i)]
+            start = loop.time()
+            try:
+                await self.engines[i].join_network(inviter.host)
+            except (OSError, asyncio.TimeoutError) as e:
+                logger.warning("%s couldn't join through %s: %r", self.engines[i].host, inviter.host, e)
+                return
+            durations.append(loop.time() - start)
+
+        await asyncio.gather(*(join(i) for i in range(1, self.nodes)))
+        return durations
+
+    async def _wait_for_members(self) -> Optional[float]:
+        """
+        :returns: the time every node knew all others, None on timeout
+        """
+
+        loop = asyncio.get_event_loop()
+        deadline = loop.time() + CONVERGENCE_TIMEOUT
+        while loop.time() < deadline:
+            # only trusted keys get in, all of them are members. ours is there once a peer told us about it
+            if all(len(engine.known_peers) + (engine.public_bytes not in engine.known_peers) >= self.nodes
+                   for engine in self.engines):
+                return loop.time()
+            await asyncio.sleep(POLL_INTERVAL)
+        return None
+
+    async def _broadcast(self, number: int):
+        loop = asyncio.get_event_loop()
+        arrivals: Dict[str, List[float]] = {}
+        for engine in self.engines:
+            engine.bind(on_broadcast=lambda _, text: arrivals.setdefault(text, []).append(loop.time()))
+
+        others = self.nodes - 1
+        seconds, reached = [], 0
+        for i in range(number):
+            text = f"broadcast {i}"
+            start = loop.time()
+            await self.engines[0].broadcast(text)
+            deadline = start + CONVERGENCE_TIMEOUT
+            while len(arrivals.get(text, ())) < others and loop.time() < deadline:
+                await asyncio.sleep(POLL_INTERVAL)
+            times = arrivals.get(text, [])
+            reached += len(times)
+            if times:
+                seconds.append(max(times) - start)
+        return seconds, reached / (others * number) if number else 0.0
+
+    def _traffic(self):
+        loads = self.network.load.values()
+        return sum(load.writes_sent for load in loads), sum(load.bytes_sent for load in loads)
@@ -0,0 +1,42 @@
+import unittest
+import os
+import random
+
+from lib import compression
+from lib.compression import (Compressor, CODEC_NONE, CODEC_ZLIB)
+
+
+class CompressionTest(unittest.TestCase):
+    def test_roundtrip_keeps_small_and_incompressible_messages_raw(self):
+        sender, receiver = Compressor(CODEC_ZLIB), Compressor(CODEC_ZLIB)
+        msgs = [b'hi', b'hello, see you tomorrow morning, thanks for the help with that', os.urandom(500),
+                b'the same line again and again ' * 100]
+        for msg in msgs:
+            self.assertEqual(msg, receiver.decode(sender.encode(msg)))
+
+        # the chat line and the repeated one
+        self.assertEqual(2, sender.sent.compressed)
+        self.assertEqual(4, receiver.received.messages)
+        self.assertGreater(sender.sent.ratio, 1)
+        self.assertEqual(sender.sent.wire_bytes, receiver.received.wire_bytes)
+
+    def test_without_codec_messages_pass_through(self):
+        self.assertEqual(b'x' * 100, Compressor(CODEC_NONE).encode(b'x' * 100))
+
+    def test_rejects_bombs_and_garbage(self):
+        sender, receiver = Compressor(CODEC_ZLIB), Compressor(CODEC_ZLIB, max_size=1000)
+        with self.assertRaises(ValueError):
+            receiver.decode(sender.encode(bytes(100000)))
+        with self.assertRaises(ValueError):
+            receiver.decode(b'\x01' + random.Random(0).randbytes(50))
+        # a complete stream with something after it
+        with self.assertRaises(ValueError):
+            receiver.decode(sender.encode(b'hello ' * 20) + b'extra')
+        with self.assertRaises(ValueError):
+            receiver.decode(b'\x07data')
+
+    def test_negotiation_follows_the_client(self):
+        self.assertEqual(CODEC_ZLIB, compression.negotiate([CODEC_ZLIB], [200, CODEC_ZLIB]))
+        # unregistered ids never win even if both ends list them
+        self.assertEqual(CODEC_NONE, compression.negotiate([200], [200]))
+        self.assertEqual(CODEC_NONE, compression.negotiate([], compression.supported_codecs()))
@@ -0,0 +1,521 @@
+import unittest
+import asyncio
+import os
+import random
+import tempfile
+from unittest import mock
+
+from cryptography.hazmat.primitives.asymmetric import ed25519
+
+from lib import util as cu
+from lib import protocol
+from lib.engine import (AsyncMeshchat, MESSAGE_CODES, MAX_MESSAGE_SIZE, SIGNATURE_SIZE, _broadcast_signed)
+from lib.routing import (ROUTED_TTL, ROUTED_UNKNOWN, ROUTED_SESSION_IDLE)
+from lib.transfer import (IncomingTransfer, CHUNK_SIZE)
+from lib.transport import (MemoryNetwork, LinkProfile, VirtualClockLoop)
+
+
+class EngineTestCase(unittest.TestCase):
+    """
+    Engines on an in-memory network in virtual time, every test starts from a fresh loop
+    """
+
+    loop_factory = VirtualClockLoop
+
+    def setUp(self):
+        self.loop = self.loop_factory()
+        asyncio.set_event_loop(self.loop)
+        self.directory = tempfile.TemporaryDirectory()
+        self.trusted = cu.KeyStore(os.path.join(self.directory.name, "trusted"))
+        self.network = MemoryNetwork(LinkProfile(latency=0.01), random.Random(0))
+        self.engines = []
+
+    def tearDown(self):
+        self.loop.run_until_complete(asyncio.gather(*(e.stop() for e in self.engines), return_exceptions=True))
+        tasks = asyncio.all_tasks(self.loop)
+        while tasks:
+            for task in tasks:
+                task.cancel()
+            self.loop.run_until_complete(asyncio.gather(*tasks, return_exceptions=True))
+            tasks = asyncio.all_tasks(self.loop)
+        self.loop.close()
+        asyncio.set_event_loop(None)
+        self.directory.cleanup()
+
+    def engine(self, host: str, trusted: bool = True, **kwargs) -> AsyncMeshchat:
+        """
+        An engine with a fresh key pair at host, create them all before running any so the trusted file is complete
+        """
+
+        identity = cu.Identity(ed25519.Ed25519PrivateKey.generate(), self.trusted)
+        if trusted:
+            cu.write_trusted_key(identity.public_bytes, self.directory.name)
+        engine = AsyncMeshchat(host=host, identity=identity, transport=self.network.transport(), **kwargs)
+        self.engines.append(engine)
+        return engine
+
+    def run_until(self, coro):
+        return self.loop.run_until_complete(coro)
+
+
+class AsyncMeshchatTest(EngineTestCase):
+    def test_connects_and_delivers_messages_in_order(self):
+        a, b = self.engine('10.0.0.1'), self.engine('10.0.0.2')
+        received = []
+        a.bind(on_peer_connected=lambda node: setattr(node, 'dispatcher', received.append))
+
+        async def main():
+            await a.start_network()
+            await b.start_network()
+            # nothing connected yet, the first message waits for the connection
+            await b.send_message(a.host, 'hello')
+            await b.send_message(a.host, 'again')
+            await asyncio.sleep(1)
+
+        self.run_until(main())
+        self.assertEqual(['hello', 'again'], received)
+        self.assertEqual(a.public_bytes, b.connections[a.host].peer_kbytes)
+        self.assertEqual(b.public_bytes, a.connections[b.host].peer_kbytes)
+
+    def test_oversized_text_is_refused(self):
+        a, b = self.engine('10.0.0.1'), self.engine('10.0.0.2')
+
+        async def main():
+            await a.start_network()
+            await b.pool.get(a.host)
+            with self.assertRaises(ValueError):
+                await b.send_message(a.host, 'x' * (MAX_MESSAGE_SIZE + 1))
+            with self.assertRaises(ValueError):
+                await b.broadcast('x' * (MAX_MESSAGE_SIZE + 1))
+
+        self.run_until(main())
+
+    def test_joiners_learn_the_whole_mesh(self):
+        a, b, c = self.engine('10.0.0.1'), self.engine('10.0.0.2'), self.engine('10.0.0.3')
+        joined = []
+        c.bind(on_joined=joined.append)
+
+        async def main():
+            await a.start_network()
+            await b.join_network(a.host)
+            await c.join_network(a.host)
+            await asyncio.sleep(1)
+
+        self.run_until(main())
+        self.assertEqual([a.host], joined)
+        for engine in (a, b, c):
+            others = {e.public_bytes: e.host for e in (a, b, c) if e is not engine}
+            self.assertEqual(others, {k: ipa for k, ipa in engine.known_peers.items() if k != engine.public_bytes})
+        self.assertIn(b.host, c.connections)
+
+    def test_join_goes_on_when_one_bootstrap_request_fails(self):
+        a, b, c = self.engine('10.0.0.1'), self.engine('10.0.0.2'), self.engine('10.0.0.3')
+        joined = []
+        c.bind(on_joined=joined.append)
+
+        async def no_neighbours(node, request_id):
+            raise ValueError("not today")
+
+        async def main():
+            await a.start_network()
+            await b.join_network(a.host)
+            # the neighbours request times out, the known peers one still answers
+            a._send_neighbours = no_neighbours
+            await c.join_network(a.host)
+
+        self.run_until(main())
+        self.assertEqual([a.host], joined)
+        self.assertEqual(b.host, c.known_peers.get(b.public_bytes))
+        self.assertIn(b.host, c.connections)
+
+    def test_failing_handler_keeps_the_connection(self):
+        a, b = self.engine('10.0.0.1'), self.engine('10.0.0.2')
+        received, disconnected = [], []
+
+        def dispatch(text):
+            if text == 'fail':
+                raise ConnectionResetError("connection is closed")
+            if text == 'crash':
+                raise KeyError(text)
+            received.append(text)
+
+        a.bind(on_peer_connected=lambda node: setattr(node, 'dispatcher', dispatch),
+               on_peer_disconnected=disconnected.append)
+
+        async def main():
+            await a.start_network()
+            for text in ('fail', 'crash', 'hello'):
+                await b.send_message(a.host, text)
+            await asyncio.sleep(1)
+            self.assertEqual(['hello'], received)
+
+            # the listener still runs and cleans up once the peer goes
+            await b.stop()
+            await asyncio.sleep(1)
+
+        self.run_until(main())
+        self.assertEqual(1, len(disconnected))
+        self.assertEqual({}, dict(a.connections))
+        self.assertEqual({}, a.listen_tasks)
+
+    def test_connection_counters_survive_a_reconnect(self):
+        a, b = self.engine('10.0.0.1'), self.engine('10.0.0.2')
+
+        def received():
+            return a.stats()['meshchat_connection_messages_received_total'][b.host]
+
+        async def main():
+            await a.start_network()
+            for text in ('one', 'two'):
+                await b.send_message(a.host, text)
+            await asyncio.sleep(1)
+            before = received()
+            self.assertGreaterEqual(before, 2)
+
+            b.connections[a.host].close()
+            await asyncio.sleep(1)
+            self.assertNotIn(b.host, a.connections)
+            self.assertEqual(before, received())
+
+            await b.pool.get(a.host)
+            await b.send_message(a.host, 'three')
+            await asyncio.sleep(1)
+            self.assertGreaterEqual(received(), before + 1)
+
+        self.run_until(main())
+
+    def test_known_peers_are_stamped_with_the_given_clock(self):
+        a = self.engine('10.0.0.1', clock=lambda: 12.5)
+        b = self.engine('10.0.0.2', clock=self.loop.time)
+
+        async def main():
+            await a.start_network()
+            await asyncio.sleep(100)
+            await b.join_network(a.host)
+
+        self.run_until(main())
+        self.assertEqual(12500, a.known_peers.version(b.public_bytes))
+        self.assertAlmostEqual(100000, b.known_peers.version(a.public_bytes), delta=100)
+
+    def test_pool_runs_without_heartbeats_or_deadline(self):
+        a = self.engine('10.0.0.1', heartbeat_interval=None, receive_deadline=None, keepalive_interval=10)
+        b = self.engine('10.0.0.2', heartbeat_interval=None, receive_deadline=None, keepalive_interval=10)
+
+        async def main():
+            await a.start_network()
+            await b.join_network(a.host)
+            await asyncio.sleep(60)
+            self.assertFalse(a.pool_task.done())
+            self.assertIn(b.host, a.connections)
+
+        self.run_until(main())
+
+    def test_stop_closes_connections_and_the_server(self):
+        a, b = self.engine('10.0.0.1'), self.engine('10.0.0.2')
+        disconnected = []
+        b.bind(on_peer_disconnected=disconnected.append)
+
+        async def main():
+            await a.start_network()
+            node = await b.pool.get(a.host)
+            await a.stop()
+            # the route advertisement the disconnect scheduled didn't outlive stop
+            self.assertTrue(a._advertise_task.done())
+            await asyncio.sleep(1)
+            self.assertEqual([node], disconnected)
+            with self.assertRaises(ConnectionRefusedError):
+                await b.connect_peer(a.host)
+
+        self.run_until(main())
+        self.assertEqual({}, dict(a.connections))
+        self.assertEqual({}, dict(b.connections))
+
+
+class AcceptTest(EngineTestCase):
+    async def stall(self, host: str, engine: AsyncMeshchat):
+        """
+        Connect from host to engine and send nothing
+        """
+
+        transport = self.network.transport()
+        transport.bind(host, 1)
+        return await transport.open_connection(engine.host, engine.port)
+
+    def test_stalled_handshake_is_dropped_after_the_timeout(self):
+        a = self.engine('10.0.0.1', handshake_timeout=3)
+
+        async def main():
+            await a.start_network()
+            stream = await self.stall('10.0.0.9', a)
+            start = self.loop.time()
+            with self.assertRaises(ConnectionResetError):
+                await stream.read_frame()
+            self.assertAlmostEqual(3, self.loop.time() - start, delta=0.1)
+            self.assertEqual(1, a.stats()['meshchat_accept_failures_total'])
+
+        self.run_until(main())
+
+    def test_handshakes_beyond_the_limit_wait_for_a_slot(self):
+        a = self.engine('10.0.0.1', handshake_timeout=3, max_handshakes=2)
+        b = self.engine('10.0.0.2', connect_timeout=10)
+
+        async def main():
+            await a.start_network()
+            # both slots taken until the stalled handshakes time out
+            await asyncio.gather(self.stall('10.0.0.8', a), self.stall('10.0.0.9', a))
+            start = self.loop.time()
+            await b.pool.get(a.host)
+            return self.loop.time() - start
+
+        waited = self.run_until(main())
+        self.assertGreater(waited, 2.9)
+        self.assertLess(waited, 3.1)
+        self.assertIn(b.host, a.connections)
+
+
+class BroadcastTest(EngineTestCase):
+    def setUp(self):
+        super().setUp()
+        self.mesh = [self.engine(f'10.0.0.{i}') for i in range(1, 5)]
+        self.stranger = cu.Identity(ed25519.Ed25519PrivateKey.generate(), self.trusted)
+        self.received = {engine.host: [] for engine in self.mesh}
+        for engine in self.mesh:
+            engine.bind(on_broadcast=lambda peer, text, ipa=engine.host: self.received[ipa].append((peer.kbytes, text)))
+
+        async def join():
+            await self.mesh[0].start_network()
+            for engine in self.mesh[1:]:
+                await engine.join_network(self.mesh[0].host)
+
+        self.run_until(join())
+
+    async def inject(self, sender: AsyncMeshchat, receiver: AsyncMeshchat, origin: cu.Identity, seq: int,
+                     text: bytes, signature: bytes = None):
+        """
+        Have sender pass on a broadcast claiming to come from origin, signed by it unless given a signature
+        """
+
+        if signature is None:
+            signature = origin.private_key.sign(_broadcast_signed(origin.public_raw, seq, text))
+        record = MESSAGE_CODES['broadcast'] + protocol.encode_gossip(origin.public_raw, seq, signature + text)
+        await sender.connections[receiver.host].send_message(record)
+
+    def test_reaches_every_node_once(self):
+        origin = self.mesh[0]
+
+        async def main():
+            await origin.broadcast('to all')
+            await origin.broadcast('again')
+            await asyncio.sleep(1)
+
+        self.run_until(main())
+        for engine in self.mesh[1:]:
+            self.assertEqual([(origin.public_bytes, 'to all'), (origin.public_bytes, 'again')],
+                             self.received[engine.host])
+        # the origin doesn't hear its own, echoes included
+        self.assertEqual([], self.received[origin.host])
+        # every node is connected to every other, each got copies over several paths
+        self.assertGreater(sum(engine.gossip_seen.duplicates for engine in self.mesh), 0)
+
+    def test_untrusted_or_forged_broadcast_is_dropped(self):
+        a, b, c = self.mesh[:3]
+
+        async def main():
+            await self.inject(b, a, self.stranger, 0, b'from outside')
+            # a trusted origin, but not signed by it
+            await self.inject(b, a, c.identity, 1000, b'not from c', signature=bytes(SIGNATURE_SIZE))
+            await asyncio.sleep(1)
+
+        self.run_until(main())
+        self.assertEqual([], self.received[a.host])
+
+    def test_forged_copy_doesnt_suppress_the_real_broadcast(self):
+        a, b, c = self.mesh[:3]
+
+        async def main():
+            # the id c's next broadcast will carry, arriving at a before the real one
+            await self.inject(b, a, c.identity, c._gossip_seq, b'forged', signature=bytes(SIGNATURE_SIZE))
+            await asyncio.sleep(1)
+            await c.broadcast('real')
+            await asyncio.sleep(1)
+
+        self.run_until(main())
+        self.assertEqual([(c.public_bytes, 'real')], self.received[a.host])
+
+
+class RoutesTest(EngineTestCase):
+    def test_unchanged_routes_arent_advertised_again(self):
+        a, b, c = self.engine('10.0.0.1'), self.engine('10.0.0.2'), self.engine('10.0.0.3')
+
+        async def main():
+            await a.start_network()
+            await b.join_network(a.host)
+            await c.join_network(a.host)
+            await asyncio.sleep(2)
+            self.assertIn(b.public_raw, a.routes)
+            self.assertIn(c.public_raw, a.routes)
+
+            sent = self.network.load[a.host].writes_sent
+            a._schedule_advertisement()
+            await asyncio.sleep(2)
+            self.assertEqual(sent, self.network.load[a.host].writes_sent)
+
+        self.run_until(main())
+
+
+class RelayTest(EngineTestCase):
+    def setUp(self):
+        super().setUp()
+        # a and c only reach each other through b
+        self.a, self.b, self.c = self.engine('10.0.0.1'), self.engine('10.0.0.2'), self.engine('10.0.0.3')
+        self.received = []
+        self.c.bind(on_routed_message=lambda peer, text: self.received.append((peer.kbytes, text)))
+
+        async def connect():
+            for engine in (self.a, self.b, self.c):
+                await engine.start_network()
+            await self.a.pool.get(self.b.host)
+            await self.c.pool.get(self.b.host)
+            await asyncio.sleep(2)
+
+        self.run_until(connect())
+
+    def test_relays_end_to_end(self):
+        a, c = self.a, self.c
+
+        async def main():
+            self.assertEqual(self.b.host, a.routes.route(c.public_raw).next_hop)
+            await a.send_routed(c.public_raw, b'over b')
+            await a.send_routed(c.public_raw, b'again')
+            await asyncio.sleep(1)
+
+        self.run_until(main())
+        self.assertNotIn(c.host, a.connections)
+        self.assertEqual([(a.public_bytes, 'over b'), (a.public_bytes, 'again')], self.received)
+
+    def test_stale_session_is_set_up_again(self):
+        a, c = self.a, self.c
+
+        async def main():
+            await a.send_routed(c.public_raw, b'first')
+            await asyncio.sleep(1)
+            # c forgot the session, e.g. after a restart
+            c.routed_sessions.clear()
+            await a.send_routed(c.public_raw, b'lost')
+            await asyncio.sleep(1)
+            self.assertNotIn(c.public_raw, a.routed_sessions)
+            await a.send_routed(c.public_raw, b'second')
+            await asyncio.sleep(1)
+
+        self.run_until(main())
+        self.assertEqual([b'first', b'second'], [text.encode() for _, text in self.received])
+
+    def test_unused_sessions_expire(self):
+        a, b, c = self.a, self.b, self.c
+
+        async def main():
+            await a.send_routed(c.public_raw, b'first')
+            await asyncio.sleep(ROUTED_SESSION_IDLE + 1)
+            await a.send_routed(b.public_raw, b'to b')
+            await asyncio.sleep(1)
+
+        self.run_until(main())
+        self.assertEqual([b.public_raw], list(a.routed_sessions))
+
+    def test_spoofed_stale_notice_is_ignored(self):
+        a, b, c = self.a, self.b, self.c
+
+        async def main():
+            await a.send_routed(c.public_raw, b'first')
+            await asyncio.sleep(1)
+            session = a.routed_sessions[c.public_raw]
+            # b claims to be c, naming no message a sent
+            await b._relay(a.public_raw, c.public_raw, ROUTED_TTL, ROUTED_UNKNOWN, bytes(24))
+            await asyncio.sleep(1)
+            self.assertIs(session, a.routed_sessions[c.public_raw])
+
+        self.run_until(main())
+
+
+class FileTest(EngineTestCase):
+    # disk access runs on executor threads, virtual time would race past it and fire the ack timeout
+    loop_factory = staticmethod(asyncio.new_event_loop)
+
+    def setUp(self):
+        super().setUp()
+        self.source = os.path.join(self.directory.name, 'file.bin')
+        self.data = random.Random(0).randbytes(3 * CHUNK_SIZE + 100)
+        with open(self.source, 'wb') as f:
+            f.write(self.data)
+        self.a, self.b = self.engine('10.0.0.1'), self.engine('10.0.0.2')
+        self.received = []
+        self.b.bind(on_file_offer=lambda peer, name, size: os.path.join(self.directory.name, 'received-' + name),
+                    on_file_received=lambda peer, path: self.received.append((peer.ipa, path)))
+
+    def test_sends_the_whole_file(self):
+        async def main():
+            await self.b.start_network()
+            await self.a.send_file(self.b.host, self.source)
+
+        self.run_until(main())
+        path = os.path.join(self.directory.name, 'received-file.bin')
+        self.assertEqual([(self.a.host, path)], self.received)
+        with open(path, 'rb') as f:
+            self.assertEqual(self.data, f.read())
+        self.assertEqual({}, self.a.transfers_out)
+        self.assertEqual({}, self.b.transfers_in)
+
+    def test_write_failure_fails_the_transfer_but_not_the_connection(self):
+        messages = []
+        self.b.bind(on_peer_connected=lambda node: setattr(node, 'dispatcher', messages.append))
+
+        async def main():
+            await self.b.start_network()
+            with mock.patch.object(IncomingTransfer, 'write', side_effect=OSError(28, "No space left on device")):
+                with self.assertRaisesRegex(ConnectionAbortedError, "OSError"):
+                    await self.a.send_file(self.b.host, self.source)
+            await self.a.send_message(self.b.host, 'still there')
+            await asyncio.sleep(0.5)
+
+        self.run_until(main())
+        self.assertEqual(['still there'], messages)
+        self.assertEqual([], self.received)
+        self.assertEqual({}, self.b.transfers_in)
+
+    def test_malformed_offset_fails_the_transfer(self):
+        a, b = self.a, self.b
+
+        for reply in (b'\x00\x01', (len(self.data) + 1).to_bytes(8, byteorder='big')):
+            async def answer(node, request_id, offer):
+                await b.reply(node, request_id, reply)
+
+            b._answer_file_offer = answer
+
+            async def main():
+                await b.start_network()
+                with self.assertRaises(ConnectionError):
+                    await a.send_file(b.host, self.source)
+
+            self.run_until(main())
+            self.assertEqual({}, a.transfers_out)
+
+
+class RequestTest(EngineTestCase):
+    def test_request_that_couldnt_be_sent_is_forgotten(self):
+        a, b = self.engine('10.0.0.1'), self.engine('10.0.0.2')
+
+        async def main():
+            await a.start_network()
+            node = await b.pool.get(a.host)
+            self.assertEqual(b'', await b.request(node, 'ping'))
+
+            node.close()
+            with self.assertRaises(ConnectionResetError):
+                await b.request(node, 'neighbours')
+            self.assertEqual(0, len(node.requests))
+
+        self.run_until(main())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,132 @@
+import unittest
+import asyncio
+import socket
+
+from lib import framing
+
+
+def frame(msg: bytes) -> bytes:
+    return len(msg).to_bytes(framing.HEADER_SIZE, byteorder='big') + msg
+
+
+class FramingTest(unittest.TestCase):
+    def run_server(self, scenario):
+        async def main():
+            accepted = asyncio.get_event_loop().create_future()
+
+            async def on_connected(stream):
+                accepted.set_result(stream)
+
+            server = await framing.start_server(on_connected, host='127.0.0.1', port=0)
+            port = server.sockets[0].getsockname()[1]
+            try:
+                await scenario(port, accepted)
+            finally:
+                server.close()
+                await server.wait_closed()
+
+        asyncio.run(main())
+
+    def test_frames_split_across_segments(self):
+        msgs = [b'', b'a', b'hello' * 100, bytes(range(256)) * 4]
+        wire = b''.join(frame(m) for m in msgs)
+
+        async def scenario(port, accepted):
+            _, writer = await asyncio.open_connection('127.0.0.1', port)
+            stream = await accepted
+            # trickle the bytes so headers and bodies arrive torn apart
+            for i in range(0, len(wire), 7):
+                writer.write(wire[i:i+7])
+                await writer.drain()
+                await asyncio.sleep(0)
+
+            self.assertEqual(msgs, [await stream.read_frame() for _ in msgs])
+            writer.close()
+
+        self.run_server(scenario)
+
+    def test_frame_larger_than_buffer(self):
+        big = bytes(range(256)) * (framing.BUFFER_SIZE // 64)
+
+        async def scenario(port, accepted):
+            client = await framing.open_connection('127.0.0.1', port)
+            stream = await accepted
+
+            client.write_frame(b'head')
+            client.write_frame(big)
+            client.write_frame(b'tail')
+            await client.drain()
+
+            self.assertEqual(b'head', await stream.read_frame())
+            received = await stream.read_frame()
+            self.assertEqual(big, received)
+            # the bytearray it was received into, not a copy
+            self.assertIsInstance(received, bytearray)
+            self.assertEqual(b'tail', await stream.read_frame())
+            client.close()
+
+        self.run_server(scenario)
+
+    def test_small_frame_written_at_once(self):
+        class Transport:
+            def __init__(self):
+                self.writes = []
+
+            def is_closing(self):
+                return False
+
+            def write(self, data):
+                self.writes.append(data)
+
+        stream = framing.FrameProtocol()
+        stream.transport = Transport()
+        stream.write_frame(b'one')
+        stream.write_frame(b'')
+        self.assertEqual([frame(b'one'), frame(b'')], stream.transport.writes)
+
+    def test_oversized_frame_aborts(self):
+        async def scenario(port, accepted):
+            _, writer = await asyncio.open_connection('127.0.0.1', port)
+            stream = await accepted
+
+            writer.write(frame(b'ok'))
+            # only the header of a frame nobody should allocate
+            writer.write((framing.MAX_FRAME_SIZE + 1).to_bytes(framing.HEADER_SIZE, byteorder='big'))
+            await writer.drain()
+
+            self.assertEqual(b'ok', await stream.read_frame())
+            with self.assertRaises(ConnectionAbortedError):
+                await stream.read_frame()
+            with self.assertRaises(ValueError):
+                stream.write_frame(bytes(framing.MAX_FRAME_SIZE + 1))
+            writer.close()
+
+        self.run_server(scenario)
+
+    def test_read_after_close_raises(self):
+        async def scenario(port, accepted):
+            client = await framing.open_connection('127.0.0.1', port)
+            stream = await accepted
+
+            client.write_frame(b'last')
+            await client.drain()
+            client.close()
+
+            self.assertEqual(b'last', await stream.read_frame())
+            with self.assertRaises(ConnectionResetError):
+                await stream.read_frame()
+
+        self.run_server(scenario)
+
+    def test_profile_applies_socket_options(self):
+        profile = framing.TransportProfile(nodelay=False, keepalive=True, keepidle=30)
+
+        async def scenario(port, accepted):
+            client = await framing.open_connection('127.0.0.1', port, profile)
+            await accepted
+            sock = client.get_extra_info('socket')
+            self.assertEqual(0, sock.getsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY))
+            self.assertEqual(1, sock.getsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE))
+            client.close()
+
+        self.run_server(scenario)
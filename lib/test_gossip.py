@@ -0,0 +1,41 @@
+import unittest
+
+from lib.gossip import SeenCache
+
+
+class SeenCacheTest(unittest.TestCase):
+    def test_duplicates_are_reported(self):
+        seen = SeenCache()
+
+        self.assertFalse(seen.check((b'a', 1)))
+        self.assertFalse(seen.check((b'a', 2)))
+        self.assertTrue(seen.check((b'a', 1)))
+        self.assertEqual(1, seen.duplicates)
+
+    def test_peek_doesnt_record(self):
+        seen = SeenCache()
+
+        self.assertFalse(seen.peek('x'))
+        self.assertFalse(seen.check('x'))
+        self.assertTrue(seen.peek('x'))
+        self.assertEqual(1, seen.duplicates)
+
+    def test_entries_expire(self):
+        now = [0.0]
+        seen = SeenCache(ttl=10, clock=lambda: now[0])
+
+        seen.check('x')
+        now[0] = 9
+        self.assertIn('x', seen)
+        now[0] = 11
+        self.assertNotIn('x', seen)
+        self.assertFalse(seen.check('x'))
+
+    def test_capacity_is_bounded(self):
+        seen = SeenCache(capacity=3)
+
+        for i in range(10):
+            seen.check(i)
+        self.assertEqual(3, len(seen))
+        self.assertNotIn(0, seen)
+        self.assertIn(9, seen)
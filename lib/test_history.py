@@ -0,0 +1,46 @@
+import unittest
+import tempfile
+
+from lib.history import MessageHistory
+
+
+class MessageHistoryTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        # flushed by hand, the writer thread never wakes up on its own
+        self.history = MessageHistory(self.directory.name, segment_size=256, flush_interval=3600)
+
+    def tearDown(self):
+        self.history.close()
+        self.directory.cleanup()
+
+    def test_pending_and_written_messages_page_in_order(self):
+        for i in range(30):
+            self.history.append('10.0.0.2', f"message {i}", outgoing=i % 2 == 0, timestamp=i)
+            if i == 19:
+                self.history.flush()
+
+        self.assertEqual(30, self.history.count('10.0.0.2'))
+        start, page = self.history.page('10.0.0.2', size=15)
+        self.assertEqual(15, start)
+        self.assertEqual([f"message {i}" for i in range(15, 30)], [m.text for m in page])
+
+        start, page = self.history.page('10.0.0.2', before=start, size=20)
+        self.assertEqual(0, start)
+        self.assertEqual([f"message {i}" for i in range(15)], [m.text for m in page])
+        self.assertTrue(page[0].outgoing)
+        self.assertFalse(page[1].outgoing)
+        # the small segment size spread the written messages over several files
+        self.assertGreater(len(self.history.logs[next(iter(self.history.logs))].segments), 1)
+
+    def test_history_survives_reopening(self):
+        self.history.append(b'ssh-ed25519 AAAA', "hello")
+        self.history.append(b'ssh-ed25519 AAAA', "ünïcode", outgoing=True)
+        self.history.append('10.0.0.3', "elsewhere")
+        self.history.close()
+
+        self.history = MessageHistory(self.directory.name, flush_interval=3600)
+        _, page = self.history.page(b'ssh-ed25519 AAAA')
+        self.assertEqual([("hello", False), ("ünïcode", True)], [(m.text, m.outgoing) for m in page])
+        self.assertEqual(1, self.history.count('10.0.0.3'))
+        self.assertEqual(0, self.history.count('10.0.0.4'))
@@ -0,0 +1,47 @@
+import unittest
+import math
+import random
+
+from lib.link import (LinkStats, select_neighbours)
+
+
+class LinkStatsTest(unittest.TestCase):
+    def test_smoothed_rtt_and_loss(self):
+        link = LinkStats(window=4)
+        self.assertEqual(math.inf, link.score)
+
+        link.add_rtt(0.1)
+        self.assertEqual((0.1, 0.05), (link.srtt, link.rttvar))
+        link.add_rtt(0.2)
+        self.assertAlmostEqual(0.1125, link.srtt)
+        self.assertAlmostEqual(link.srtt, link.score)
+
+        link.add_loss()
+        link.add_loss()
+        self.assertEqual(0.5, link.loss)
+        self.assertGreater(link.score, link.srtt)
+        # old results fall out of the window
+        link.add_rtt(0.1)
+        link.add_rtt(0.1)
+        link.add_rtt(0.1)
+        self.assertEqual(0.25, link.loss)
+        self.assertEqual(7, link.quality().probes)
+
+
+class SelectNeighboursTest(unittest.TestCase):
+    def test_fastest_plus_random_with_hysteresis(self):
+        rng = random.Random(0)
+        scores = {'a': 0.01, 'b': 0.02, 'c': 0.03, 'd': 0.5, 'e': 0.6}
+        selected = select_neighbours([], scores, 3, random_slots=1, rng=rng)
+        self.assertEqual(['a', 'b'], selected[:2])
+        self.assertIn(selected[2], ('c', 'd', 'e'))
+
+        # slightly faster peers don't displace neighbours, much faster ones do
+        self.assertEqual(['x', 'y'], select_neighbours(['x', 'y'], {'x': 0.1, 'y': 0.1, 'z': 0.09}, 2,
+                                                       random_slots=0))
+        self.assertEqual(['z', 'x'], select_neighbours(['x', 'y'], {'x': 0.1, 'y': 0.1, 'z': 0.01}, 2,
+                                                       random_slots=0))
+
+    def test_unmeasured_neighbours_keep_only_spare_slots(self):
+        self.assertEqual(['a', 'gone'], select_neighbours(['gone'], {'a': 0.1}, 2, random_slots=0))
+        self.assertEqual(['a'], select_neighbours(['gone'], {'a': 0.1}, 1, random_slots=0))
@@ -0,0 +1,43 @@
+import unittest
+import logging
+import os
+import tempfile
+
+from lib import logs
+
+
+class LogsTest(unittest.TestCase):
+    def tearDown(self):
+        logs.shutdown()
+
+    def test_trace_keeps_latest_records(self):
+        logs.configure(level=logging.WARNING, filename=None, stream=False, trace=True, trace_capacity=3)
+        logger = logging.getLogger('lib.test')
+        for i in range(5):
+            logger.debug("record %d", i)
+
+        lines = logs.dump_trace()
+        self.assertEqual(3, len(lines))
+        self.assertTrue(lines[0].endswith("record 2"))
+        self.assertTrue(lines[-1].endswith("record 4"))
+
+    def test_queued_records_reach_the_file(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'log')
+            logs.configure(level=logging.INFO, filename=path, stream=False)
+            logger = logging.getLogger('lib.test')
+            logger.debug("dropped")
+            logger.info("kept %s", 'this')
+            # stopping the listener writes out what's queued
+            logs.shutdown()
+
+            with open(path) as f:
+                text = f.read()
+        self.assertIn("kept this", text)
+        self.assertNotIn("dropped", text)
+        with self.assertRaises(RuntimeError):
+            logs.dump_trace()
+
+
+if __name__ == '__main__':
+    unittest.main()
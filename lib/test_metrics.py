@@ -0,0 +1,48 @@
+import unittest
+import json
+import os
+import tempfile
+
+from lib.metrics import Registry
+
+
+class RegistryTest(unittest.TestCase):
+    def setUp(self):
+        self.registry = Registry()
+        self.sent = {'10.0.0.2': 3, '10.0.0.3': 5}
+
+        self.failures = self.registry.counter('failures_total', "Failed things")
+        self.phases = self.registry.summary('phase_seconds', "Time by phase", 'phase')
+        self.registry.gauge('connections', "Connections", lambda: len(self.sent))
+        self.registry.collected_counter('sent_total', "Sent by peer", lambda: self.sent, 'ipa')
+
+    def test_snapshot(self):
+        self.failures.inc()
+        self.failures.inc(2)
+        self.phases.labels('hello').observe(0.5)
+        self.phases.labels('hello').observe(1.5)
+        self.assertIs(self.registry.counter('failures_total', "Failed things"), self.failures)
+
+        snapshot = self.registry.snapshot()
+        self.assertEqual(3, snapshot['failures_total'])
+        self.assertEqual({'hello': 2}, snapshot['phase_seconds_count'])
+        self.assertEqual({'hello': 2.0}, snapshot['phase_seconds_sum'])
+        self.assertEqual({'hello': 1.5}, snapshot['phase_seconds_max'])
+        self.assertEqual(2, snapshot['connections'])
+        self.assertEqual(self.sent, snapshot['sent_total'])
+
+        with self.assertRaises(ValueError):
+            self.registry.gauge('failures_total', "Not a gauge", lambda: 0)
+
+    def test_prometheus_and_json_files(self):
+        self.failures.inc()
+        text = self.registry.to_prometheus()
+        self.assertIn('# TYPE failures_total counter\nfailures_total 1\n', text)
+        self.assertIn('sent_total{ipa="10.0.0.3"} 5\n', text)
+
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'meshchat.json')
+            self.registry.write(path, 'json')
+            with open(path) as f:
+                self.assertEqual(self.registry.snapshot(), json.load(f))
+            self.assertEqual(['meshchat.json'], os.listdir(directory))
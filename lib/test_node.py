@@ -0,0 +1,244 @@
+import unittest
+import asyncio
+import os
+import tempfile
+
+from cryptography.hazmat.primitives.asymmetric import (ed25519, x25519)
+
+from lib import util as cu
+from lib.framing import MAX_FRAME_SIZE
+from lib.node import (Node, make_hello, MAC_SIZE, _HELLO, _HELLO_BODY, _RESUME, _REJECT)
+from lib.session import SessionCache
+from lib.transport import (MemoryNetwork, VirtualClockLoop)
+
+
+class NodeTestCase(unittest.TestCase):
+    """
+    Node pairs over an in-memory connection in virtual time
+    """
+
+    def setUp(self):
+        self.loop = VirtualClockLoop()
+        asyncio.set_event_loop(self.loop)
+        self.directory = tempfile.TemporaryDirectory()
+        self.trusted = cu.KeyStore(os.path.join(self.directory.name, "trusted"))
+        # written before the store is first read, keys made later are untrusted
+        self.client_identity, self.server_identity = self.identity(), self.identity()
+        self.network = MemoryNetwork()
+        self.client_transport, self.server_transport = self.network.transport(), self.network.transport()
+        self.client_transport.bind('10.0.0.1', 1)
+        self.server_transport.bind('10.0.0.2', 1)
+        self.accepted = asyncio.Queue()
+        self.loop.run_until_complete(self.server_transport.start_server(self.accepted.put, backlog=8))
+
+    def tearDown(self):
+        tasks = asyncio.all_tasks(self.loop)
+        for task in tasks:
+            task.cancel()
+        self.loop.run_until_complete(asyncio.gather(*tasks, return_exceptions=True))
+        self.loop.close()
+        asyncio.set_event_loop(None)
+        self.directory.cleanup()
+
+    def identity(self, trusted: bool = True) -> cu.Identity:
+        identity = cu.Identity(ed25519.Ed25519PrivateKey.generate(), self.trusted)
+        if trusted:
+            cu.write_trusted_key(identity.public_bytes, self.directory.name)
+        return identity
+
+    async def streams(self):
+        """
+        Both ends of a fresh connection, the client's first
+        """
+
+        client = await self.client_transport.open_connection('10.0.0.2', 1)
+        return client, await self.accepted.get()
+
+    def connect(self, client_kwargs: dict = None, server_kwargs: dict = None):
+        """
+        Run both ends of a handshake, returns the client and server nodes
+        """
+
+        async def main():
+            client, server = await self.streams()
+            return await asyncio.gather(
+                Node.connect(client, is_client=True, identity=self.client_identity, **(client_kwargs or {})),
+                Node.connect(server, is_client=False, identity=self.server_identity, **(server_kwargs or {})))
+
+        return self.loop.run_until_complete(main())
+
+    def run_until(self, coro):
+        return self.loop.run_until_complete(coro)
+
+
+class HandshakeTest(NodeTestCase):
+    def server_receives(self, hello: bytes, **kwargs) -> Node:
+        """
+        Run the server's end of a handshake whose client sends hello
+        """
+
+        async def main():
+            client, server = await self.streams()
+            client.write_frame(hello)
+            return await Node.connect(server, is_client=False, identity=self.server_identity, **kwargs)
+
+        return self.run_until(main())
+
+    def test_both_ends_agree_on_keys_and_identities(self):
+        client, server = self.connect()
+        self.assertFalse(client.resumed or server.resumed)
+        self.assertEqual(self.server_identity.public_bytes, client.peer_kbytes)
+        self.assertEqual(self.client_identity.public_bytes, server.peer_kbytes)
+
+        async def main():
+            await client.send_message(b'ping')
+            self.assertEqual(b'ping', await server.receive_message())
+            await server.send_message(b'pong')
+            self.assertEqual(b'pong', await client.receive_message())
+
+        self.run_until(main())
+
+    def test_untrusted_key_is_rejected_unless_known(self):
+        stranger = self.identity(trusted=False)
+        hello = make_hello(0, x25519.X25519PrivateKey.generate(), identity=stranger)
+        with self.assertRaisesRegex(RuntimeError, "not a known public key"):
+            self.server_receives(hello)
+
+        # peers learnt from the mesh are trusted through trusted_keys
+        server = self.server_receives(hello, trusted_keys={stranger.public_bytes})
+        self.assertEqual(stranger.public_bytes, server.peer_kbytes)
+
+    def test_bad_signature_fails_cleanly(self):
+        hello = bytearray(make_hello(0, x25519.X25519PrivateKey.generate(), identity=self.client_identity))
+        # the last byte of the signature
+        hello[len(_HELLO) + _HELLO_BODY.size - 1] ^= 1
+        with self.assertRaisesRegex(RuntimeError, "signature"):
+            self.server_receives(bytes(hello))
+
+        # a hello meant for the other direction, reflected back
+        with self.assertRaisesRegex(RuntimeError, "signature"):
+            self.server_receives(make_hello(1, x25519.X25519PrivateKey.generate(), identity=self.client_identity))
+
+    def test_truncated_hello_fails_cleanly(self):
+        hello = make_hello(0, x25519.X25519PrivateKey.generate(), identity=self.client_identity)
+        for size in (0, 1, len(_HELLO) + _HELLO_BODY.size - 1):
+            with self.assertRaisesRegex(RuntimeError, "not a handshake hello"):
+                self.server_receives(hello[:size])
+
+
+class KeyChainTest(NodeTestCase):
+    def test_directions_use_different_keys(self):
+        client, server = self.connect()
+        # same plaintext, counter and nonce direction, only the key differs
+        self.assertNotEqual(client.send_chain.seal(b'same', 0), server.send_chain.seal(b'same', 0))
+
+    def test_record_reflected_back_to_its_sender_fails(self):
+        client, server = self.connect()
+
+        async def main():
+            await client.send_message(b'hello')
+            record = await server.stream.read_frame()
+            self.assertEqual(b'hello', server.compressor.decode(server.recv_chain.open(record, server.peer_direction)))
+
+            server.stream.write_frame(record)
+            with self.assertRaises(OSError):
+                await client.receive_message()
+
+        self.run_until(main())
+
+    def test_oversized_message_is_refused_without_using_up_a_record(self):
+        client, server = self.connect()
+
+        async def main():
+            with self.assertRaises(ValueError):
+                await client.send_message(os.urandom(MAX_FRAME_SIZE + MAX_FRAME_SIZE // 2))
+            await client.send_message(b'small')
+            self.assertEqual(b'small', await server.receive_message())
+
+        self.run_until(main())
+
+    def test_directions_rekey_independently_and_in_step(self):
+        client, server = self.connect()
+        for chain in (client.send_chain, client.recv_chain, server.send_chain, server.recv_chain):
+            chain.rekey_records = 3
+
+        async def main():
+            ups = [b'up %d' % i for i in range(10)]
+            downs = [b'down %d' % i for i in range(4)]
+
+            async def send(node, msgs):
+                for msg in msgs:
+                    await node.send_message(msg)
+
+            async def receive(node, count):
+                return [await node.receive_message() for _ in range(count)]
+
+            # both directions at once, neither waits for the other
+            _, _, received_up, received_down = await asyncio.gather(
+                send(client, ups), send(server, downs), receive(server, len(ups)), receive(client, len(downs)))
+            self.assertEqual(ups, received_up)
+            self.assertEqual(downs, received_down)
+
+        self.run_until(main())
+        self.assertEqual(3, client.send_chain.epoch)
+        self.assertEqual(client.send_chain.epoch, server.recv_chain.epoch)
+        self.assertEqual(1, server.send_chain.epoch)
+        self.assertEqual(server.send_chain.epoch, client.recv_chain.epoch)
+
+
+class ResumptionTest(NodeTestCase):
+    def sessions(self, **kwargs) -> SessionCache:
+        return SessionCache(clock=self.loop.time, **kwargs)
+
+    def test_reconnect_resumes_the_session(self):
+        client_sessions, server_sessions = self.sessions(), self.sessions()
+        first = self.connect({'sessions': client_sessions}, {'sessions': server_sessions})
+        client, server = self.connect({'sessions': client_sessions}, {'sessions': server_sessions})
+
+        self.assertFalse(first[0].resumed)
+        self.assertTrue(client.resumed and server.resumed)
+        self.assertEqual(self.server_identity.public_bytes, client.peer_kbytes)
+
+        async def main():
+            await client.send_message(b'resumed')
+            self.assertEqual(b'resumed', await server.receive_message())
+
+        self.run_until(main())
+
+    def test_expired_or_unknown_ticket_falls_back_to_the_full_handshake(self):
+        client_sessions, server_sessions = self.sessions(lifetime=60), self.sessions(lifetime=60)
+        self.connect({'sessions': client_sessions}, {'sessions': server_sessions})
+        self.run_until(asyncio.sleep(120))
+        client, server = self.connect({'sessions': client_sessions}, {'sessions': server_sessions})
+        self.assertFalse(client.resumed or server.resumed)
+
+        # the server forgot the session, e.g. after a restart
+        client, server = self.connect({'sessions': client_sessions}, {'sessions': self.sessions()})
+        self.assertFalse(client.resumed or server.resumed)
+        self.assertEqual(self.client_identity.public_bytes, server.peer_kbytes)
+
+    def test_offer_with_a_bad_mac_is_refused_and_keeps_the_ticket(self):
+        client_sessions, server_sessions = self.sessions(), self.sessions()
+        self.connect({'sessions': client_sessions}, {'sessions': server_sessions})
+        session = client_sessions.take_for('10.0.0.2')
+
+        async def main():
+            client_stream, server_stream = await self.streams()
+            server = asyncio.ensure_future(Node.connect(server_stream, identity=self.server_identity,
+                                                        sessions=server_sessions))
+            client_stream.write_frame(_RESUME + session.ticket + os.urandom(32) + bytes(MAC_SIZE))
+            self.assertEqual(_REJECT, await client_stream.read_frame())
+            self.assertIsNotNone(server_sessions.get(session.ticket))
+
+            # the full handshake follows on the same connection
+            client = Node(client_stream, identity=self.client_identity)
+            await client.handshake(is_client=True)
+            return await server
+
+        server = self.run_until(main())
+        self.assertFalse(server.resumed)
+        self.assertEqual(self.client_identity.public_bytes, server.peer_kbytes)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,85 @@
+import unittest
+
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import ed25519
+
+from lib.peertable import PeerTable, PeerRecord
+
+
+def new_kbytes() -> bytes:
+    return ed25519.Ed25519PrivateKey.generate().public_key().public_bytes(
+        encoding=serialization.Encoding.OpenSSH,
+        format=serialization.PublicFormat.OpenSSH
+    )
+
+
+class PeerTableTest(unittest.TestCase):
+    def setUp(self):
+        self.now = 1000
+        self.keys = [new_kbytes() for _ in range(50)]
+
+    def table(self) -> PeerTable:
+        return PeerTable(clock=lambda: self.now)
+
+    def test_local_updates_bump_versions(self):
+        table = self.table()
+
+        table[self.keys[0]] = '10.0.0.1'
+        self.assertEqual(1000, table.version(self.keys[0]))
+        # same address keeps the version, a new one moves it forward even if the clock didn't
+        table[self.keys[0]] = '10.0.0.1'
+        table[self.keys[0]] = '10.0.0.2'
+        self.assertEqual(1001, table.version(self.keys[0]))
+        self.assertEqual({self.keys[0]: '10.0.0.2'}, dict(table))
+
+    def test_merge_keeps_newer_entries(self):
+        table = self.table()
+        table[self.keys[0]] = '10.0.0.1'
+
+        changed = table.merge([PeerRecord(self.keys[0], '10.0.0.9', 999), PeerRecord(self.keys[1], '10.0.0.2', 5)])
+        self.assertEqual([self.keys[1]], changed)
+        self.assertEqual('10.0.0.1', table[self.keys[0]])
+
+        self.assertEqual([self.keys[0]], table.merge([PeerRecord(self.keys[0], '10.0.0.9', 2000)]))
+        self.assertEqual('10.0.0.9', table[self.keys[0]])
+
+    def test_diff_transfers_only_differing_buckets(self):
+        a, b = self.table(), self.table()
+        for i, kbytes in enumerate(self.keys):
+            a[kbytes] = f'10.0.0.{i}'
+        b.merge(a.diff([]))
+        self.assertEqual(a.digests(), b.digests())
+        self.assertEqual([], a.diff(b.digests()))
+
+        self.now += 1
+        a[self.keys[3]] = '10.1.0.3'
+        delta = a.diff(b.digests())
+        self.assertIn(a.record(self.keys[3]), delta)
+        self.assertLess(len(delta), len(self.keys))
+
+        b.merge(delta)
+        self.assertEqual(dict(a), dict(b))
+        self.assertEqual(a.digests(), b.digests())
+
+    def test_excluded_entries_are_left_out(self):
+        a, b = self.table(), self.table()
+        requester, responder, other = self.keys[:3]
+        a[responder] = '10.0.0.2'
+        a[other] = '10.0.0.3'
+        b[requester] = '10.0.0.1'
+        b.merge([a.record(other)])
+
+        self.assertEqual([], b.diff(a.digests(exclude=(responder,)), exclude=(requester,)))
+
+    def test_key_at_follows_address_changes(self):
+        table = self.table()
+        first, second = self.keys[:2]
+        table[first] = '10.0.0.1'
+        self.assertEqual(first, table.key_at('10.0.0.1'))
+
+        table[first] = '10.0.0.2'
+        self.assertIsNone(table.key_at('10.0.0.1'))
+        table[second] = '10.0.0.2'
+        del table[first]
+        self.assertEqual(second, table.key_at('10.0.0.2'))
+        self.assertIsNone(table.key_at('10.0.0.3'))
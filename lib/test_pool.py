@@ -0,0 +1,178 @@
+import unittest
+import asyncio
+
+from lib.pool import (ConnectionPool, MAX_PENDING)
+
+
+class FakeNode:
+    def __init__(self, last_active: float = 0.0, last_received: float = 0.0, last_sent: float = 0.0):
+        self.last_active = last_active
+        self.last_received = last_received
+        self.last_sent = last_sent
+        self.closed = False
+        self.sent = []
+
+    def close(self):
+        self.closed = True
+
+    def abort(self):
+        self.closed = True
+
+    async def send_messages(self, *msgs):
+        self.sent += msgs
+
+
+async def unreachable(ipa):
+    raise OSError(f"{ipa} unreachable")
+
+
+async def alive(node):
+    pass
+
+
+class ConnectionPoolTest(unittest.TestCase):
+    def test_evicts_least_recently_active_unpinned(self):
+        pool = ConnectionPool(unreachable, alive, pinned=lambda ipa: ipa == 'pinned', max_size=2)
+        pinned, old, new = FakeNode(0.0), FakeNode(1.0), FakeNode(2.0)
+
+        self.assertEqual([], pool.add('pinned', pinned))
+        self.assertEqual([], pool.add('old', old))
+        self.assertEqual([old], pool.add('new', new))
+        self.assertEqual(['pinned', 'new'], list(pool.connections))
+
+    def test_idle_connections_closed_and_quiet_ones_probed(self):
+        probed = []
+
+        async def probe(node):
+            probed.append(node)
+            raise asyncio.TimeoutError()
+
+        async def main():
+            pool = ConnectionPool(unreachable, probe, pinned=lambda ipa: ipa == 'pinned',
+                                  idle_timeout=100, keepalive_interval=10)
+            idle, pinned, quiet = FakeNode(0.0, 0.0), FakeNode(0.0, 0.0), FakeNode(95.0, 50.0)
+            pool.add('idle', idle)
+            pool.add('pinned', pinned)
+            pool.add('quiet', quiet)
+
+            pool.check(now=150.0)
+            # a probe still running isn't started twice
+            pool.check(now=150.0)
+            await asyncio.sleep(0)
+
+            self.assertTrue(idle.closed)
+            self.assertEqual([pinned, quiet], probed)
+            self.assertTrue(pinned.closed and quiet.closed)
+            # closed connections don't wait for their listener to leave the pool
+            self.assertEqual([], list(pool.connections))
+
+        asyncio.run(main())
+
+    def test_silent_connections_closed_and_quiet_ones_heartbeated(self):
+        beats = []
+
+        async def heartbeat(node):
+            beats.append(node)
+
+        async def probe(node):
+            probed.append(node)
+
+        probed = []
+
+        async def main():
+            pool = ConnectionPool(unreachable, probe, heartbeat=heartbeat, heartbeat_interval=10,
+                                  keepalive_interval=10, receive_deadline=30)
+            # a pinned connection isn't spared once the peer went silent
+            dead, talking, chatty = FakeNode(95.0, 60.0, 95.0), FakeNode(95.0, 80.0, 80.0), FakeNode(99.0, 99.0, 99.0)
+            pool.pinned = lambda ipa: True
+            pool.add('dead', dead)
+            pool.add('talking', talking)
+            pool.add('chatty', chatty)
+
+            pool.check(now=100.0)
+            await asyncio.sleep(0)
+
+            self.assertTrue(dead.closed)
+            self.assertFalse(talking.closed or chatty.closed)
+            self.assertEqual(['talking', 'chatty'], list(pool.connections))
+            self.assertEqual([talking], beats)
+            # the peer's heartbeats are awaited instead of probing
+            self.assertEqual([], probed)
+
+        asyncio.run(main())
+
+    def test_heartbeats_turned_off(self):
+        beats = []
+
+        async def heartbeat(node):
+            beats.append(node)
+
+        async def main():
+            pool = ConnectionPool(unreachable, alive, heartbeat=heartbeat, heartbeat_interval=None,
+                                  idle_timeout=100, keepalive_interval=10)
+            quiet = FakeNode(95.0, 99.0, 0.0)
+            pool.add('quiet', quiet)
+
+            maintain = asyncio.ensure_future(pool.maintain())
+            await asyncio.sleep(0.01)
+            self.assertFalse(maintain.done())
+            maintain.cancel()
+
+            pool.check(now=100.0)
+            await asyncio.sleep(0)
+            self.assertEqual([], beats)
+            self.assertFalse(quiet.closed)
+
+        asyncio.run(main())
+
+    def test_concurrent_gets_share_one_connect(self):
+        attempts = []
+
+        async def main():
+            pool = None
+
+            async def connect(ipa):
+                attempts.append(ipa)
+                await asyncio.sleep(0.01)
+                node = FakeNode()
+                pool.add(ipa, node)
+                return node
+
+            pool = ConnectionPool(connect, alive)
+            first, second = await asyncio.gather(pool.get('peer'), pool.get('peer'))
+            self.assertIs(first, second)
+            self.assertEqual(['peer'], attempts)
+
+        asyncio.run(main())
+
+    def test_enqueued_records_sent_once_connected(self):
+        async def main():
+            node = FakeNode()
+
+            async def connect(ipa):
+                await asyncio.sleep(0.01)
+                pool.add(ipa, node)
+                return node
+
+            pool = ConnectionPool(connect, alive)
+            pool.enqueue('peer', b'one')
+            pool.enqueue('peer', b'two')
+            self.assertEqual([], node.sent)
+
+            await asyncio.sleep(0.05)
+            self.assertEqual([b'one', b'two'], node.sent)
+
+            # a peer that takes long to connect gets only so many records
+            pool.enqueue('slow', b'first')
+            for _ in range(MAX_PENDING - 1):
+                pool.enqueue('slow', b'more')
+            with self.assertRaises(OSError):
+                pool.enqueue('slow', b'too many')
+
+            # an unreachable peer's records are dropped after the connect fails
+            slow = ConnectionPool(unreachable, alive, connect_timeout=0.01)
+            slow.enqueue('peer', b'lost')
+            await asyncio.sleep(0.02)
+            self.assertEqual({}, slow.pending)
+
+        asyncio.run(main())
@@ -0,0 +1,56 @@
+import unittest
+
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import ed25519
+
+from lib import protocol
+from lib import util
+from lib.peertable import PeerRecord
+
+
+def new_kbytes() -> bytes:
+    return ed25519.Ed25519PrivateKey.generate().public_key().public_bytes(
+        encoding=serialization.Encoding.OpenSSH,
+        format=serialization.PublicFormat.OpenSSH
+    )
+
+
+class ProtocolTest(unittest.TestCase):
+    def test_key_conversion_matches_openssh(self):
+        kbytes = new_kbytes()
+        raw = serialization.load_ssh_public_key(kbytes).public_bytes(
+            encoding=serialization.Encoding.Raw,
+            format=serialization.PublicFormat.Raw
+        )
+
+        self.assertEqual(raw, util.ssh_to_raw(kbytes))
+        self.assertEqual(kbytes, util.raw_to_ssh(raw))
+        with self.assertRaises(ValueError):
+            util.ssh_to_raw(b'ssh-rsa AAAA')
+
+    def test_peers_roundtrip(self):
+        peers = [('192.168.0.1', new_kbytes()), ('fe80::1', new_kbytes()), ('10.0.0.255', new_kbytes())]
+
+        payload = protocol.encode_peers(peers)
+        self.assertEqual(protocol.PROTOCOL_VERSION, payload[0])
+        self.assertEqual(1 + 4 + 48 * len(peers), len(payload))
+        self.assertEqual(peers, protocol.decode_peers(payload))
+
+        self.assertEqual([], protocol.decode_peers(protocol.encode_peers([])))
+
+    def test_peer_records_and_digests_roundtrip(self):
+        records = [PeerRecord(new_kbytes(), '192.168.1.3', 1), PeerRecord(new_kbytes(), '::1', 2 ** 63)]
+        self.assertEqual(records, protocol.decode_peer_records(protocol.encode_peer_records(records)))
+
+        digests = [0, 1, 2 ** 64 - 1]
+        self.assertEqual(digests, protocol.decode_digests(protocol.encode_digests(digests)))
+
+    def test_rejects_malformed_payloads(self):
+        payload = protocol.encode_peers([('192.168.0.1', new_kbytes())])
+
+        with self.assertRaises(ValueError):
+            protocol.decode_peers(b'')
+        with self.assertRaises(ValueError):
+            protocol.decode_peers(bytes((255,)) + payload[1:])
+        with self.assertRaises(ValueError):
+            protocol.decode_peers(payload[:-1])
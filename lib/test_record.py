@@ -0,0 +1,39 @@
+import unittest
+import os
+
+from cryptography.exceptions import InvalidTag
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+
+from lib.record import RecordCipher
+
+
+class RecordTest(unittest.TestCase):
+    def test_roundtrip_across_rekeys(self):
+        key = os.urandom(32)
+        sealer = RecordCipher(key, rekey_records=3, rekey_bytes=100)
+        opener = RecordCipher(key, rekey_records=3, rekey_bytes=100)
+
+        msgs = [os.urandom(n) for n in (0, 1, 50, 70, 5, 5, 5, 200, 1)]
+        for msg in msgs:
+            self.assertEqual(msg, opener.open(sealer.seal(msg, 0), 0))
+        self.assertGreater(sealer.epoch, 2)
+        self.assertEqual(sealer.epoch, opener.epoch)
+
+    def test_directions_use_distinct_nonces(self):
+        key = os.urandom(32)
+        a, b = RecordCipher(key), RecordCipher(key)
+
+        self.assertNotEqual(a.seal(b'same', 0), b.seal(b'same', 1))
+
+    def test_rejects_tampered_and_replayed_records(self):
+        key = os.urandom(32)
+        sealer, opener = RecordCipher(key, aead=AESGCM), RecordCipher(key, aead=AESGCM)
+
+        record = sealer.seal(b'hello', 0)
+        with self.assertRaises(InvalidTag):
+            opener.open(record[:-1] + bytes((record[-1] ^ 1,)), 0)
+
+        opener = RecordCipher(key, aead=AESGCM)
+        opener.open(record, 0)
+        with self.assertRaises(InvalidTag):
+            opener.open(record, 0)
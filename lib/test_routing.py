@@ -0,0 +1,82 @@
+import unittest
+import os
+
+from cryptography.exceptions import InvalidTag
+
+from lib import protocol
+from lib.routing import (RoutingTable, EndToEnd, Route, MAX_HOPS, SENT_REFERENCES)
+
+
+OWN, B, C, D = (bytes((i,)) * 32 for i in range(4))
+
+
+class RoutingTableTest(unittest.TestCase):
+    def test_picks_shortest_route_and_withdraws(self):
+        table = RoutingTable(OWN)
+        self.assertTrue(table.update('10.0.0.2', [(B, 0), (C, 1), (OWN, 1)]))
+        self.assertTrue(table.update('10.0.0.3', [(C, 0), (D, 3)]))
+
+        self.assertEqual(Route('10.0.0.2', 1), table.route(B))
+        self.assertEqual(Route('10.0.0.3', 1), table.route(C))
+        self.assertEqual(Route('10.0.0.3', 4), table.route(D))
+        self.assertNotIn(OWN, table)
+
+        # a full advertisement replaces the previous one, C is now only reachable through 10.0.0.2
+        self.assertTrue(table.update('10.0.0.3', [(D, 3)]))
+        self.assertEqual(Route('10.0.0.2', 2), table.route(C))
+        self.assertFalse(table.update('10.0.0.3', [(D, 3)]))
+
+        self.assertTrue(table.remove_hop('10.0.0.2'))
+        self.assertIsNone(table.route(C))
+        self.assertEqual(1, len(table))
+
+    def test_longer_route_through_the_same_hop_is_noticed(self):
+        table = RoutingTable(OWN)
+        table.update('10.0.0.2', [(B, 0), (C, 1)])
+        table.update('10.0.0.3', [(C, 2)])
+        self.assertEqual(Route('10.0.0.2', 2), table.route(C))
+
+        # only C moved, its shortest route is through the other hop now
+        self.assertTrue(table.update('10.0.0.2', [(B, 0), (C, 5)]))
+        self.assertEqual(Route('10.0.0.3', 3), table.route(C))
+        self.assertEqual(Route('10.0.0.2', 1), table.route(B))
+
+    def test_poisoned_reverse_and_hop_limit(self):
+        table = RoutingTable(OWN)
+        table.update('10.0.0.2', [(B, 0), (C, MAX_HOPS - 1)])
+        self.assertNotIn(C, table)
+
+        advertisement = dict(table.advertisement('10.0.0.2'))
+        self.assertEqual({OWN: 0, B: MAX_HOPS}, advertisement)
+        self.assertEqual({OWN: 0, B: 1}, dict(table.advertisement('10.0.0.3')))
+
+        routes = table.advertisement('10.0.0.3')
+        self.assertEqual(routes, protocol.decode_routes(protocol.encode_routes(routes)))
+
+
+class EndToEndTest(unittest.TestCase):
+    def test_out_of_order_messages_open_once(self):
+        shared = os.urandom(32)
+        initiator, responder = EndToEnd(shared, is_initiator=True), EndToEnd(shared, is_initiator=False)
+
+        first, second = initiator.seal(b'one'), initiator.seal(b'two')
+        self.assertEqual(b'two', responder.open(second))
+        self.assertEqual(b'one', responder.open(first))
+        with self.assertRaises(InvalidTag):
+            responder.open(first)
+
+        self.assertEqual(b'back', initiator.open(responder.seal(b'back')))
+        with self.assertRaises(InvalidTag):
+            EndToEnd(os.urandom(32), is_initiator=False).open(initiator.seal(b'other key'))
+
+    def test_only_recently_sealed_messages_are_recognised(self):
+        initiator = EndToEnd(os.urandom(32), is_initiator=True)
+        first = initiator.seal(b'first')
+        self.assertTrue(initiator.sealed(EndToEnd.reference(first)))
+        # the same counter under another key
+        other = EndToEnd(os.urandom(32), is_initiator=True).seal(b'first')
+        self.assertFalse(initiator.sealed(EndToEnd.reference(other)))
+
+        for _ in range(SENT_REFERENCES):
+            initiator.seal(b'more')
+        self.assertFalse(initiator.sealed(EndToEnd.reference(first)))
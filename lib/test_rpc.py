@@ -0,0 +1,57 @@
+import unittest
+import asyncio
+
+from lib.rpc import RequestTracker
+
+
+class RequestTrackerTest(unittest.TestCase):
+    def test_replies_resolve_matching_requests(self):
+        async def main():
+            tracker = RequestTracker()
+            first, first_reply = tracker.new_request()
+            second, second_reply = tracker.new_request()
+            self.assertNotEqual(first, second)
+
+            # replies arrive out of order
+            asyncio.get_event_loop().call_soon(tracker.resolve, second, b'two')
+            asyncio.get_event_loop().call_soon(tracker.resolve, first, b'one')
+
+            self.assertEqual(b'one', await tracker.wait(first, first_reply))
+            self.assertEqual(b'two', await tracker.wait(second, second_reply))
+            self.assertEqual(0, len(tracker))
+
+        asyncio.run(main())
+
+    def test_timeout_and_late_reply(self):
+        async def main():
+            tracker = RequestTracker()
+            request_id, reply = tracker.new_request()
+
+            with self.assertRaises(asyncio.TimeoutError):
+                await tracker.wait(request_id, reply, timeout=0.01)
+            self.assertFalse(tracker.resolve(request_id, b'late'))
+
+        asyncio.run(main())
+
+    def test_cancel_all_fails_waiters(self):
+        async def main():
+            tracker = RequestTracker()
+            request_id, reply = tracker.new_request()
+            asyncio.get_event_loop().call_soon(tracker.cancel_all, ConnectionResetError())
+
+            with self.assertRaises(ConnectionResetError):
+                await tracker.wait(request_id, reply)
+
+        asyncio.run(main())
+
+    def test_discarded_request_is_forgotten(self):
+        async def main():
+            tracker = RequestTracker()
+            request_id, reply = tracker.new_request()
+            tracker.discard(request_id)
+
+            self.assertEqual(0, len(tracker))
+            self.assertTrue(reply.cancelled())
+            self.assertFalse(tracker.resolve(request_id, b'late'))
+
+        asyncio.run(main())
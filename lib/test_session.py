@@ -0,0 +1,43 @@
+import unittest
+import os
+
+from lib.session import SessionCache
+
+
+class SessionCacheTest(unittest.TestCase):
+    def test_both_ends_derive_the_same_ticket(self):
+        shared = os.urandom(32)
+        ours, theirs = SessionCache(), SessionCache()
+
+        session = ours.store('10.0.0.2', b'their key', shared, 1)
+        theirs.store('10.0.0.1', b'our key', shared, 1)
+        self.assertEqual(session.secret, theirs.take(session.ticket).secret)
+
+    def test_tickets_are_single_use_and_expire(self):
+        now = [0.0]
+        cache = SessionCache(lifetime=10, clock=lambda: now[0])
+
+        session = cache.store('10.0.0.2', b'key', os.urandom(32), 1)
+        # looking doesn't use it up
+        self.assertEqual(session, cache.get(session.ticket))
+        self.assertEqual(session, cache.take_for('10.0.0.2'))
+        self.assertIsNone(cache.take(session.ticket))
+        self.assertIsNone(cache.take_for('10.0.0.2'))
+
+        session = cache.store('10.0.0.2', b'key', os.urandom(32), 1)
+        now[0] = 10
+        self.assertIsNone(cache.take(session.ticket))
+        self.assertEqual(0, len(cache))
+
+    def test_keeps_one_session_per_address_within_capacity(self):
+        cache = SessionCache(capacity=2)
+
+        old = cache.store('10.0.0.2', b'key', os.urandom(32), 1)
+        cache.store('10.0.0.2', b'key', os.urandom(32), 1)
+        self.assertIsNone(cache.take(old.ticket))
+
+        first = cache.store('10.0.0.3', b'key', os.urandom(32), 1)
+        cache.store('10.0.0.4', b'key', os.urandom(32), 1)
+        cache.store('10.0.0.5', b'key', os.urandom(32), 1)
+        self.assertEqual(2, len(cache))
+        self.assertIsNone(cache.take(first.ticket))
@@ -0,0 +1,25 @@
+import unittest
+
+from lib.simulator import Simulation
+from lib.transport import LinkProfile
+
+
+class SimulationTest(unittest.TestCase):
+    def test_small_mesh_converges_and_repeats(self):
+        def run():
+            return Simulation(6, LinkProfile(latency=0.02, jitter=0.01, loss=0.05), seed=7).run(broadcasts=3)
+
+        report = run()
+        self.assertEqual(0, report.failed_joins)
+        self.assertIsNotNone(report.membership_convergence)
+        self.assertEqual(1.0, report.broadcast_reach)
+        self.assertEqual(3, report.broadcast_seconds.count)
+        self.assertEqual(6, report.load.count)
+
+        again = run()
+        self.assertEqual(report.messages, again.messages)
+        self.assertEqual(report.virtual_seconds, again.virtual_seconds)
+
+
+if __name__ == '__main__':
+    unittest.main()
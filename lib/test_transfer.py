@@ -0,0 +1,85 @@
+import unittest
+import asyncio
+import os
+import tempfile
+
+from lib import protocol
+from lib.transfer import (OutgoingTransfer, IncomingTransfer, CHUNK_SIZE)
+
+
+class TransferTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.source = os.path.join(self.directory.name, 'source.bin')
+        self.data = os.urandom(CHUNK_SIZE * 2 + 123)
+        with open(self.source, 'wb') as f:
+            f.write(self.data)
+        self.target = os.path.join(self.directory.name, 'target.bin')
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def copy(self, outgoing: OutgoingTransfer, incoming: IncomingTransfer, stop: int = None) -> bool:
+        offset, done = incoming.offset, False
+        while offset < (outgoing.size if stop is None else stop):
+            chunk = outgoing.read_chunk(offset)
+            # through the wire format, as the engine sends them
+            transfer_id, at, data = protocol.decode_chunk(protocol.encode_chunk(outgoing.id, offset, chunk))
+            self.assertEqual(incoming.id, transfer_id)
+            done = incoming.write(at, data)
+            offset += len(data)
+        return done
+
+    def test_interrupted_transfer_resumes(self):
+        async def main():
+            outgoing = OutgoingTransfer(self.source)
+            transfer_id, size, name = protocol.decode_offer(protocol.encode_offer(outgoing.id, outgoing.size, outgoing.name))
+            self.assertEqual(('source.bin', len(self.data)), (name, size))
+
+            incoming = IncomingTransfer(transfer_id, size, self.target)
+            self.assertFalse(self.copy(outgoing, incoming, stop=CHUNK_SIZE))
+            incoming.close()
+            outgoing.close()
+
+            # offering the unchanged file again picks up after the first chunk
+            outgoing = OutgoingTransfer(self.source)
+            self.assertEqual(transfer_id, outgoing.id)
+            incoming = IncomingTransfer(transfer_id, size, self.target)
+            self.assertEqual(CHUNK_SIZE, incoming.offset)
+            self.assertTrue(self.copy(outgoing, incoming))
+            outgoing.close()
+
+        asyncio.run(main())
+        with open(self.target, 'rb') as f:
+            self.assertEqual(self.data, f.read())
+        self.assertEqual(['source.bin', 'target.bin'], sorted(os.listdir(self.directory.name)))
+
+    def test_out_of_order_chunk_rejected(self):
+        incoming = IncomingTransfer(bytes(16), len(self.data), self.target)
+        with self.assertRaises(ValueError):
+            incoming.write(CHUNK_SIZE, self.data[CHUNK_SIZE:2 * CHUNK_SIZE])
+        with self.assertRaises(ValueError):
+            incoming.write(0, self.data + b'extra')
+        incoming.close()
+
+    def test_window_waits_for_acks(self):
+        async def main():
+            outgoing = OutgoingTransfer(self.source)
+            asyncio.get_event_loop().call_soon(outgoing.ack, CHUNK_SIZE)
+            await outgoing.wait_acked(CHUNK_SIZE, timeout=1)
+            with self.assertRaises(asyncio.TimeoutError):
+                await outgoing.wait_acked(2 * CHUNK_SIZE, timeout=0.01)
+            outgoing.close()
+
+        asyncio.run(main())
+
+    def test_failed_transfer_wakes_the_sender(self):
+        async def main():
+            outgoing = OutgoingTransfer(self.source)
+            error = ConnectionAbortedError("gave up")
+            asyncio.get_event_loop().call_soon(outgoing.fail, error)
+            with self.assertRaises(ConnectionAbortedError):
+                await outgoing.wait_acked(CHUNK_SIZE, timeout=1)
+            outgoing.close()
+
+        asyncio.run(main())
@@ -0,0 +1,76 @@
+import unittest
+import asyncio
+import random
+import time
+
+from lib.transport import (MemoryNetwork, LinkProfile, VirtualClockLoop)
+
+
+class MemoryNetworkTest(unittest.TestCase):
+    def setUp(self):
+        self.loop = VirtualClockLoop()
+        asyncio.set_event_loop(self.loop)
+
+    def tearDown(self):
+        self.loop.close()
+        asyncio.set_event_loop(None)
+
+    def connect(self, network: MemoryNetwork):
+        accepted = asyncio.Queue()
+
+        async def main():
+            server, client = network.transport(), network.transport()
+            server.bind('a', 1)
+            client.bind('b', 1)
+            await server.start_server(accepted.put, backlog=1)
+            ours = await client.open_connection('a', 1)
+            return ours, await accepted.get()
+
+        return self.loop.run_until_complete(main())
+
+    def test_virtual_time_passes_without_waiting(self):
+        start = time.perf_counter()
+        self.loop.run_until_complete(asyncio.sleep(3600))
+        self.assertAlmostEqual(3600, self.loop.time())
+        self.assertLess(time.perf_counter() - start, 1)
+
+    def test_frames_arrive_in_order_after_the_latency(self):
+        network = MemoryNetwork(LinkProfile(latency=0.05, jitter=0.05, loss=0.3, retransmit=1.0), random.Random(1))
+        client, server = self.connect(network)
+        self.assertEqual(('b', 1), server.get_extra_info('peername'))
+
+        async def main():
+            sent = self.loop.time()
+            for i in range(50):
+                client.write_frame(b'frame %d' % i)
+            frames = [await server.read_frame() for _ in range(50)]
+            return frames, self.loop.time() - sent
+
+        frames, elapsed = self.loop.run_until_complete(main())
+        self.assertEqual([b'frame %d' % i for i in range(50)], frames)
+        # some were lost and retransmitted, holding back the rest
+        self.assertGreater(elapsed, 1.0)
+        self.assertEqual(50, network.load['b'].writes_sent)
+        self.assertEqual(50, network.load['a'].writes_received)
+
+    def test_close_ends_the_stream_after_pending_frames(self):
+        client, server = self.connect(MemoryNetwork())
+
+        async def main():
+            client.write_frame(b'last words')
+            client.close()
+            self.assertEqual(b'last words', await server.read_frame())
+            with self.assertRaises(ConnectionResetError):
+                await server.read_frame()
+
+        self.loop.run_until_complete(main())
+
+    def test_unbound_address_refuses(self):
+        transport = MemoryNetwork().transport()
+        transport.bind('b', 1)
+        with self.assertRaises(ConnectionRefusedError):
+            self.loop.run_until_complete(transport.open_connection('a', 1))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,81 @@
+import unittest
+import os
+import tempfile
+
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import ed25519
+
+from lib import util
+
+
+def new_key():
+    public = ed25519.Ed25519PrivateKey.generate().public_key()
+    raw = public.public_bytes(encoding=serialization.Encoding.Raw, format=serialization.PublicFormat.Raw)
+    return raw, util.raw_to_ssh(raw)
+
+
+class KeyStoreTest(unittest.TestCase):
+    def setUp(self):
+        fd, self.path = tempfile.mkstemp()
+        os.close(fd)
+        self.now = 0.0
+        self.store = util.KeyStore(self.path, refresh=5, clock=lambda: self.now)
+
+    def tearDown(self):
+        os.remove(self.path)
+
+    def write(self, *lines: bytes, mtime: int):
+        with open(self.path, 'wb') as f:
+            f.write(b'\n'.join(lines) + b'\n')
+        os.utime(self.path, ns=(mtime, mtime))
+
+    def test_loads_ed25519_keys_and_skips_others(self):
+        (raw, kbytes), (other, _) = new_key(), new_key()
+        self.write(kbytes + b' user@host', b'ssh-rsa AAAA', b'', mtime=1)
+
+        self.assertIn(raw, self.store)
+        self.assertNotIn(other, self.store)
+        self.assertEqual(1, len(self.store))
+
+    def test_reloads_changed_file_after_refresh_interval(self):
+        (first, first_kbytes), (second, second_kbytes) = new_key(), new_key()
+        self.write(first_kbytes, mtime=1)
+        self.assertIn(first, self.store)
+
+        self.write(first_kbytes, second_kbytes, mtime=2)
+        self.assertNotIn(second, self.store)
+        self.now = 5
+        self.assertIn(second, self.store)
+
+        os.remove(self.path)
+        self.now = 10
+        self.assertNotIn(first, self.store)
+        # recreated for tearDown
+        self.write(mtime=3)
+
+    def test_parsed_keys_are_cached(self):
+        raw, _ = new_key()
+        key = self.store.public_key(raw)
+        self.assertIs(key, self.store.public_key(raw))
+        self.assertEqual(raw, key.public_bytes(encoding=serialization.Encoding.Raw,
+                                               format=serialization.PublicFormat.Raw))
+
+
+class IdentityTest(unittest.TestCase):
+    def test_identities_read_their_own_directory(self):
+        with tempfile.TemporaryDirectory() as root:
+            directories = [os.path.join(root, name) for name in ('a', 'b')]
+            for directory in directories:
+                os.mkdir(directory)
+                util.create_keys(directory)
+            util.write_trusted_key(util.get_public_key(directories[1]), directories[0])
+            with open(os.path.join(directories[0], "self.pub"), 'ab') as f:
+                f.write(b' user@host\n')
+
+            a, b = (util.Identity.load(directory) for directory in directories)
+            self.assertNotEqual(a.public_raw, b.public_raw)
+            # compared with peers' keys, the comment of self.pub must not stick
+            self.assertEqual(util.raw_to_ssh(a.public_raw), a.public_bytes)
+            self.assertEqual(util.ssh_to_raw(util.get_public_key(directories[0])), a.public_raw)
+            self.assertIn(b.public_raw, a.trusted)
+            self.assertNotIn(a.public_raw, b.trusted)
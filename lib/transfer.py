@@ -0,0 +1,141 @@
+"""
+Chunked file transfers between connected peers
+
+The sender offers a file by id, size and name and the receiver answers with
+how many bytes of it it already holds, so an interrupted transfer resumes
+where it stopped. Chunks of ``CHUNK_SIZE`` bytes then go through the record
+layer like any other message. The receiver acknowledges each one once it's
+written, or with a reason when it gives up on the transfer, and the sender
+never has more than ``WINDOW`` chunks unacknowledged, so a slow receiver or
+disk holds the sender back and neither end buffers more than a window of a
+transfer.
+
+The id is derived from the file's path, size and modification time, sending
+an unchanged file again continues the partial copy the receiver kept next to
+its destination as ``<path>.<id>.part``.
+"""
+
+from typing import Optional
+from hashlib import blake2b
+import asyncio
+import os
+
+
+TRANSFER_ID_SIZE = 16
+CHUNK_SIZE = 64 * 1024
+# unacknowledged chunks in flight per transfer
+WINDOW = 16
+# seconds the sender waits for the receiver to acknowledge a chunk
+ACK_TIMEOUT = 30.0
+
+
+class OutgoingTransfer:
+    """
+    A file being sent, read a chunk at a time into one reused buffer
+    """
+
+    def __init__(self, path: str):
+        self.file = open(path, 'rb')
+        stat = os.fstat(self.file.fileno())
+        self.size = stat.st_size
+        self.name = os.path.basename(path)
+        self.id = blake2b(f"{os.path.abspath(path)}\0{stat.st_size}\0{stat.st_mtime_ns}".encode(),
+                          digest_size=TRANSFER_ID_SIZE).digest()
+
+        self.acked = 0
+        self.error: Optional[Exception] = None
+        self._acked_changed = asyncio.Event()
+        self._buf = bytearray(CHUNK_SIZE)
+
+    def read_chunk(self, offset: int) -> bytes:
+        """
+        Read the chunk starting at offset
+
+        :raises EOFError: if the file ends before its size said it would
+        """
+
+        self.file.seek(offset)
+        n = self.file.readinto(self._buf)
+        if not n and offset < self.size:
+            raise EOFError(f"{self.name} shrank while being sent")
+        return bytes(memoryview(self._buf)[:n])
+
+    def ack(self, offset: int):
+        if offset > self.acked:
+            self.acked = offset
+            self._acked_changed.set()
+
+    def fail(self, error: Exception):
+        """
+        Give up on the transfer, whoever waits for acknowledgements gets error
+        """
+
+        self.error = error
+        self._acked_changed.set()
+
+    async def wait_acked(self, offset: int, timeout: float = ACK_TIMEOUT):
+        """
+        Wait until the receiver acknowledged everything before offset
+
+        :raises asyncio.TimeoutError: if an acknowledgement takes longer than timeout
+        :raises Exception: the error the transfer failed with
+        """
+
+        while self.acked < offset:
+            if self.error is not None:
+                raise self.error
+            self._acked_changed.clear()
+            await asyncio.wait_for(self._acked_changed.wait(), timeout)
+
+    def close(self):
+        self.file.close()
+
+
+class IncomingTransfer:
+    """
+    A file being received into a partial file, renamed to path once complete
+    """
+
+    def __init__(self, transfer_id: bytes, size: int, path: str):
+        self.id = transfer_id
+        self.size = size
+        self.path = path
+        self.part_path = f"{path}.{transfer_id.hex()}.part"
+
+        self.file = open(self.part_path, 'ab')
+        self.offset = self.file.tell()
+        # the file was rewritten since, or the partial copy is corrupt
+        if self.offset > size:
+            self.file.truncate(0)
+            self.offset = 0
+
+    @property
+    def complete(self) -> bool:
+        return self.offset == self.size
+
+    def write(self, offset: int, data: bytes) -> bool:
+        """
+        Append a chunk, which must start where the last one ended
+
+        :returns: True if that completed the file
+        :raises ValueError: if the chunk is out of order or runs past the end
+        """
+
+        if offset != self.offset or offset + len(data) > self.size:
+            raise ValueError(f"chunk at {offset} doesn't follow {self.offset} of {self.size} bytes")
+        self.file.write(data)
+        self.offset += len(data)
+        if self.complete:
+            self.finish()
+        return self.complete
+
+    def finish(self):
+        self.file.close()
+        os.replace(self.part_path, self.path)
+
+    def close(self):
+        """
+        Stop receiving, the partial file stays for a later resumption
+        """
+
+        self.file.close()
@@ -0,0 +1,408 @@
+"""
+How an engine opens and accepts its frame streams
+
+``TcpTransport`` is the real network. ``MemoryNetwork`` connects the
+transports it hands out in memory, with simulated latency, jitter and
+loss, so that many engines can share one process and one event loop. Both
+produce ``FrameProtocol`` streams, framing and everything above it runs
+unchanged.
+
+The in-memory links behave like TCP connections: bytes arrive in order and
+complete, a lost segment only shows as the retransmission delay. Run on a
+:class:`VirtualClockLoop`, no real time passes while the engines wait, so
+hours of protocol activity take as long as the work they cause.
+"""
+
+from .framing import (FrameProtocol, TransportProfile, DEFAULT_PROFILE, start_server, open_connection)
+
+from typing import (Awaitable, Callable, Deque, Dict, NamedTuple, Optional, Tuple)
+from collections import (defaultdict, deque)
+import asyncio
+import random
+import selectors
+import socket
+
+
+# every interface, an engine on it dials out from whichever address the kernel picks
+ANY_HOST = "0.0.0.0"
+
+ClientConnected = Callable[[FrameProtocol], Awaitable]
+
+
+class Transport:
+    """
+    The listening address of one engine and the connections it makes
+    """
+
+    def bind(self, host: str, port: int):
+        """
+        Reserve the address to serve on
+
+        :raises OSError: if the address is taken
+        """
+
+        raise NotImplementedError
+
+    async def start_server(self, client_connected_cb: ClientConnected, backlog: int):
+        """
+        Start accepting connections on the bound address
+
+        :returns: a server with close() and wait_closed()
+        """
+
+        raise NotImplementedError
+
+    async def open_connection(self, host: str, port: int) -> FrameProtocol:
+        """
+        Connect to host from the bound address, unless that's every interface
+
+        :raises OSError: if the connection can't be established
+        """
+
+        raise NotImplementedError
+
+    def close(self):
+        """
+        Release the bound address, for engines that never served on it
+        """
+
+        raise NotImplementedError
+
+
+class TcpTransport(Transport):
+    def __init__(self, profile: TransportProfile = DEFAULT_PROFILE):
+        self.profile = profile
+        self.host = ANY_HOST
+        self.sock: Optional[socket.socket] = None
+
+    def bind(self, host: str, port: int):
+        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        # accepted sockets inherit the buffer sizes, which must be set before listen
+        self.profile.apply(s)
+        s.bind((host, port))
+
+        self.host = host
+        self.sock = s
+
+    async def start_server(self, client_connected_cb: ClientConnected, backlog: int) -> asyncio.AbstractServer:
+        return await start_server(client_connected_cb, self.profile, sock=self.sock, backlog=backlog)
+
+    async def open_connection(self, host: str, port: int) -> FrameProtocol:
+        # peers know us by the address we connect from, which must be the one we listen on
+        local_addr = (self.host, 0) if self.host != ANY_HOST else None
+        return await open_connection(host, port, self.profile, local_addr=local_addr)
+
+    def close(self):
+        if self.sock is not None:
+            self.sock.close()
+
+
+class LinkProfile(NamedTuple):
+    """
+    Behaviour of every simulated link, times in seconds
+    """
+
+    # one way delay, plus up to jitter more drawn uniformly per write
+    latency: float = 0.01
+    jitter: float = 0.0
+    # chance of a write being lost once, it then arrives a retransmission timeout later
+    loss: float = 0.0
+    retransmit: float = 0.2
+
+
+class LinkLoad:
+    """
+    Traffic of one simulated host
+    """
+
+    __slots__ = ('writes_sent', 'bytes_sent', 'writes_received', 'bytes_received', 'connections')
+
+    def __init__(self):
+        self.writes_sent = 0
+        self.bytes_sent = 0
+        self.writes_received = 0
+        self.bytes_received = 0
+        # connections opened and accepted
+        self.connections = 0
+
+
+class MemoryNetwork:
+    """
+    Hosts connected in memory, addressed by any string
+
+    Delays and losses are drawn from rng, with a seeded one and a
+    :class:`VirtualClockLoop` a run repeats exactly.
+    """
+
+    def __init__(self, profile: LinkProfile = LinkProfile(), rng: random.Random = None):
+        self.profile = profile
+        self.rng = rng if rng is not None else random.Random()
+        self._servers: Dict[Tuple[str, int], '_MemoryServer'] = {}
+        self.load: Dict[str, LinkLoad] = defaultdict(LinkLoad)
+
+    def transport(self) -> 'MemoryTransport':
+        return MemoryTransport(self)
+
+    def delay(self) -> float:
+        profile = self.profile
+        delay = profile.latency
+        if profile.jitter:
+            delay += self.rng.uniform(0, profile.jitter)
+        if profile.loss and self.rng.random() < profile.loss:
+            delay += profile.retransmit
+        return delay
+
+    def _bind(self, host: str, port: int) -> '_MemoryServer':
+        if (host, port) in self._servers:
+            raise OSError(f"address {host}:{port} already in use")
+        server = self._servers[(host, port)] = _MemoryServer(self, (host, port))
+        return server
+
+    def _unbind(self, address: Tuple[str, int]):
+        self._servers.pop(address, None)
+
+    async def _connect(self, local_host: str, host: str, port: int) -> FrameProtocol:
+        loop = asyncio.get_event_loop()
+        # the handshake takes a round trip, the refusal of a closed port too
+        await asyncio.sleep(2 * self.profile.latency)
+        server = self._servers.get((host, port))
+        if server is None or server.client_connected_cb is None:
+            raise ConnectionRefusedError(f"{host}:{port} refused the connection")
+
+        client, accepted = FrameProtocol(), FrameProtocol(client_connected_cb=server.client_connected_cb)
+        ours = _MemoryPipe(self, loop, client, (local_host, port), (host, port))
+        theirs = _MemoryPipe(self, loop, accepted, (host, port), (local_host, port))
+        ours.peer, theirs.peer = theirs, ours
+        self.load[local_host].connections += 1
+        self.load[host].connections += 1
+
+        client.connection_made(ours)
+        accepted.connection_made(theirs)
+        return client
+
+
+class MemoryTransport(Transport):
+    """
+    One host of a :class:`MemoryNetwork`
+    """
+
+    def __init__(self, network: MemoryNetwork):
+        self.network = network
+        self.host: Optional[str] = None
+        self.server: Optional[_MemoryServer] = None
+
+    def bind(self, host: str, port: int):
+        if host == ANY_HOST:
+            raise OSError("simulated hosts need an address of their own")
+        self.server = self.network._bind(host, port)
+        self.host = host
+
+    async def start_server(self, client_connected_cb: ClientConnected, backlog: int) -> '_MemoryServer':
+        self.server.client_connected_cb = client_connected_cb
+        return self.server
+
+    async def open_connection(self, host: str, port: int) -> FrameProtocol:
+        return await self.network._connect(self.host, host, port)
+
+    def close(self):
+        if self.server is not None:
+            self.server.close()
+
+
+class _MemoryServer:
+    def __init__(self, network: MemoryNetwork, address: Tuple[str, int]):
+        self.network = network
+        self.address = address
+        self.client_connected_cb: Optional[ClientConnected] = None
+
+    def close(self):
+        # like a listening socket, closing it leaves the accepted connections alone
+        self.network._unbind(self.address)
+        self.client_connected_cb = None
+
+    async def wait_closed(self):
+        pass
+
+
+class _MemoryPipe(asyncio.Transport):
+    """
+    One end of a simulated connection, feeding the other end's protocol
+    """
+
+    def __init__(self, network: MemoryNetwork, loop: asyncio.AbstractEventLoop, protocol: FrameProtocol,
+                 sockname: Tuple[str, int], peername: Tuple[str, int]):
+        super().__init__()
+        self.network = network
+        self.loop = loop
+        self.protocol = protocol
+        self.peer: Optional['_MemoryPipe'] = None
+        self._extra = {'sockname': sockname, 'peername': peername}
+        self._load = network.load[sockname[0]]
+
+        self._closing = False
+        self._lost = False
+        # arrivals are kept in order, a delayed write holds back the ones after it
+        self._last_arrival = 0.0
+        # timers due at the same time may fire in any order, each one delivers the oldest write in flight
+        self._in_flight: Deque[Tuple[Callable, tuple]] = deque()
+        self._paused = False
+        self._backlog: Deque[bytes] = deque()
+        # the peer closed, the end of the stream follows the backlog
+        self._eof_pending = False
+
+    def get_extra_info(self, name, default=None):
+        return self._extra.get(name, default)
+
+    def is_closing(self) -> bool:
+        return self._closing
+
+    def get_write_buffer_size(self) -> int:
+        return 0
+
+    def write(self, data: bytes):
+        if self._closing:
+            return
+        data = bytes(data)
+        self._load.writes_sent += 1
+        self._load.bytes_sent += len(data)
+        self._send(self.peer._receive, data)
+
+    def writelines(self, list_of_data):
+        self.write(b''.join(list_of_data))
+
+    def _send(self, callback: Callable, *args):
+        arrival = max(self.loop.time() + self.network.delay(), self._last_arrival)
+        self._last_arrival = arrival
+        self._in_flight.append((callback, args))
+        self.loop.call_at(arrival, self._arrive)
+
+    def _arrive(self):
+        callback, args = self._in_flight.popleft()
+        callback(*args)
+
+    def _receive(self, data: bytes):
+        if self._lost:
+            return
+        self._load.writes_received += 1
+        self._load.bytes_received += len(data)
+        if self._paused or self._backlog:
+            self._backlog.append(data)
+        else:
+            self._feed(data)
+
+    def _feed(self, data: bytes):
+        view = memoryview(data)
+        while view:
+            buf = self.protocol.get_buffer(len(view))
+            n = min(len(buf), len(view))
+            buf[:n] = view[:n]
+            self.protocol.buffer_updated(n)
+            view = view[n:]
+            # an oversized frame aborts the connection midway
+            if self._lost:
+                return
+
+    def pause_reading(self):
+        self._paused = True
+
+    def resume_reading(self):
+        self._paused = False
+        while self._backlog and not self._paused and not self._lost:
+            self._feed(self._backlog.popleft())
+        if self._eof_pending and not self._backlog:
+            self._end_of_stream()
+
+    def is_reading(self) -> bool:
+        return not self._paused
+
+    def close(self):
+        if self._closing:
+            return
+        self._closing = True
+        # the peer reads everything written so far before the end of the stream
+        self._send(self.peer._peer_closed)
+        self.loop.call_soon(self._connection_lost, None)
+
+    def abort(self):
+        if self._lost:
+            return
+        self._closing = True
+        self.loop.call_at(self.loop.time() + self.network.profile.latency, self.peer._peer_reset)
+        self._connection_lost(None)
+
+    def _peer_closed(self):
+        # everything written before arrived, though reading may be paused with some of it held back
+        self._eof_pending = True
+        if not self._backlog:
+            self._end_of_stream()
+
+    def _end_of_stream(self):
+        if self._lost:
+            return
+        self.protocol.eof_received()
+        self._closing = True
+        self._connection_lost(None)
+
+    def _peer_reset(self):
+        self._closing = True
+        self._connection_lost(ConnectionResetError("connection reset by the peer"))
+
+    def _connection_lost(self, exc: Optional[Exception]):
+        if self._lost:
+            return
+        self._lost = True
+        self._backlog.clear()
+        self.protocol.connection_lost(exc)
+
+
+class _VirtualSelector(selectors.BaseSelector):
+    """
+    Polls real file descriptors without blocking, waiting only advances the clock
+    """
+
+    def __init__(self):
+        self._selector = selectors.DefaultSelector()
+        self.now = 0.0
+
+    def register(self, fileobj, events, data=None):
+        return self._selector.register(fileobj, events, data)
+
+    def unregister(self, fileobj):
+        return self._selector.unregister(fileobj)
+
+    def modify(self, fileobj, events, data=None):
+        return self._selector.modify(fileobj, events, data)
+
+    def select(self, timeout=None):
+        events = self._selector.select(0)
+        if events or timeout is None:
+            # nothing is scheduled, only another thread can wake the loop
+            return events or self._selector.select(None)
+        self.now += timeout
+        return events
+
+    def get_key(self, fileobj):
+        return self._selector.get_key(fileobj)
+
+    def get_map(self):
+        return self._selector.get_map()
+
+    def close(self):
+        self._selector.close()
+
+
+class VirtualClockLoop(asyncio.SelectorEventLoop):
+    """
+    An event loop whose clock jumps to the next timer instead of waiting for it
+
+    Time stands still while callbacks run, work handed to executor threads
+    doesn't hold the clock back.
+    """
+
+    def __init__(self):
+        self._virtual = _VirtualSelector()
+        super().__init__(self._virtual)
+
+    def time(self) -> float:
+        return self._virtual.now
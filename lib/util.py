@@ -2,19 +2,26 @@
 Cryptography related utility functions
 """
 
-from typing import Set
+from typing import (Callable, Dict, Optional, Set)
+import base64
+import os
+import time
 from cryptography.hazmat.backends import default_backend
 from cryptography.hazmat.primitives import serialization
 from cryptography.hazmat.primitives.asymmetric import ed25519
 
 
-def read_private_key():
-    with open(".key/self", 'rb') as f:
+# directory of a node's key pair and trusted keys
+KEY_DIR = ".key"
+
+
+def read_private_key(directory: str = KEY_DIR):
+    with open(os.path.join(directory, "self"), 'rb') as f:
         return serialization.load_pem_private_key(f.read(), None, default_backend())
 
 
-def read_public_key():
-    with open(".key/self.pub", 'rb') as f:
+def read_public_key(directory: str = KEY_DIR):
+    with open(os.path.join(directory, "self.pub"), 'rb') as f:
         return serialization.load_ssh_public_key(f.read(), default_backend())
 
 
@@ -30,23 +37,172 @@ def read_public_key():
 #             _write_key(f, pubkey)
 
 
-def read_trusted_keys() -> Set[bytes]:
-    with open(".key/trusted", 'rb') as f:
+def read_trusted_keys(directory: str = KEY_DIR) -> Set[bytes]:
+    with open(os.path.join(directory, "trusted"), 'rb') as f:
         keys_bytes = f.read()
         return set(keys_bytes.splitlines())
 
 
-def write_trusted_key(pubkey: bytes):
-    with open(".key/trusted", 'ab') as f:
+def write_trusted_key(pubkey: bytes, directory: str = KEY_DIR):
+    with open(os.path.join(directory, "trusted"), 'ab') as f:
         f.write(pubkey)
         f.write(b'\n')
 
 
-def get_public_key() -> bytes:
-    with open(".key/self.pub", 'rb') as f:
+# OpenSSH wire encoding of an ed25519 key: length-prefixed type name, then the 32 raw bytes
+SSH_ED25519_PREFIX = b'\x00\x00\x00\x0bssh-ed25519\x00\x00\x00\x20'
+RAW_KEY_SIZE = 32
+
+
+def ssh_to_raw(kbytes: bytes) -> bytes:
+    """
+    Extract the raw 32 byte ed25519 key from its OpenSSH text form
+
+    :raises ValueError: if kbytes isn't an OpenSSH ed25519 public key
+    """
+
+    fields = kbytes.split()
+    if len(fields) < 2 or fields[0] != b'ssh-ed25519':
+        raise ValueError("not an OpenSSH ed25519 public key")
+    blob = base64.b64decode(fields[1])
+    if len(blob) != len(SSH_ED25519_PREFIX) + RAW_KEY_SIZE or not blob.startswith(SSH_ED25519_PREFIX):
+        raise ValueError("malformed OpenSSH ed25519 public key")
+    return blob[len(SSH_ED25519_PREFIX):]
+
+
+def raw_to_ssh(raw: bytes) -> bytes:
+    """
+    Build the OpenSSH text form of a raw ed25519 key, as written to self.pub
+    """
+
+    return b'ssh-ed25519 ' + base64.b64encode(SSH_ED25519_PREFIX + raw)
+
+
+# seconds between checks of the trusted keys file for changes
+KEYSTORE_REFRESH = 5.0
+PARSED_KEYS_CAPACITY = 4096
+
+
+class KeyStore:
+    """
+    Trusted ed25519 keys by their raw bytes, loaded once from a file
+
+    The file is reloaded when its mtime changes, checked at most every
+    refresh seconds, so membership tests stay O(1) and mostly free of file
+    I/O. Parsed public keys are cached by raw key.
+    """
+
+    def __init__(self, path: str = os.path.join(KEY_DIR, "trusted"), refresh: float = KEYSTORE_REFRESH,
+                 clock: Callable[[], float] = time.monotonic):
+        self.path = path
+        self.refresh = refresh
+        self.clock = clock
+        self._keys: Set[bytes] = set()
+        self._mtime: Optional[int] = None
+        self._checked: Optional[float] = None
+        self._parsed: Dict[bytes, ed25519.Ed25519PublicKey] = {}
+
+    def __contains__(self, raw: bytes) -> bool:
+        self._maybe_reload()
+        return raw in self._keys
+
+    def __len__(self) -> int:
+        self._maybe_reload()
+        return len(self._keys)
+
+    def _maybe_reload(self):
+        now = self.clock()
+        if self._checked is not None and now - self._checked < self.refresh:
+            return
+        self._checked = now
+        self.reload()
+
+    def reload(self):
+        """
+        Read the file again if it changed, a missing file trusts no keys
+        """
+
+        try:
+            mtime = os.stat(self.path).st_mtime_ns
+        except FileNotFoundError:
+            self._keys, self._mtime = set(), None
+            return
+        if mtime == self._mtime:
+            return
+
+        with open(self.path, 'rb') as f:
+            lines = f.read().splitlines()
+        keys = set()
+        for kbytes in lines:
+            try:
+                keys.add(ssh_to_raw(kbytes))
+            # only ed25519 keys identify peers
+            except ValueError:
+                continue
+        self._keys, self._mtime = keys, mtime
+
+    def public_key(self, raw: bytes) -> ed25519.Ed25519PublicKey:
+        """
+        Parse a raw ed25519 key, reusing the object from earlier calls
+        """
+
+        key = self._parsed.get(raw)
+        if key is None:
+            if len(self._parsed) >= PARSED_KEYS_CAPACITY:
+                del self._parsed[next(iter(self._parsed))]
+            key = self._parsed[raw] = ed25519.Ed25519PublicKey.from_public_bytes(raw)
+        return key
+
+
+# shared by every connection of nodes using the default key directory
+trusted_keys = KeyStore()
+
+
+def get_public_key(directory: str = KEY_DIR) -> bytes:
+    with open(os.path.join(directory, "self.pub"), 'rb') as f:
         return f.read()
 
 
+class Identity:
+    """
+    A node's key pair and the keys it trusts
+    """
+
+    def __init__(self, private_key: ed25519.Ed25519PrivateKey, trusted: KeyStore):
+        self.private_key = private_key
+        self.public_raw: bytes = private_key.public_key().public_bytes(
+            encoding=serialization.Encoding.Raw,
+            format=serialization.PublicFormat.Raw
+        )
+        # the canonical OpenSSH form peers' keys are held in, without a comment
+        self.public_bytes: bytes = raw_to_ssh(self.public_raw)
+        self.trusted = trusted
+
+    @classmethod
+    def load(cls, directory: str = KEY_DIR, trusted: KeyStore = None) -> 'Identity':
+        """
+        Read the key pair in directory, trusting the keys of its trusted file unless given a keystore
+        """
+
+        if trusted is None:
+            trusted = KeyStore(os.path.join(directory, "trusted"))
+        return cls(read_private_key(directory), trusted)
+
+
+_default_identity: Optional[Identity] = None
+
+
+def default_identity() -> Identity:
+    """
+    The identity in the default key directory, read on first use
+    """
+
+    global _default_identity
+    if _default_identity is None:
+        _default_identity = Identity.load(KEY_DIR, trusted_keys)
+    return _default_identity
+
+
 # def get_known_keys() -> List:
 #     with open(".key/known_keys") as f:
 #         return f.read().splitlines()
@@ -57,7 +213,7 @@ def get_public_key() -> bytes:
 #         return serialization.load_ssh_public_key(f.read(), default_backend())
 
 
-def create_keys():
+def create_keys(directory: str = KEY_DIR):
     # write private to keys/self
     # write public to keys/self.pub
     # * later other nodes keys.. (database?)
@@ -69,7 +225,7 @@ def create_keys():
         format=serialization.PrivateFormat.PKCS8,
         encryption_algorithm=serialization.NoEncryption()
     )
-    with open('.key/self', 'wb') as f:
+    with open(os.path.join(directory, 'self'), 'wb') as f:
         f.write(privbytes)
 
     pubkey = privkey.public_key()
@@ -77,7 +233,7 @@ def create_keys():
         encoding=serialization.Encoding.OpenSSH,
         format=serialization.PublicFormat.OpenSSH
     )
-    with open('.key/self.pub', 'wb') as f:
+    with open(os.path.join(directory, 'self.pub'), 'wb') as f:
         f.write(pubbytes)
 
     # return pubbytes
@@ -1,7 +1,9 @@
 from lib.meshchat import Meshchat
+from lib.history import MessageHistory
+from lib import logs
 
 from kivy.app import App
-from kivy.clock import Clock
+from kivy.clock import (Clock, mainthread)
 from kivy.core.window import Window
 from kivy.uix.button import Button
 from kivy.uix.label import Label
@@ -100,10 +102,16 @@ class JoinScreen(Screen):
 
 
 class ChatScreen(Screen):
-    def __init__(self, mc, **kwargs):
+    def __init__(self, mc, history, **kwargs):
         super().__init__(**kwargs)
         self.mc = mc
+        self.history = history
+        # conversations are kept by public key, addresses change
+        self.peer = self.mc.connections[self.name].peer_kbytes
+        # index of the oldest message on screen
+        self.oldest = None
 
+        self.load_earlier()
         self.decorate_message_dispatcher()
 
     def decorate_message_dispatcher(self):
@@ -122,13 +130,32 @@ class ChatScreen(Screen):
     def render(self, _):
         self.ids.peer_label.text = self.name
 
+    def load_earlier(self):
+        """
+        Put the previous page of the history above the messages on screen
+        """
+
+        if self.oldest == 0:
+            return
+        self.oldest, msgs = self.history.page(self.peer, before=self.oldest)
+
+        layout = self.ids.message_layout
+        for msg in reversed(msgs):
+            # the last child is drawn first
+            layout.add_widget(Label(text=msg.text), index=len(layout.children))
+
     def render_message(self, msg):
-        print("IMMMMMM RENDDUUUURRIIIIINGG")
+        self.history.append(self.peer, msg)
         self.ids.message_layout.add_widget(Label(text=msg))
 
     def submit_message(self, message, _):
-        self.mc.send_message(self.name, message)
+        try:
+            self.mc.send_message(self.name, message)
+        except (OSError, ValueError) as e:
+            self.ids.message_layout.add_widget(Label(text=f"not sent: {e}"))
+            return
 
+        self.history.append(self.peer, message, outgoing=True)
         self.ids.message_layout.add_widget(Label(text=message))
 
     def on_key_down(self, _is, _kb, keycode, _, modifiers):
@@ -136,6 +163,10 @@ class ChatScreen(Screen):
         if keycode == 41 and not text_input.focus:
             self.manager.current = 'peer'
             return True
+        # page up
+        if keycode == 75:
+            self.load_earlier()
+            return True
         if not text_input.focus:
             return False
 
@@ -165,10 +196,11 @@ class PeerWidget(BoxLayout):
 
 
 class PeerScreen(Screen):
-    def __init__(self, mc, **kwargs):
+    def __init__(self, mc, history, **kwargs):
         super().__init__(**kwargs)
         self.peer_widgets = dict()
         self.mc = mc
+        self.history = history
 
         # Clock.schedule_once(self.render)
         self.mc.bind(
@@ -176,7 +208,8 @@ class PeerScreen(Screen):
             on_peer_connected=self.handle_connection,
             on_peer_joined=self.render_knownpeer,
             on_peer_disconnected=self.erase_connection,
-            on_received_peers=self.render
+            # fired on the loop thread, which mustn't call back into the facade
+            on_received_peers=mainthread(self.render)
             )
 
     def on_enter(self):
@@ -197,7 +230,7 @@ class PeerScreen(Screen):
             if j == kp_len: return False
 
             peer = known_peers.pop()
-            if peer[0] not in self.mc.connections:
+            if peer[0] not in connected:
                 self.render_knownpeer(peer)
 
             j += 1
@@ -208,6 +241,7 @@ class PeerScreen(Screen):
         # Clock.schedule_interval(render_connections, 0)
 
         known_peers = self.mc.get_known_peers()
+        connected = {node.peer_ipa for node in self.mc.get_connections()}
         kp_len = len(known_peers)
         j = 0
         Clock.schedule_interval(render_known, 0)
@@ -220,7 +254,7 @@ class PeerScreen(Screen):
 
         assert not self.manager.has_screen(ipa)
 
-        self.manager.add_widget(ChatScreen(self.mc, name=ipa))
+        self.manager.add_widget(ChatScreen(self.mc, self.history, name=ipa))
 
     def handle_lastmsg(self, kbytes, msg):
         self.peer_widgets[kbytes].ids.last_msg.text = msg
@@ -264,6 +298,7 @@ class MeshchatApp(App):
     def __init__(self):
         super().__init__()
         self.mc = Meshchat()
+        self.history = MessageHistory()
 
         # * append to title user?(name/ipa/pubkey) chatting with
         # * name should be in a personal cerificate that i would get from node itself
@@ -286,11 +321,15 @@ class MeshchatApp(App):
         screen_manager.add_widget(StartScreen())
         screen_manager.add_widget(HostScreen(name='host'))
         screen_manager.add_widget(JoinScreen(name='join'))
-        screen_manager.add_widget(PeerScreen(self.mc, name='peer'))
+        screen_manager.add_widget(PeerScreen(self.mc, self.history, name='peer'))
 
         return screen_manager
 
+    def on_stop(self):
+        self.history.close()
+
 
 if __name__ == '__main__':
+    logs.configure()
     Window.fullscreen = 'auto'
     MeshchatApp().run()
@@ -2,6 +2,8 @@ from tui.util import hide_cursor
 from tui import main_scene
 from tui import chat_scene
 from lib import meshchat
+from lib import logs
+from lib.history import MessageHistory
 
 import curses
 import curses.ascii
@@ -50,12 +52,19 @@ def main(stdscr: 'curses._CursesWindow'):
 
     main_scene.render(canvas, mc)
     # connection established
-    chat_scene.render(canvas, mc)
+    history = MessageHistory()
+    # the chat scene talks to the single connected peer
+    connections = mc.get_connections()
+    peer = next(iter(connections)).peer_kbytes if connections else b''
+    chat_scene.render(canvas, mc, history, peer)
+    history.close()
 
 
 if __name__ == "__main__":
     # reducing delay of the esc key for input mode switch
     environ.setdefault('ESCDELAY', '0')
+    # records on the terminal would draw over the interface
+    logs.configure(stream=False)
 
     # mc.create_keys()
 
@@ -1,6 +1,7 @@
 from .util import (show_cursor)
 from .input_widget import InputWidget
 from .chat_widget import ChatWidget
+from lib.history import PAGE_SIZE
 
 import curses
 from threading import Thread
@@ -39,11 +40,22 @@ def render_messages_win(canvas):
     return (input_widg, chat_widg)
 
 
+def render_history(chat_widg, history, peer, start):
+    chat_widg.clear()
+    for msg in history.read(peer, start, history.count(peer)):
+        if msg.outgoing:
+            chat_widg.render_omsg(msg.text)
+        else:
+            chat_widg.render_rmsg(msg.text)
+
+
 # ceiling centered ipa of node chatting with
-def render(canvas, mc_api):
+def render(canvas, mc_api, history=None, peer=b''):
     def render_remote_messages():
         while (rmsg := mc_api.receive_message()) != "bye":
             if rmsg != '':
+                if history is not None:
+                    history.append(peer, rmsg)
                 chat_widg.render_rmsg(rmsg)
                 # rendermsg moves cursor, hence restoring it, plain getbegyx wouldn't care about borders
                 y, x = input_widg.win.getparyx()
@@ -51,6 +63,8 @@ def render(canvas, mc_api):
                 canvas.refresh()
 
     def chat():
+        nonlocal history_start
+
         receive_thread = Thread(target=render_remote_messages)
         receive_thread.start()
 
@@ -65,11 +79,19 @@ def render(canvas, mc_api):
                     if key == ord('j'):
                         chat_widg.scroll_board(+1, canvas_height)
                     elif key == ord('k'):
-                        chat_widg.scroll_board(-1, canvas_height)
+                        # scrolled to the top, pulling in the previous page of the history
+                        if chat_widg.pad_offset == 0 and history is not None and history_start > 0:
+                            history_start = max(history_start - PAGE_SIZE, 0)
+                            render_history(chat_widg, history, peer, history_start)
+                            chat_widg.scroll_board(-chat_widg.pad_offset, canvas_height)
+                        else:
+                            chat_widg.scroll_board(-1, canvas_height)
 
                 curses.curs_set(1)
                 curses.echo(True)
             else:
+                if history is not None:
+                    history.append(peer, input_txt, outgoing=True)
                 chat_widg.render_omsg(input_txt)
                 mc_api.send_message(input_txt)
 
@@ -82,6 +104,11 @@ def render(canvas, mc_api):
     canvas_height, canvas_width = canvas.getmaxyx()
 
     input_widg, chat_widg = render_messages_win(canvas)
+    # only the latest page is read from disk, earlier ones as the user scrolls up
+    history_start = 0
+    if history is not None:
+        history_start = max(history.count(peer) - PAGE_SIZE, 0)
+        render_history(chat_widg, history, peer, history_start)
     show_cursor()
 
     chat()
@@ -12,7 +12,7 @@ class ChatWidget:
         self.winy, self.winx = self.win.getbegyx()
         self.win_height, self.win_width = self.win.getmaxyx()
 
-        self.msg_voffset, self.msg_hoffset = int(self.win_height * 0.05), int(self.win_width * 0.05)
+        self.msg_voffset, self.msg_hoffset = self._top_offset(), int(self.win_width * 0.05)
         self.msg_minh = 1
         self.msg_minw = int(self.win_width * 0.08)
         self.msg_maxw = int(self.win_width * 0.45)
@@ -23,6 +23,14 @@ class ChatWidget:
         # vertical offset from which to draw pad
         self.pad_offset = 0
 
+    def _top_offset(self):
+        return int(self.win_height * 0.05)
+
+    def clear(self):
+        self.msg_pad.erase()
+        self.msg_voffset = self._top_offset()
+        self.pad_offset = 0
+
     def _render_msg(self, text, remote=False):
         m_mxw, m_mnw = self.msg_maxw, self.msg_minw
         txtlen = len(text)